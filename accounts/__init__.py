@@ -0,0 +1,7 @@
+# Licensed under GPLv3
+"""Calculations and transformations on the cash files
+
+   The rows and grids used by every command are in core, and the commandline
+   is in cli.  Each command is in a module with the code that only it uses,
+   which is only imported when that command is run.
+"""
@@ -0,0 +1,98 @@
+# Licensed under GPLv3
+"""Saving the output of a command, for --cache to reuse
+"""
+import os
+import json
+import hashlib
+from .closed import files_hash
+from .core import CACHE_MAX_BYTES
+
+
+def ledger_hash(dirname, extra_files=()):   # pragma: no cover
+    """return a hash of the contents of all the files that go into the
+       results - every cash file, plus any extra files (like the template)
+    """
+    files = [os.path.join(dirname, f) for f in sorted(os.listdir(dirname))]
+    return files_hash(files + list(extra_files))
+
+
+def cache_key(ledger, cmd, options, as_of):
+    """return the cache key for running cmd with the given options against
+       the ledger, as of the given month
+    """
+    options = sorted((k, repr(v)) for k, v in options.items())
+    text = json.dumps([ledger, cmd, options, as_of])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def cache_as_of(cache, now):
+    """return the part of the date that a cached output depends on, given
+       the 'cache' setting of the command
+    """
+    if cache == 'day':
+        return now.strftime('%Y-%m-%d')
+    return now.strftime('%Y-%m')
+
+
+class OutputCache(object):
+    """A directory of command outputs, each stored in a file named by its
+       cache_key().  Reading an entry touches it, so that the least recently
+       used entries are the ones removed when the size limit is reached.
+    """
+
+    def __init__(self, dirname, max_bytes=CACHE_MAX_BYTES):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key)
+
+    def _entries(self):
+        if not os.path.isdir(self.dirname):
+            return []
+        entries = []
+        for name in os.listdir(self.dirname):
+            st = os.stat(self._path(name))
+            entries.append((st.st_mtime, name, st.st_size))
+        return sorted(entries)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                result = f.read()
+        except (IOError, OSError):
+            return None
+        os.utime(path, None)
+        return result
+
+    def put(self, key, result):
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+
+        # write and rename, so that a reader never sees a partial entry
+        tmp = self._path('.{}.{}'.format(key, os.getpid()))
+        with open(tmp, 'w') as f:
+            f.write(result)
+        os.rename(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        for _, name, size in entries:
+            if total <= self.max_bytes:
+                break
+            os.unlink(self._path(name))
+            total -= size
+
+    def clear(self):
+        entries = self._entries()
+        for _, name, _ in entries:
+            os.unlink(self._path(name))
+        return len(entries)
+
+
+def subp_cache_clear(args):  # pragma: no cover
+    count = OutputCache(args.cache_dir).clear()
+    return "Removed {} cached results".format(count)
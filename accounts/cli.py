@@ -0,0 +1,567 @@
+# Licensed under GPLv3
+"""The commandline, which only imports the module of the command being run,
+   and the modules of any other features that it uses
+"""
+import argparse
+import datetime
+import importlib
+import sys
+import os
+from .core import (
+    BILLS_DIR, CACHE_DIR, CLOSED_PREFIX, FILES_DIR, MIRROR_DB, PERIODS,
+    ROOT_DIR, SITE_DIR, TEMPLATE_FILE, FilePushdown, apply_filter_strings,
+    autosplit_rows, autosplit_spans, closed_safe, comment_filter_word,
+    expand_spans, fast_sum_dir, fast_sum_possible, parse_ledger)
+
+
+# A list of all the sub-commands.  Each is run by the subp_<name>() function
+# in its 'module', which is only imported when the command is run.  The
+# optional keys are:
+#   'args'      - a list of (names, options) for the add_argument() calls
+#                 that set up the commandline options of the command
+#   'stream'    - the command only makes one pass over args.rows, so they
+#                 do not need to be held in memory
+#   'spans'     - the command can handle a RowSpan in args.rows
+#   'load_rows' - False if the command finds its own data
+#   'cache'     - the output only depends on the rows and options, so can
+#                 be reused by --cache for the rest of the month, or 'day'
+#                 if it also depends on the date
+#   'closed'    - the command only needs the month+tag sums, so it can use
+#                 the closed year summaries in place of their rows
+#   'total'     - the command only needs sum(args.rows), so a FastSum of
+#                 the files can be used when the filters allow
+
+# The period option for the commands that group rows by month
+PERIOD_ARGS = [
+    (('--period',), {
+        'choices': sorted(PERIODS), 'default': None,
+        'help': 'Group the rows by this period (default: month)',
+    }),
+]
+
+SCHEDULE_ARGS = [
+    (('--schedule',), {
+        'default': None,
+        'help': 'A file of recurring bills as "tag months amount day" '
+                '(default: learn them from the payments)',
+    }),
+]
+
+subp_cmds = {
+    'sum': {
+        'module': 'summary',
+        'args': PERIOD_ARGS,
+        'closed': True,
+        'total': True,
+        'cache': True,
+        'stream': True,
+        'spans': True,
+        'help': 'Sum all transactions',
+    },
+    'make_balance': {
+        'module': 'page',
+        'closed': True,
+        'cache': True,
+        'stream': True,
+        'help': 'Output sum HTML page',
+    },
+    'topay': {
+        'module': 'topay',
+        'args': PERIOD_ARGS + SCHEDULE_ARGS,
+        'closed': True,
+        'cache': 'day',
+        'stream': True,
+        'spans': True,
+        'help': 'List all pending payments',
+    },
+    'topay_html': {
+        'module': 'topay',
+        'args': PERIOD_ARGS + SCHEDULE_ARGS,
+        'closed': True,
+        'cache': 'day',
+        'stream': True,
+        'spans': True,
+        'help': 'List all pending payments as HTML table',
+    },
+    'party': {
+        'module': 'summary',
+        'closed': True,
+        'total': True,
+        'cache': True,
+        'stream': True,
+        'spans': True,
+        'help': 'Is it party time or not?',
+    },
+    'csv': {
+        'module': 'export',
+        'help': 'Output transactions as csv',
+    },
+    'grid': {
+        'module': 'summary',
+        'args': PERIOD_ARGS + [
+            (('--depth',), {
+                'type': int, 'default': None,
+                'help': 'Collapse the tags into subtotals this many levels '
+                        'deep',
+            }),
+            (('--drill',), {
+                'action': 'append', 'default': [], 'metavar': 'TAG',
+                'help': 'Also show all the tags below this collapsed tag',
+            }),
+        ],
+        'closed': True,
+        'cache': True,
+        'stream': True,
+        'spans': True,
+        'help': 'Output a grid of transaction tags vs months',
+    },
+    'json_payments': {
+        'module': 'export',
+        'closed': True,
+        'cache': True,
+        'stream': True,
+        'spans': True,
+        'help': 'Output JSON of incoming payments',
+    },
+    'coverage': {
+        'module': 'summary',
+        'args': [
+            (('--date',), {
+                'help': 'Date to list the covered members for (default '
+                        'today)',
+            }),
+            (('--member',), {
+                'help': 'List the covered periods and gaps for this member',
+            }),
+        ],
+        'stream': True,
+        'help': 'List members covered by dues on a date, or member gaps',
+    },
+    'history': {
+        'module': 'history',
+        'args': [
+            (('--diff',), {
+                'nargs': 2, 'metavar': 'REV',
+                'help': 'Output a grid of the changes between two git '
+                        'revisions',
+            }),
+        ],
+        'load_rows': False,
+        'help': 'Show the balance after each git commit, or a grid diff',
+    },
+    'receipts': {
+        'module': 'receipts',
+        'args': [
+            (('--bills',), {
+                'default': os.path.join(ROOT_DIR, BILLS_DIR),
+                'help': 'Directory of receipt files',
+            }),
+            (('--window',), {
+                'type': int, 'default': 31,
+                'help': 'How many days a receipt can be from its payment',
+            }),
+        ],
+        'stream': True,
+        'help': 'Match bill payments to the receipts in the bills dir',
+    },
+    'dupes': {
+        'module': 'dupes',
+        'args': [
+            (('--days',), {
+                'type': int, 'default': 7,
+                'help': 'How many days apart two payments can be and still '
+                        'be reported as likely duplicates',
+            }),
+        ],
+        'help': 'Report rows that look like they were recorded twice',
+    },
+    'payment_matrix': {
+        'module': 'door',
+        'args': [
+            (('source',), {
+                'help': 'Door activity export, as a CSV or HTML file or '
+                        'http URL',
+            }),
+            (('--month',), {
+                'default': None,
+                'help': 'Month to check (YYYY-MM), default is the latest '
+                        'ping',
+            }),
+        ],
+        'stream': True,
+        'help': 'Compare the door activity with the dues paid',
+    },
+    'forecast': {
+        'module': 'forecast',
+        'args': [
+            (('--months',), {
+                'type': int, 'default': 12,
+                'help': 'How many months to forecast',
+            }),
+            (('--scenarios',), {
+                'type': int, 'default': 1000,
+                'help': 'How many scenarios to simulate',
+            }),
+            (('--churn',), {
+                'type': float,
+                'help': 'Chance of each member leaving each month (default '
+                        'learnt)',
+            }),
+            (('--seed',), {
+                'type': int,
+                'help': 'Random seed, for repeatable results',
+            }),
+        ],
+        'stream': True,
+        'help': 'Simulate the future balance from the bills and dues',
+    },
+    'import': {
+        'module': 'importer',
+        'args': [
+            (('files',), {
+                'nargs': '+',
+                'help': 'CSV or TSV files with a header row',
+            }),
+            (('--delimiter',), {
+                'help': 'Field delimiter (default: tab for .tsv files, else '
+                        'comma)',
+            }),
+            (('--value-col',), {
+                'default': 'value',
+                'help': 'Name of the value column, negative values are '
+                        'outgoing',
+            }),
+            (('--date-col',), {
+                'default': 'date',
+                'help': 'Name of the date column',
+            }),
+            (('--comment-col',), {
+                'default': 'comment',
+                'help': 'Name of the comment column',
+            }),
+            (('--date-format',), {
+                'help': 'strptime format of the dates, if not YYYY-MM-DD',
+            }),
+            (('--dry-run',), {
+                'action': 'store_true',
+                'help': 'Only show where each new transaction would be added',
+            }),
+        ],
+        'load_rows': False,
+        'help': 'Add the transactions from CSV or TSV files to the cash files',
+    },
+    'sqlite': {
+        'module': 'mirror',
+        'args': [
+            (('--db',), {
+                'default': os.path.join(ROOT_DIR, MIRROR_DB),
+                'help': 'The sqlite database file',
+            }),
+            (('--sql',), {
+                'help': 'Run this SQL query instead of selecting the '
+                        'filtered rows',
+            }),
+        ],
+        'load_rows': False,
+        'help': 'Sync an sqlite copy of the rows and query it',
+    },
+    'site': {
+        'module': 'website',
+        'args': [
+            (('--out-dir',), {
+                'default': os.path.join(ROOT_DIR, SITE_DIR),
+                'help': 'Directory to write the pages into',
+            }),
+            (('--jobs',), {
+                'type': int, 'default': None,
+                'help': 'How many processes to render with (default: one '
+                        'per cpu)',
+            }),
+        ] + SCHEDULE_ARGS,
+        'stream': True,
+        'help': 'Output a static site with a page per month and member',
+    },
+    'close_year': {
+        'module': 'closed',
+        'args': [
+            (('year',), {
+                'type': int,
+                'help': 'The year to close',
+            }),
+        ],
+        'load_rows': False,
+        'help': 'Summarise a year of cash files, to save reading them',
+    },
+    'seal': {
+        'module': 'seal',
+        'load_rows': False,
+        'help': 'Record a hash tree over the cash files, to verify them',
+    },
+    'verify': {
+        'module': 'seal',
+        'load_rows': False,
+        'help': 'Find the cash files that changed since they were sealed',
+    },
+    'search': {
+        'module': 'index',
+        'args': [
+            (('terms',), {
+                'nargs': '+', 'metavar': 'term',
+                'help': 'A word, or a "#tag" to find it and the tags below '
+                        'it',
+            }),
+            (('--any',), {
+                'action': 'store_true', 'default': False,
+                'help': 'Find the rows with any of the terms, not all of '
+                        'them',
+            }),
+        ],
+        'index': True,
+        'stream': True,
+        'help': 'Find the rows with words or tags in their comments',
+    },
+    'trends': {
+        'module': 'trends',
+        'args': [
+            (('--json',), {
+                'action': 'store_true',
+                'help': 'Output every month of every series as JSON',
+            }),
+        ],
+        'closed': True,
+        'stream': True,
+        'spans': True,
+        'cache': True,
+        'help': 'Output rolling sums, year on year changes and tag shares',
+    },
+    'cache_clear': {
+        'module': 'cache',
+        'load_rows': False,
+        'help': 'Remove all the results saved by --cache',
+    },
+}
+
+
+def command_func(cmd):
+    """Import the module of a command, and return the function that runs it
+    """
+    module = importlib.import_module(
+        '.' + subp_cmds[cmd]['module'], __name__.rpartition('.')[0])
+    return getattr(module, 'subp_' + cmd)
+
+
+class CommandFinder(argparse.ArgumentParser):
+    """A parser of just the global options, to find the command name.  Any
+       error is left for the full parser to report
+    """
+    def error(self, message):
+        raise ValueError(message)
+
+
+def command_find(options, argv):
+    """return the first argument after the global options, which names the
+       command, or None
+    """
+    finder = CommandFinder(add_help=False, parents=[options])
+    finder.add_argument('cmd', nargs='?')
+    try:
+        return finder.parse_known_args(argv)[0].cmd
+    except ValueError:
+        return None
+
+
+def main_options():
+    """return a parser of the global options, given before the command
+    """
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--dir',
+                         action='store',
+                         type=str,
+                         default=os.path.join(ROOT_DIR, FILES_DIR),
+                         help='Input directory')
+    options.add_argument('--filter', action='append',
+                         help='Add a key=value filter to the rows used')
+    options.add_argument('--split',
+                         action='store_const', const=True,
+                         default=False,
+                         help='Split rows that cover multiple months')
+    options.add_argument('--cache',
+                         action='store_const', const=True,
+                         default=False,
+                         help='Reuse the saved output from an identical '
+                              'command on an unchanged ledger')
+    options.add_argument('--cache-dir',
+                         default=os.path.join(ROOT_DIR, CACHE_DIR),
+                         help='Where to save the --cache results')
+    options.add_argument('--full', action='store_true',
+                         default=False,
+                         help='Read every cash file, even for the years '
+                              'that have been closed')
+    options.add_argument('--from', dest='from_month', metavar='YYYY-MM',
+                         help='Only use rows from this month onwards')
+    options.add_argument('--to', dest='to_month', metavar='YYYY-MM',
+                         help='Only use rows up to and including this month')
+    options.add_argument('--spans',
+                         action='store_const', const=True,
+                         default=False,
+                         help='Like --split, but keep each split row as '
+                              'one month range')
+    options.add_argument('--out', default='-',
+                         help='Output file (default: stdout)')
+    return options
+
+
+#
+# Most of this is boilerplate and stays the same even with addition of
+# features.  The only exception is if a sub-command needs to add a new
+# commandline option, which is done with its 'args' in subp_cmds.
+#
+def main(argv=None):  # pragma: no cover
+    if argv is None:
+        argv = sys.argv[1:]
+
+    global_options = main_options()
+    argparser = argparse.ArgumentParser(
+        description='Run calculations and transformations on cash data',
+        parents=[global_options])
+
+    # Only the parser of the command being run is needed, so the command is
+    # found first and only its parser is made.  Without a known command,
+    # they are all made so that the usage lists them.
+    cmds = list(subp_cmds)
+    cmd = command_find(global_options, argv)
+    if cmd in subp_cmds:
+        cmds = [cmd]
+
+    subp = argparser.add_subparsers(help='Subcommand', dest='cmd')
+    subp.required = True
+    for key in cmds:
+        parser = subp.add_parser(key, help=subp_cmds[key]['help'])
+
+        # the output can also be given after the command, as it used to be
+        # for csv
+        parser.add_argument('--out', default=argparse.SUPPRESS,
+                            help=argparse.SUPPRESS)
+
+        for names, options in subp_cmds[key].get('args', []):
+            parser.add_argument(*names, **options)
+
+    args = argparser.parse_args(argv)
+    args.func = command_func(args.cmd)
+
+    if not os.path.exists(args.dir):
+        raise RuntimeError('Directory "{}" does not exist'.format(args.dir))
+
+    if args.out == '-':
+        out = sys.stdout
+    else:
+        out = open(args.out, 'w')
+    try:
+        main_run(args, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def main_run(args, out):  # pragma: no cover
+    """Run the command from the parsed commandline, writing to out
+    """
+    # the month range options are just more filters
+    if args.filter is None:
+        args.filter = []
+    if args.from_month:
+        args.filter.append('month>=' + args.from_month)
+    if args.to_month:
+        args.filter.append('month<=' + args.to_month)
+
+    # some commands find their own data
+    if not subp_cmds[args.cmd].get('load_rows', True):
+        result = args.func(args)
+        if result is not None:
+            out.write(result + '\n')
+        return
+
+    # a cached result saves loading anything at all
+    cache = None
+    if args.cache and subp_cmds[args.cmd].get('cache'):
+        from .cache import OutputCache, cache_as_of, cache_key, ledger_hash
+
+        cache = OutputCache(args.cache_dir)
+        options = dict(vars(args))
+        for option in ('func', 'dir', 'cache', 'cache_dir', 'out'):
+            options.pop(option, None)
+        extra_files = [os.path.join(ROOT_DIR, TEMPLATE_FILE)]
+        if getattr(args, 'schedule', None):
+            extra_files.append(args.schedule)
+        key = cache_key(
+            ledger_hash(args.dir, extra_files),
+            args.cmd, options,
+            cache_as_of(subp_cmds[args.cmd]['cache'],
+                        datetime.datetime.utcnow()))
+
+        result = cache.get(key)
+        if result is not None:
+            out.write(result + '\n')
+            return
+
+    # the closed years can be summarised, if that makes no difference
+    summaries = ()
+    if (subp_cmds[args.cmd].get('closed') and not args.full and
+            closed_safe(args.filter) and
+            any(f.startswith(CLOSED_PREFIX) for f in os.listdir(args.dir))):
+        from .closed import closed_load
+
+        summaries = closed_load(args.dir)
+
+    # first, load the data, skipping files that the filters rule out
+    pushdown = FilePushdown(args.filter, split=args.split or args.spans)
+
+    if (subp_cmds[args.cmd].get('total') and
+            getattr(args, 'period', None) is None and
+            fast_sum_possible(args.filter)):
+        # splitting rows never changes the total, and the filters have all
+        # been handled by the pushdown, so the one total can stand in for
+        # all of the rows
+        args.rows = [fast_sum_dir(args.dir, pushdown, summaries)]
+    else:
+        args.rows = parse_ledger(args.dir, pushdown, summaries,
+                                 split=args.split or args.spans)
+
+        # the comments are indexed for the commands that search them, or to
+        # answer word filters from an index saved with the --cache results
+        args.index = None
+        if subp_cmds[args.cmd].get('index') or (
+                args.cache and any(comment_filter_word(s) is not None
+                                   for s in args.filter)):
+            from .index import comment_index
+
+            args.rows = list(args.rows)
+            args.index = comment_index(args, summaries, args.rows)
+
+        # optionally split multi-month transactions into one per month
+        if args.spans:
+            args.rows = autosplit_spans(args.rows)
+            if not subp_cmds[args.cmd].get('spans'):
+                # this command needs to see every child row
+                args.rows = expand_spans(args.rows)
+        elif args.split:
+            args.rows = autosplit_rows(args.rows)
+
+        # apply any filters requested
+        args.rows = apply_filter_strings(args.filter, args.rows, args.index)
+
+    # Each stage above only handles one row at a time, the rows are only
+    # all held in memory for the commands that need more than one pass
+    if not subp_cmds[args.cmd].get('stream'):
+        args.rows = list(args.rows)
+
+    if getattr(args.func, 'writes', False) and cache is None:
+        # the output is written as it is made
+        args.func(args, out)
+        return
+
+    result = args.func(args)
+    if result is not None:
+        out.write(result + '\n')
+        if cache is not None:
+            cache.put(key, result)
@@ -0,0 +1,122 @@
+# Licensed under GPLv3
+"""Summarising the cash files of closed years, so that they need not be
+   read again
+"""
+import sys
+import os
+import re
+import json
+import hashlib
+from .core import CLOSED_PREFIX, MemberCoverage, autosplit_rows, parse_lines
+
+
+def files_hash(files):
+    """return a hash of the names and contents of the files
+    """
+    h = hashlib.sha256()
+    for filename in files:
+        if not os.path.isfile(filename):
+            continue
+        with open(filename, 'rb') as f:
+            data = f.read()
+        h.update('{}\0{}\0'.format(os.path.basename(filename),
+                                   len(data)).encode('utf-8'))
+        h.update(data)
+    return h.hexdigest()
+
+
+def closed_files(dirname, year):
+    """return the sorted names of the cash files for the given year
+    """
+    pattern = re.compile(r'^(incoming|outgoing)-{:04d}-\d\d$'.format(year))
+    return sorted(f for f in os.listdir(dirname) if pattern.match(f))
+
+
+def closed_cells(rows):
+    """Sum the rows into cells keyed by (direction, hashtag, month), keeping
+       the last date in each cell.  Return a sorted list of
+       [direction, hashtag, month, value, last date]
+    """
+    cells = {}
+    for row in rows:
+        key = (row.direction, row.hashtag or '', row.month)
+        if key in cells:
+            (value, last) = cells[key]
+            cells[key] = (value + row.value, max(last, row.date))
+        else:
+            cells[key] = (row.value, row.date)
+
+    return [list(key) + [str(abs(value)), last.isoformat()]
+            for key, (value, last) in sorted(cells.items())]
+
+
+def closed_summary(year, files, checksum, rows):
+    """return the summary of a closed year, from all the rows in its files
+    """
+    rows = list(rows)
+
+    last_payments = {}
+    for row in rows:
+        member = MemberCoverage.member(row)
+        if member is not None:
+            date = row.date.isoformat()
+            last_payments[member] = max(date, last_payments.get(member, ''))
+
+    return {
+        'year': year,
+        'files': files,
+        'checksum': checksum,
+        'balance': str(sum(rows)),
+        'cells': closed_cells(rows),
+        'split_cells': closed_cells(autosplit_rows(rows)),
+        'last_payments': last_payments,
+    }
+
+
+def close_year(dirname, year):   # pragma: no cover
+    """Write the summary of the given year into the cash dir
+    """
+    files = closed_files(dirname, year)
+    if not files:
+        raise ValueError('No cash files found for {}'.format(year))
+
+    rows = []
+    for filename in files:
+        direction = filename.split('-', 1)[0]
+        with open(os.path.join(dirname, filename), 'r') as f:
+            rows.extend(parse_lines(f, direction))
+
+    checksum = files_hash([os.path.join(dirname, f) for f in files])
+    summary = closed_summary(year, files, checksum, rows)
+
+    filename = os.path.join(dirname, '{}{}.json'.format(CLOSED_PREFIX, year))
+    with open(filename, 'w') as f:
+        json.dump(summary, f, sort_keys=True)
+        f.write('\n')
+    return summary
+
+
+def closed_load(dirname):   # pragma: no cover
+    """return the closed year summaries that still match their cash files
+    """
+    summaries = []
+    for filename in sorted(os.listdir(dirname)):
+        if not filename.startswith(CLOSED_PREFIX):
+            continue
+        with open(os.path.join(dirname, filename), 'r') as f:
+            summary = json.load(f)
+
+        files = closed_files(dirname, summary['year'])
+        checksum = files_hash([os.path.join(dirname, f) for f in files])
+        if files != summary['files'] or checksum != summary['checksum']:
+            sys.stderr.write('Ignoring {}, the cash files have changed\n'
+                             .format(filename))
+            continue
+        summaries.append(summary)
+    return summaries
+
+
+def subp_close_year(args):  # pragma: no cover
+    summary = close_year(args.dir, args.year)
+    return "Closed {} with {} files, balance {}".format(
+        summary['year'], len(summary['files']), summary['balance'])
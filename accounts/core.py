@@ -0,0 +1,1608 @@
+# Licensed under GPLv3
+"""The rows of the cash files, and the grids that they are summed into, as
+   used by all of the commands
+"""
+from collections import namedtuple
+import calendar
+import datetime
+import os.path
+import decimal
+import bisect
+import heapq
+import math
+import os
+import re
+
+
+#
+# TODO
+# - make Row take Date objects and not strings with dates, removing a string
+#   handling fart from Row.autosplit() and removing external formatting
+#   knowledge from Row
+# - The "!months:[offset:]count" tag is perhaps a little awkward, find a
+#   more obvious format (perhaps "!months=month[,month]+" - which is clearly
+#   a more discoverable format, but would get quite verbose with yearly
+#   transactions (or even just one with more than 3 months...)
+# - The Row object should allow a direction indicating "auto" to take
+#   the direction from the sign of the value - this would simplify the
+#   places where we automatically create a new Row (eg, from splitting)
+# - Implement a running balance check - perhaps using pragma lines in
+#   the input - then we can add a check that the calculated balance matches
+#   the known counted balance at that point in time (quick, accounting people,
+#   tell me the name for this concept!).  Complicating this is the fact that
+#   the running balance is split accross two files - so, this might need
+#   consolidate the incoming and outgoing files.
+
+# The directory holding this package, and the cash files, bills and docs
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FILES_DIR = 'cash'
+MIRROR_DB = 'ledger.sqlite'
+CACHE_DIR = '.cache'
+CACHE_MAX_BYTES = 10 * 1024 * 1024
+TEMPLATE_FILE = os.path.join('docs', 'template.html')
+BILLS_DIR = 'bills'
+SITE_DIR = os.path.join('docs', 'site')
+IGNORE_FILES = ('membershipfees',)
+
+# The summaries written by "close_year" are kept with the cash files
+CLOSED_PREFIX = 'closed-'
+
+# The seal written by "seal" is kept with the cash files
+SEAL_FILE = 'seal.json'
+
+# Filters on these fields give the same result for a closed year summary as
+# for the rows it replaces
+CLOSED_SAFE_FIELDS = ('direction', 'month', 'hashtag', 'rel_months')
+
+# Rows are recorded in the "<direction>-<YYYY-MM>" file for the month that
+# they happened in, but sometimes in the file for the month before or after
+FILE_MONTH_SLACK = 1
+
+# Ensure we do not invent more money
+decimal.getcontext().rounding = decimal.ROUND_DOWN
+
+
+def month_index(date):
+    """return an integer count of months, for simple month arithmetic
+    """
+    return date.year * 12 + date.month - 1
+
+
+def month_name(index):
+    """return the "YYYY-MM" string for a month_index()
+    """
+    return '{:04d}-{:02d}'.format(index // 12, index % 12 + 1)
+
+
+# The periods that the rows can be grouped by, each is rolled up from the
+# finer period given
+PERIODS = {
+    'week': 'day',
+    'month': 'day',
+    'quarter': 'month',
+    'year': 'quarter',
+}
+
+
+def period_key(period, key):
+    """return the integer key of the period holding the given key of the
+       next finer period.  Weeks start on a Monday
+    """
+    if period == 'week':
+        return (key - 1) // 7
+    if period == 'month':
+        date = datetime.date.fromordinal(key)
+        return month_index(date)
+    if period == 'quarter':
+        return key // 3
+    if period == 'year':
+        return key // 4
+    raise ValueError('Unknown period "{}"'.format(period))
+
+
+def period_name(period, key):
+    """return the human readable name of a period_key()
+    """
+    if period == 'week':
+        (year, week, _) = datetime.date.fromordinal(key * 7 + 1).isocalendar()
+        return '{:04d}-W{:02d}'.format(year, week)
+    if period == 'month':
+        return month_name(key)
+    if period == 'quarter':
+        return '{:04d}-Q{}'.format(key // 4, key % 4 + 1)
+    if period == 'year':
+        return '{:04d}'.format(key)
+    raise ValueError('Unknown period "{}"'.format(period))
+
+
+def rel_months(date):
+    """return the approximate number of months between date and now
+    """
+    now = datetime.datetime.utcnow().date()
+    month_this = date.replace(day=1)
+    month_now = now.replace(day=1)
+    rel_days = (month_this - month_now).days
+
+    # approximate the relative number of months with 28 days per month.
+    # for large enough relative values, this will be inaccurate.
+    # TODO - improve the accuracy when needed
+    return int(rel_days / 28.0)
+
+
+def filter_parse(string):
+    """Split a human readable filter into its field, operator and value
+    """
+    # its not a real tokeniser, its just a RE. so, now I have two problems
+    m = re.match("([a-z0-9_]+)([=!<>~]{1,2})(.*)", string, re.I)
+    if not m:
+        raise ValueError('filters must be <key><op><value>')
+
+    field = m.group(1)
+    op = m.group(2)
+    value_match = m.group(3)
+
+    # coerce our value to match into a number, if that looks possible
+    try:
+        value_match = float(value_match)
+    except ValueError:
+        pass
+
+    return field, op, value_match
+
+
+def filter_compare(op, value_now, value_match):
+    """Return True if value_now matches value_match using the filter op
+    """
+    if op == '==':
+        return value_now == value_match
+    elif op == '!=':
+        return value_now != value_match
+    elif op == '>':
+        return value_now > value_match
+    elif op == '<':
+        return value_now < value_match
+    elif op == '>=':
+        return value_now >= value_match
+    elif op == '<=':
+        return value_now <= value_match
+    elif op == '=~':
+        return bool(re.search(value_match, value_now, re.I))
+
+    raise ValueError('Unknown filter operation "{}"'.format(op))
+
+
+def filter_value(attr):
+    """return a field value in the form that the filters compare it in
+    """
+    if isinstance(attr, (int, str, decimal.Decimal)):
+        return attr
+
+    # convert all 'complex' types into string representations
+    return str(attr)
+
+
+class Row(namedtuple('Row', ('value', 'date', 'comment'))):
+
+    def __new__(cls, value, date, comment, direction):
+        value = decimal.Decimal(value)
+        date = datetime.datetime.strptime(date.strip(), "%Y-%m-%d").date()
+
+        if direction not in ('incoming', 'outgoing'):
+            raise ValueError('Direction "{}" unhandled'.format(direction))
+
+        # We use the direction field, so it is impossible to have a negative
+        # value
+        if value < 0:
+            raise ValueError('Value "{}" is negative'.format(value))
+
+        # Inverse value
+        if direction == 'outgoing':
+            value = decimal.Decimal(0)-value
+
+        obj = super(cls, Row).__new__(cls, value, date, comment)
+
+        # Look at the comment for this row and extract any hashtags found
+        # hashtags are used to tag the category of each transaction and
+        # might be overwritten later to decorate them nicely
+        obj.hashtag = obj._xtag('#')
+
+        return obj
+
+    # Where the row was read from, as "filename:line", if known
+    source = None
+
+    # The row that this one was split from, if any
+    parent = None
+
+    def __add__(self, value):
+        if isinstance(value, Row):
+            value = value.value
+
+        return self.value + value
+
+    def __radd__(self, value):
+        return self.__add__(value)
+
+    @property
+    def direction(self):
+        if self.value < 0:
+            return "outgoing"
+        else:
+            return "incoming"
+
+    @property
+    def month(self):
+        return self.date.strftime('%Y-%m')
+
+    @property
+    def rel_months(self):
+        return rel_months(self.date)
+
+    def _xtag(self, x):
+        """Generically extract tags with a given prefix
+        """
+        p = re.compile(x+'([a-zA-Z]\S*)')
+        all_tags = p.findall(self.comment)
+
+        # TODO - have a better plan for what to do with multiple tags
+        if len(all_tags) > 1:
+            raise ValueError('Row has multiple {}tags: {}'.format(x, all_tags))
+
+        if len(all_tags) == 0:
+            return None
+
+        return all_tags[0]
+
+    def bangtag(self):
+        """Look at the comment for this row and extract any '!' tags found
+           bangtags are used to insert meta-commands (like '!months:-1:5')
+        """
+        return self._xtag('!')
+
+    @staticmethod
+    def _month_add(date, incr):
+        """unghgnh.  I am following the pattern of not requiring any extra
+           libs to be installed to use this softare.  This means that
+           there are no month math functions, so I write my own
+
+           Given a date object and a number of months to increment
+           (or decrement) return a new date object
+           (NOTE: no leap year processing, they are assumed not to exist)
+        """
+        # short cut that guarantees not to disturb the date
+        if incr == 0:
+            return date
+
+        year = date.year
+        month = date.month + incr
+        day = date.day
+        while month > 12:
+            year += 1
+            month -= 12
+        while month < 1:
+            year -= 1
+            month += 12
+
+        # clamp to maximum day of the month
+        day = min(day, calendar.monthrange(year, month)[1])
+
+        return datetime.date(year, month, day)
+
+    def _split_range(self):
+        """extract any !months tag and return the range of month offsets
+           that this row could be split into
+        """
+        tag = self.bangtag()
+        if tag is None:
+            return 0, 1
+
+        fields = tag.split(':')
+
+        if fields[0] != 'months':       # TODO: fix this for multiple tags
+            return 0, 1
+
+        if len(fields) < 2 or len(fields) > 3:
+            raise ValueError('months bang must specify one or two numbers')
+
+        if len(fields) == 3:
+            # the fields are "start:count"
+            start = int(fields[1])
+            end = start+int(fields[2])
+        else:
+            # otherwise, the field is just "count"
+            start = 0
+            end = int(fields[1])
+
+        return start, end
+
+    def _split_dates(self):
+        """extract any !months tag and use that to calculate the list of
+           dates that this row could be split into
+        """
+        start, end = self._split_range()
+
+        dates = []
+        for i in range(start, end):
+            dates.append(self._month_add(self.date, i))
+
+        return dates
+
+    def coverage_span(self):
+        """return the first date and the number of months paid for by this
+           row.  Rows that are already children of a split are one month each
+        """
+        if re.search(r'!child\b', self.comment):
+            return self.date, 1
+
+        dates = self._split_dates()
+        return dates[0], len(dates)
+
+    def autosplit_span(self):
+        """Like the 'simple' autosplit(), but return a single RowSpan holding
+           the month range instead of one child row per month
+        """
+        start, end = self._split_range()
+
+        # no splitting needed, return unchanged
+        if start == 0 and end == 1:
+            return self
+
+        return RowSpan(self, start, end - start)
+
+    def autosplit(self, method='simple'):
+        """look at the split bangtag and return a split row if needed
+        """
+        dates = self._split_dates()
+
+        # append a bangtag to show that something has happend to this row
+        # this also means that it cannot be passed to split() twice as that
+        # would find two bangtags and raise an exception
+        comment = self.comment+' !child'
+
+        # divide the value amongst all the child rows
+        count_children = len(dates)
+        if count_children < 1:
+            raise ValueError(
+                'would divide by zero, splitting children from {}'.format(
+                    self.date))
+
+        # (The abs value is taken because the sign is in the self.direction)
+        each_value = abs(self.value / count_children)
+        # (avoid numbers that cannot be represented with cash by using int())
+        each_value = int(each_value)
+
+        rows = []
+
+        if method == 'simple':
+            # The 'simple' splitting will just divide the transaction value
+            # amongst multiple months - rounding any fractions down
+            # and applying them to the first month
+
+            # no splitting needed, return unchanged
+            if len(dates) == 1 and dates[0] == self.date:
+                return [self]
+
+            # the remainder is any money lost due to rounding
+            remainder = abs(self.value) - each_value * count_children
+
+            for date in dates:
+                datestr = date.isoformat()
+                this_value = each_value + remainder
+                remainder = 0  # only add the remainder to the first child
+                rows.append(Row(this_value, datestr, comment, self.direction))
+
+        elif method == 'proportional':
+            # The 'proportional' splitting attempts to pro-rata the transaction
+            # value.  If the transaction is recorded 20% through the month then
+            # only 80% of the monthly value is placed in that month.  The
+            # rest is carried over into the next month, and so on.  This is
+            # carried on until there is a month without enough value for the
+            # whole month.  This final month is accorded the remaining amount.
+            # Finally, the amount for the final month is converted to
+            # a percentage, which is used to approximate a "end date".
+            #
+            # The hope is that this "end date" is good enough to be used as
+            # a data source for membership end dates, but neither analysis nor
+            # discussion has been done on this.
+
+            value = self.value  # the total value available to share
+
+            # for first month, only add the cash for the remainder of the month
+            date = dates.pop(0)
+            day = date.day
+            percent = 1-min(28, day-1)/28.0  # FIXME - month lengths vary
+            datestr = date.isoformat()
+            this_value = int(each_value * percent)
+            value -= this_value
+            rows.append(Row(this_value, datestr, comment, self.direction))
+
+            # the body fills full months with full shares of the value
+            while value >= each_value and len(dates):
+                date = dates.pop(0)
+                datestr = date.isoformat()
+                value -= each_value
+                rows.append(Row(each_value, datestr, comment, self.direction))
+
+            # finally, add any remainders
+            if len(dates):
+                date = dates.pop(0)
+            else:
+                date = self._month_add(date, 1)
+            datestr = date.replace(day=1).isoformat()  # NOTE: clamp to 1st day
+            # this will include any money lost due to rounding
+            this_value = abs(sum(rows) - self.value)
+            percent = min(1, this_value/each_value)
+            day = percent * 27 + 1  # FIXME - month lengths vary
+            week = int(day/7)
+            comment += "({}% dom={} W{})".format(percent, day, week)
+            # NOTE: MemberCoverage records the exact membership end dates
+            rows.append(Row(this_value, datestr, comment, self.direction))
+
+        else:
+            raise ValueError('unknown splitter method name')
+
+        for row in rows:
+            row.parent = self
+        return rows
+
+    def _getvalue(self, field):
+        """return the field value, if the name refers to a method, call it to
+           obtain the value
+        """
+        if not hasattr(self, field):
+            raise AttributeError('Object has no attr "{}"'.format(field))
+        attr = getattr(self, field)
+        if callable(attr):
+            attr = attr()
+        return filter_value(attr)
+
+    def match(self, **kwargs):
+        """using kwargs, check if this Row matches if so, return it, or None
+        """
+        for key, value in kwargs.items():
+            attr = self._getvalue(key)
+            if value != attr:
+                return None
+
+        return self
+
+    def filter(self, string):
+        """Using the given human readable filter, check if this row matches
+           and if so, return it, or None
+        """
+
+        (field, op, value_match) = filter_parse(string)
+        value_now = self._getvalue(field)
+
+        if filter_compare(op, value_now, value_match):
+            return self
+
+        return None
+
+
+class RowSpan(object):
+    """A row split over a range of months, kept as one object.
+
+       This holds the same information as the list of child rows from the
+       'simple' autosplit(), but the memory needed does not grow with the
+       number of months covered.  Filters narrow the set of children down
+       to a list of [lo, hi) runs of child indexes and grid_accumulate()
+       range-adds the runs, only expanding them into months at the end.
+    """
+
+    # these fields are different for each child, all others are the same
+    child_fields = ('value', 'date', 'month', 'rel_months')
+
+    # the child values of these fields only ever increase with the index
+    monotonic_fields = ('date', 'month', 'rel_months')
+
+    def __init__(self, row, first, count, runs=None):
+        self.row = row
+        self.first = first
+        self.count = count
+        if count < 1:
+            raise ValueError(
+                'would divide by zero, splitting children from {}'.format(
+                    row.date))
+        if runs is None:
+            runs = [(0, count)]
+        self.runs = runs
+
+        self.comment = row.comment+' !child'
+        self.hashtag = row.hashtag
+        self.direction = row.direction
+
+        # match the rounding used by autosplit()
+        self.each = int(abs(row.value / count))
+        self.remainder = abs(row.value) - self.each * count
+        self.sign = -1 if row.direction == 'outgoing' else 1
+
+    def __repr__(self):
+        return 'RowSpan({!r}, {}, {}, {})'.format(
+            self.row, self.first, self.count, self.runs)
+
+    def __len__(self):
+        return sum(hi - lo for lo, hi in self.runs)
+
+    @property
+    def value(self):
+        total = self.each * len(self)
+        if self.runs and self.runs[0][0] == 0:
+            total += self.remainder
+        return decimal.Decimal(total * self.sign)
+
+    def __add__(self, value):
+        if isinstance(value, (Row, RowSpan)):
+            value = value.value
+
+        return self.value + value
+
+    def __radd__(self, value):
+        return self.__add__(value)
+
+    def child_date(self, i):
+        return Row._month_add(self.row.date, self.first + i)
+
+    def child_value(self, i):
+        value = self.each
+        if i == 0:
+            value += self.remainder
+        return decimal.Decimal(value * self.sign)
+
+    @property
+    def date(self):
+        return self.child_date(self.runs[0][0])
+
+    @property
+    def month(self):
+        return self.date.strftime('%Y-%m')
+
+    @property
+    def month_first(self):
+        """the month_index() of the first child
+        """
+        return month_index(self.row.date) + self.first
+
+    def _getvalue(self, field):
+        if field in self.child_fields:
+            raise AttributeError(
+                'Field "{}" differs for each child'.format(field))
+        if not hasattr(self, field):
+            raise AttributeError('Object has no attr "{}"'.format(field))
+        attr = getattr(self, field)
+        if callable(attr):
+            attr = attr()
+        return filter_value(attr)
+
+    def _getchildvalue(self, field, i):
+        if field == 'value':
+            return self.child_value(i)
+        date = self.child_date(i)
+        if field == 'date':
+            return str(date)
+        if field == 'month':
+            return date.strftime('%Y-%m')
+        return rel_months(date)
+
+    def _runs_matching(self, field, op, value_match):
+        """return the runs of children where the filter matches
+        """
+        def get(i):
+            return self._getchildvalue(field, i)
+
+        def first_true(lo, hi, predicate):
+            # bisect for the first index where a monotonic predicate is True
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if predicate(get(mid)):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            return lo
+
+        runs = []
+        for lo, hi in self.runs:
+            if field in self.monotonic_fields and op != '=~':
+                if op == '>':
+                    pieces = [(first_true(lo, hi,
+                                          lambda v: v > value_match), hi)]
+                elif op == '>=':
+                    pieces = [(first_true(lo, hi,
+                                          lambda v: v >= value_match), hi)]
+                elif op == '<':
+                    pieces = [(lo, first_true(lo, hi,
+                                              lambda v: v >= value_match))]
+                elif op == '<=':
+                    pieces = [(lo, first_true(lo, hi,
+                                              lambda v: v > value_match))]
+                else:
+                    a = first_true(lo, hi, lambda v: v >= value_match)
+                    b = first_true(a, hi, lambda v: v > value_match)
+                    if op == '==':
+                        pieces = [(a, b)]
+                    else:
+                        pieces = [(lo, a), (b, hi)]
+            elif field == 'value':
+                # only the first child is different, the rest are the same
+                pieces = []
+                if lo == 0:
+                    if filter_compare(op, get(0), value_match):
+                        pieces.append((0, 1))
+                    lo = 1
+                if lo < hi and filter_compare(op, get(lo), value_match):
+                    pieces.append((lo, hi))
+            else:
+                # no shortcut is possible, check each child in turn
+                pieces = []
+                for i in range(lo, hi):
+                    if filter_compare(op, get(i), value_match):
+                        if pieces and pieces[-1][1] == i:
+                            pieces[-1] = (pieces[-1][0], i + 1)
+                        else:
+                            pieces.append((i, i + 1))
+
+            runs.extend((a, b) for a, b in pieces if a < b)
+
+        return runs
+
+    def filter(self, string):
+        """Using the given human readable filter, return a RowSpan with only
+           the children that match, or None if there are none
+        """
+        (field, op, value_match) = filter_parse(string)
+
+        if field not in self.child_fields:
+            value_now = self._getvalue(field)
+            if filter_compare(op, value_now, value_match):
+                return self
+            return None
+
+        runs = self._runs_matching(field, op, value_match)
+        if not runs:
+            return None
+        if runs == self.runs:
+            return self
+
+        span = RowSpan(self.row, self.first, self.count, runs)
+        span.hashtag = self.hashtag
+        return span
+
+    def expand(self):
+        """return the list of child Row objects that this span stands for
+        """
+        rows = []
+        for lo, hi in self.runs:
+            for i in range(lo, hi):
+                value = abs(self.child_value(i))
+                row = Row(value, self.child_date(i).isoformat(),
+                          self.comment, self.direction)
+                row.parent = self.row
+                rows.append(row)
+        return rows
+
+
+def autosplit_rows(rows):
+    """Split each of the rows, one at a time
+    """
+    for row in rows:
+        for child in row.autosplit():
+            yield child
+
+
+def autosplit_spans(rows):
+    """Split each of the rows into a RowSpan, one at a time
+    """
+    for row in rows:
+        yield row.autosplit_span()
+
+
+def expand_spans(rows):
+    """Replace any RowSpan in the rows with the child rows it stands for
+    """
+    for row in rows:
+        if isinstance(row, RowSpan):
+            for child in row.expand():
+                yield child
+        else:
+            yield row
+
+
+def parse_lines(lines, direction, source=None):
+    '''Take the lines from one file and return Row instances'''
+
+    for lineno, row in enumerate(lines, 1):
+        row = row.rstrip('\n')
+        if not row:
+            continue
+        if re.match(r'^# ', row):
+            # skip comment lines
+            # - in future there might be meta/pragmas
+            continue
+        obj = Row(*re.split(r'\s+', row,
+                            # Number of splits (3 fields)
+                            maxsplit=2),
+                  direction=direction)
+        if source is not None:
+            obj.source = '{}:{}'.format(source, lineno)
+        yield obj
+
+
+class FilePushdown(object):
+    """Use the filters to decide which "<direction>-<YYYY-MM>" files could
+       possibly hold matching rows, so that the others need not be parsed.
+
+       This only ever narrows the files read, the filters themselves must
+       still be applied to the rows.  Since rows are not always recorded in
+       the file for their own month, the month range is widened by
+       FILE_MONTH_SLACK.  When splitting, the children of a "!months" row
+       can land anywhere, so those rows are still read from every file.
+    """
+
+    def __init__(self, filter_strings=None, split=False):
+        self.split = split
+        self.directions = None
+        self.exclude = set()
+        self.lo = None
+        self.hi = None
+
+        for string in filter_strings or []:
+            (field, op, value) = filter_parse(string)
+            if field == 'direction':
+                if op == '==':
+                    self._directions(set([value]))
+                elif op == '!=':
+                    self.exclude.add(value)
+            elif field in ('month', 'date'):
+                self._month_bounds(field, op, self._month_of(value))
+            elif field == 'rel_months' and isinstance(value, float):
+                self._rel_months_bounds(op, value)
+
+    def _directions(self, directions):
+        if self.directions is None:
+            self.directions = directions
+        else:
+            self.directions &= directions
+
+    @staticmethod
+    def _month_of(value):
+        if not isinstance(value, str):
+            return None
+        m = re.match(r'(\d{4})-(\d{2})(-\d{2})?$', value)
+        if not m:
+            return None
+        month = int(m.group(1)) * 12 + int(m.group(2)) - 1
+        return month, m.group(3) is not None
+
+    def _limit(self, lo=None, hi=None):
+        if lo is not None and (self.lo is None or lo > self.lo):
+            self.lo = lo
+        if hi is not None and (self.hi is None or hi < self.hi):
+            self.hi = hi
+
+    def _month_bounds(self, field, op, month):
+        if month is None:
+            return
+        (month, is_date) = month
+
+        # a date within the month can still be more or less than the filter
+        after = 0 if is_date else 1
+        before = after
+        if field == 'date' and not is_date:
+            # the filters compare strings, so every "YYYY-MM-DD" in the month
+            # is more than its "YYYY-MM"
+            after = 0
+            before = 1
+        if op in ('>', '>='):
+            self._limit(lo=month + (after if op == '>' else 0))
+        elif op in ('<', '<='):
+            self._limit(hi=month - (before if op == '<' else 0))
+        elif op == '==':
+            self._limit(month, month)
+
+    def _rel_months_bounds(self, op, value):
+        # rel_months() counts 28 day months, so the real number of months is
+        # between value and value*28/31
+        now = month_index(datetime.datetime.utcnow().date())
+        if op in ('>', '>=', '=='):
+            n = value - 1 if op != '>' else value
+            self._limit(lo=now + int(math.floor(min(n, n * 28 / 31.0))))
+        if op in ('<', '<=', '=='):
+            n = value + 1 if op != '<' else value
+            self._limit(hi=now + int(math.ceil(max(n, n * 28 / 31.0))))
+
+    def mode(self, filename):
+        """return 'all' if all the rows in this file are needed, 'split' if
+           only the rows with a "!months" tag are needed, or None to skip it
+        """
+        direction, _, month = filename.partition('-')
+
+        if direction in self.exclude:
+            return None
+        if self.directions is not None and direction not in self.directions:
+            return None
+
+        month = self._month_of(month)
+        if month is None or month[1]:
+            return 'all'
+        month = month[0]
+
+        if self.lo is not None and month < self.lo - FILE_MONTH_SLACK:
+            return 'split' if self.split else None
+        if self.hi is not None and month > self.hi + FILE_MONTH_SLACK:
+            return 'split' if self.split else None
+        return 'all'
+
+
+def ledger_ignored(filename):
+    """return True if the file in the cash dir does not hold rows
+    """
+    return (filename in IGNORE_FILES or filename == SEAL_FILE or
+            filename.startswith(CLOSED_PREFIX))
+
+
+def parse_dir(dirname, pushdown=None, skip=()):   # pragma: no cover
+    '''Take all files in dirname and return Row instances'''
+
+    for filename in os.listdir(dirname):
+        if ledger_ignored(filename) or filename in skip:
+            continue
+
+        mode = 'all'
+        if pushdown is not None:
+            mode = pushdown.mode(filename)
+            if mode is None:
+                continue
+
+        direction, _ = filename.split('-', 1)
+
+        with open(os.path.join(dirname, filename), 'r') as tsvfile:
+            lines = tsvfile
+            if mode == 'split':
+                # blank out the others, keeping the line numbers correct
+                lines = (line if '!months' in line else '' for line in lines)
+            for row in parse_lines(lines, direction, filename):
+                yield row
+
+
+def closed_rows(summary, split=False):
+    """Turn the cells of a closed year summary back into rows, one for each
+       cell, which give the same grid as the rows that they summarise
+    """
+    cells = summary['split_cells'] if split else summary['cells']
+    for (direction, hashtag, month, value, last) in cells:
+        comment = 'closed {}'.format(summary['year'])
+        if hashtag:
+            comment = '#{} {}'.format(hashtag, comment)
+        yield Row(value, last, comment, direction)
+
+
+def closed_safe(filter_strings):
+    """return True if a closed year summary can be used with these filters
+    """
+    for string in filter_strings or []:
+        (field, op, value) = filter_parse(string)
+        if field not in CLOSED_SAFE_FIELDS:
+            return False
+    return True
+
+
+def parse_ledger(dirname, pushdown=None, summaries=(),
+                 split=False):   # pragma: no cover
+    """Take all the rows in dirname, using the closed year summaries in place
+       of the files that they summarise
+    """
+    skip = set()
+    for summary in summaries:
+        skip.update(summary['files'])
+        for row in closed_rows(summary, split):
+            yield row
+
+    for row in parse_dir(dirname, pushdown, skip):
+        yield row
+
+
+class FastSum(object):
+    """Sum the values in cash files without making a Row for each line
+
+       Only the first field of each line is looked at.  Plain values are
+       summed as an integer count of the smallest decimal place seen so far,
+       which gives the same total, to the same number of places, as summing
+       the Decimal values of the rows.  Anything else is still checked and
+       summed with Decimal, the same way as a Row would.  The dates and
+       comments are not checked at all.
+    """
+
+    value_pattern = r'(\d+)(?:\.(\d*))?$'
+
+    def __init__(self):
+        # compiled here, so that it is only done when it will be used
+        self.value_re = re.compile(self.value_pattern)
+        self.units = 0
+        self.places = 0
+        self.extra = 0
+
+    def add_value(self, value):
+        """add a Decimal value from somewhere other than a cash file
+        """
+        self.extra += value
+
+    def add_lines(self, lines, direction):
+        if direction not in ('incoming', 'outgoing'):
+            raise ValueError('Direction "{}" unhandled'.format(direction))
+        sign = -1 if direction == 'outgoing' else 1
+
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line or line.startswith('# '):
+                continue
+            field = line.split(None, 1)[0]
+
+            match = self.value_re.match(field)
+            if match is None:
+                value = decimal.Decimal(field)
+                if value < 0:
+                    raise ValueError('Value "{}" is negative'.format(value))
+                if sign < 0:
+                    value = decimal.Decimal(0) - value
+                self.extra += value
+                continue
+
+            (whole, fraction) = match.groups()
+            fraction = fraction or ''
+            places = len(fraction)
+            if places > self.places:
+                self.units *= 10 ** (places - self.places)
+                self.places = places
+            value = int(whole + fraction) * 10 ** (self.places - places)
+            self.units += sign * value
+
+    def result(self):
+        return decimal.Decimal(self.units).scaleb(-self.places) + self.extra
+
+
+def fast_sum_possible(filter_strings):
+    """return True if the filters only pick whole files, so that FastSum can
+       be used in place of the rows
+    """
+    for string in filter_strings or []:
+        (field, op, value) = filter_parse(string)
+        if field != 'direction' or op not in ('==', '!='):
+            return False
+    return True
+
+
+def fast_sum_dir(dirname, pushdown=None, summaries=()):   # pragma: no cover
+    """return the sum of all the rows in dirname, using FastSum
+    """
+    total = FastSum()
+    skip = set()
+    for summary in summaries:
+        skip.update(summary['files'])
+        for row in closed_rows(summary):
+            if pushdown is None or pushdown.mode(row_filename(row)):
+                total.add_value(row.value)
+
+    for filename in os.listdir(dirname):
+        if ledger_ignored(filename) or filename in skip:
+            continue
+        if pushdown is not None and pushdown.mode(filename) is None:
+            continue
+
+        direction, _ = filename.split('-', 1)
+        with open(os.path.join(dirname, filename), 'r') as f:
+            total.add_lines(f, direction)
+    return total.result()
+
+
+def row_key(row):
+    """return a key that is the same for rows recording the same transaction
+    """
+    comment = ' '.join(row.comment.lower().split())
+    return (row.date, row.value, comment)
+
+
+def row_format(row):
+    """return the line to add to a cash file to record this row
+    """
+    fields = (abs(row.value), row.date.isoformat(), row.comment)
+    return "{}\t{}\t{}\n".format(*fields)
+
+
+def row_filename(row):
+    """return the name of the cash file that this row should be recorded in
+    """
+    return "{}-{}".format(row.direction, row.month)
+
+
+def apply_filter_strings(filter_strings, rows, index=None):
+    """Apply the given list of human readable filters to the rows, using the
+       CommentIndex, if given, for the plain word matches on the comments
+    """
+    if filter_strings is None:
+        filter_strings = []
+
+    lookups = {}
+    if index is not None:
+        for s in filter_strings:
+            word = comment_filter_word(s)
+            if word is not None:
+                lookups[s] = index.comments_matching(word)
+
+    for row in rows:
+        # a RowSpan may return a narrower copy of itself, so keep the result
+        for s in filter_strings:
+            # the comments of split rows are not in the index
+            if s in lookups and row.comment in index.comments:
+                if row.comment not in lookups[s]:
+                    row = None
+                    break
+                continue
+            row = row.filter(s)
+            if row is None:
+                break
+        if row is not None:
+            yield row
+
+
+def comment_filter_word(filter_string):
+    """return the case folded word, if the filter is a "comment=~word" match
+       that the CommentIndex can answer, or None
+    """
+    (field, op, value_match) = filter_parse(filter_string)
+    if field != 'comment' or op != '=~' or isinstance(value_match, float):
+        return None
+    if not re.match(r'^[A-Za-z0-9_]+$', value_match):
+        return None
+    return value_match.lower()
+
+
+class GridAccumulator(object):
+    """Accumulate rows into month+tag buckets
+
+       Months are kept as month_index() integers until the result is asked
+       for.  A RowSpan is not expanded when it is added, each of its runs is
+       recorded as a range of months and these are all applied with a
+       difference array sweep in result()
+    """
+
+    def __init__(self):
+        self.grid = {}
+        self.totals = {}
+        self.total = 0
+        self.ranges = {}
+
+    @staticmethod
+    def tag(row):
+        tag = row.hashtag
+
+        if tag is None:
+            tag = 'unknown'
+
+        return tag.capitalize()
+
+    def _cell(self, tag, month):
+        # I would prefer auto-vivification to all these if statements
+        if tag not in self.grid:
+            self.grid[tag] = {}
+        if month not in self.grid[tag]:
+            self.grid[tag][month] = {
+                'sum': 0,
+                'last': datetime.date(1970, 1, 1),
+            }
+        if month not in self.totals:
+            self.totals[month] = 0
+        return self.grid[tag][month]
+
+    def add(self, row, tag=None):
+        """add the row, optionally using a different hashtag for it
+        """
+        if tag is not None:
+            tag = tag.capitalize()
+        else:
+            tag = self.tag(row)
+
+        if isinstance(row, RowSpan):
+            return self.add_span(row, tag)
+
+        month = month_index(row.date)
+        cell = self._cell(tag, month)
+
+        # sum this row into various buckets
+        cell['sum'] += row.value
+        cell['last'] = max(row.date, cell['last'])
+        self.totals[month] += row.value
+        self.total += row.value
+
+    def add_span(self, span, tag):
+        ranges = self.ranges.setdefault(tag, [])
+        base = span.month_first
+        each = decimal.Decimal(span.each * span.sign)
+        day = span.row.date.day
+
+        for lo, hi in span.runs:
+            ranges.append((base + lo, base + hi, each, day))
+        if span.runs[0][0] == 0 and span.remainder:
+            remainder = decimal.Decimal(span.remainder * span.sign)
+            ranges.append((base, base + 1, remainder, day))
+
+        self.total += span.value
+
+    def _expand_ranges(self):
+        """Sweep the recorded month ranges, summing them into the grid
+        """
+        for tag, ranges in self.ranges.items():
+            diff = {}
+            starts = {}
+            for start, end, value, day in ranges:
+                diff[start] = diff.get(start, 0) + value
+                diff[end] = diff.get(end, 0) - value
+                starts.setdefault(start, []).append((end, day))
+
+            value = 0
+            active = []     # a heap of (-day, end) to find the latest day
+            for month in range(min(diff), max(diff)):
+                value += diff.get(month, 0)
+                for end, day in starts.get(month, []):
+                    heapq.heappush(active, (-day, end))
+                while active and active[0][1] <= month:
+                    heapq.heappop(active)
+                if not active:
+                    continue
+
+                year = month // 12
+                mon = month % 12 + 1
+                day = min(-active[0][0], calendar.monthrange(year, mon)[1])
+
+                cell = self._cell(tag, month)
+                cell['sum'] += value
+                cell['last'] = max(datetime.date(year, mon, day),
+                                   cell['last'])
+                self.totals[month] += value
+
+        self.ranges = {}
+
+    def result(self):
+        """return the months, tags, grid and totals accumulated so far
+        """
+        self._expand_ranges()
+
+        grid = {}
+        for tag, cells in self.grid.items():
+            grid[tag] = {}
+            for month, cell in cells.items():
+                grid[tag][month_name(month)] = cell
+
+        totals = {}
+        for month, value in self.totals.items():
+            totals[month_name(month)] = value
+        totals['total'] = self.total
+
+        months = set(m for m in totals if m != 'total')
+        tags = set(grid)
+
+        return months, tags, grid, totals
+
+
+def grid_accumulate(rows):
+    """Accumulate the rows into month+tag buckets
+    """
+    accumulator = GridAccumulator()
+    for row in rows:
+        accumulator.add(row)
+    return accumulator.result()
+
+
+class TimeCube(object):
+    """Accumulate rows into tag+day cells, keyed by the date.toordinal()
+
+       Each coarser period is rolled up from the cells of the period below it
+       (see PERIODS), so the rows are only looked at once, no matter how many
+       periods are asked for.  The results are in the same form as from
+       GridAccumulator, so they can be rendered the same way.
+    """
+
+    def __init__(self):
+        self.levels = {'day': {}}
+        self.total = 0
+
+    def add(self, row, tag=None):
+        """add the row, optionally using a different hashtag for it
+        """
+        if tag is not None:
+            tag = tag.capitalize()
+        else:
+            tag = GridAccumulator.tag(row)
+
+        if isinstance(row, RowSpan):
+            for child in row.expand():
+                self.add(child, tag)
+            return
+
+        cells = self.levels['day'].setdefault(tag, {})
+        day = row.date.toordinal()
+        cells[day] = cells.get(day, 0) + row.value
+        self.total += row.value
+        # the day cells have changed, so any rollups are stale
+        if len(self.levels) > 1:
+            self.levels = {'day': self.levels['day']}
+
+    def _cells(self, period):
+        """return the {tag: {key: [sum, last]}} cells for the period
+        """
+        if period in self.levels:
+            return self.levels[period]
+
+        finer = PERIODS[period]
+        cells = {}
+        for tag, keys in self._cells(finer).items():
+            rolled = cells.setdefault(tag, {})
+            for key, cell in keys.items():
+                if finer == 'day':
+                    cell = [cell, key]
+                coarse = period_key(period, key)
+                if coarse in rolled:
+                    rolled[coarse][0] += cell[0]
+                    rolled[coarse][1] = max(rolled[coarse][1], cell[1])
+                else:
+                    rolled[coarse] = [cell[0], cell[1]]
+
+        self.levels[period] = cells
+        return cells
+
+    def result(self, period):
+        """return the periods, tags, grid and totals for the given period
+        """
+        grid = {}
+        totals = {}
+        for tag, keys in self._cells(period).items():
+            grid[tag] = {}
+            for key, (value, last) in keys.items():
+                name = period_name(period, key)
+                grid[tag][name] = {
+                    'sum': value,
+                    'last': datetime.date.fromordinal(last),
+                }
+                totals[name] = totals.get(name, 0) + value
+        totals['total'] = self.total
+
+        periods = set(p for p in totals if p != 'total')
+        return periods, set(grid), grid, totals
+
+
+def cube_accumulate(rows, period, tag=None):
+    """Accumulate the rows into period+tag buckets, optionally using the tag
+       function to choose the tag for each row
+    """
+    cube = TimeCube()
+    for row in rows:
+        cube.add(row, None if tag is None else tag(row))
+    return cube.result(period)
+
+
+def tag_parts(tag):
+    """return the list of names on the path from the root of the tag tree to
+       the tag, so "bills:rent" is ['bills', 'rent']
+    """
+    return tag.split(':')
+
+
+def tag_ancestors(tag):
+    """return the tag and every tag above it in the tree, from the root down
+    """
+    parts = tag_parts(tag)
+    return [':'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+def direction_tag(row):
+    """return the hashtag of the row with a prefix to show its direction,
+       so that each category has a nice and clear name in the grid
+    """
+    tag = row.hashtag
+    if tag is None:
+        tag = 'unknown'
+
+    if row.direction == 'outgoing':
+        return 'out ' + tag
+    return 'in ' + tag
+
+
+def grid_accumulate_directions(rows):
+    """Accumulate the rows into month+tag buckets, keeping the incoming and
+       outgoing rows with the same tag apart
+    """
+    accumulator = GridAccumulator()
+    for row in rows:
+        accumulator.add(row, direction_tag(row))
+    return accumulator.result()
+
+
+class StringSink(object):
+    """A writable text sink that keeps everything written to it, for when
+       the output is wanted as a string
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+def writes_output(func):
+    """Wrap a sub-command that writes its output to a sink, given as "out".
+       Without a sink, the output is returned as a string instead, with the
+       final newline left for print() to add, as for the other sub-commands
+    """
+    def wrapper(args, out=None):
+        if out is not None:
+            return func(args, out)
+        sink = StringSink()
+        func(args, sink)
+        value = sink.getvalue()
+        if value.endswith('\n'):
+            value = value[:-1]
+        return value
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.writes = True
+    return wrapper
+
+
+def grid_render_colheader(months, months_len, tags_len):
+    s = []
+
+    # Skip the column of tag names
+    s.append(' '*tags_len)
+
+    # Output the month row headings
+    for month in months:
+        s.append("{:>{}}".format(month, months_len))
+
+    s.append("\n")
+
+    return s
+
+
+def grid_render_totals(months, totals, months_len, tags_len):
+    s = []
+
+    s.append("\n")
+    s.append("{:<{width}}".format('MONTH Sub Total', width=tags_len))
+
+    for month in months:
+        s.append("{:>{}}".format(totals[month], months_len))
+
+    s.append("\n")
+    s.append("{:<{width}}".format('RUNNING Balance', width=tags_len))
+
+    running_total = 0
+    for month in months:
+        running_total += totals[month]
+        s.append("{:>{}}".format(running_total, months_len))
+
+    s.append("\n")
+    s.append("TOTAL: {:>{}}".format(totals['total'], months_len))
+
+    return s
+
+
+def grid_render_rows(months, tags, grid, months_len, tags_len):
+    # Output each tag
+    for tag in tags:
+        row = ''
+        row += "{:<{width}}".format(tag, width=tags_len)
+
+        for month in months:
+            if month in grid[tag]:
+                col = grid[tag][month]['sum']
+            else:
+                col = ''
+            row += "{:>{}}".format(col, months_len)
+
+        row += "\n"
+        yield row
+
+
+def grid_render_datagroom(months, tags):
+    # how much room to allow for the tags
+    tags_len = max([len(i) for i in tags])
+    tags_len += 1
+
+    # how much room to allow for each month column
+    months_len = 9
+
+    months = sorted(months)
+    tags = sorted(tags)
+
+    return months, tags, months_len, tags_len
+
+
+def grid_write(f, months, tags, grid, totals):
+    # Render the accumulated data
+
+    (months, tags, months_len, tags_len) = grid_render_datagroom(months, tags)
+
+    for s in grid_render_colheader(months, months_len, tags_len):
+        f.write(s)
+    for s in grid_render_rows(months, tags, grid, months_len, tags_len):
+        f.write(s)
+    for s in grid_render_totals(months, totals, months_len, tags_len):
+        f.write(s)
+
+
+def grid_render(months, tags, grid, totals):
+    sink = StringSink()
+    grid_write(sink, months, tags, grid, totals)
+    return sink.getvalue()
+
+
+def split_children(row):
+    """return the 'simple' autosplit() children of the row, allowing for rows
+       that are already split
+    """
+    if isinstance(row, RowSpan):
+        return row.expand()
+    if re.search(r'!child\b', row.comment):
+        return [row]
+    return row.autosplit()
+
+
+def percentile(values, fraction):
+    """return the value at the given fraction through the sorted values
+    """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class MemberCoverage(object):
+    """The calendar-exact membership periods paid for by the "#dues:" rows
+
+       Each member has a sorted list of non overlapping [start, end) date
+       intervals.  A payment made while the member is still covered is
+       treated as paying in advance, so it extends the coverage from its
+       current end.  All the intervals are also swept into one sorted list
+       of boundaries, so that both kinds of query are a bisect away.
+    """
+
+    def __init__(self, rows):
+        spans = {}
+        for row in rows:
+            member = self.member(row)
+            if member is None:
+                continue
+            spans.setdefault(member, []).append(row.coverage_span())
+
+        self.intervals = {}
+        for member, items in spans.items():
+            self.intervals[member] = self._merge(items)
+
+        self._starts = {}
+        for member, intervals in self.intervals.items():
+            self._starts[member] = [i[0] for i in intervals]
+
+        self._build_index()
+
+    @staticmethod
+    def member(row):
+        """return the member name that this row pays dues for, or None
+        """
+        if row.direction != 'incoming' or row.hashtag is None:
+            return None
+        fields = row.hashtag.split(':', 1)
+        if fields[0] != 'dues' or len(fields) < 2 or not fields[1]:
+            return None
+        return fields[1].lower()
+
+    @staticmethod
+    def _merge(spans):
+        """Turn a list of (start, months) into sorted, disjoint intervals
+        """
+        intervals = []
+        anchor = None
+        end = None
+        total = 0
+        for start, months in sorted(spans):
+            if months < 1:
+                continue
+            if anchor is not None and start <= end:
+                # still covered, so this payment extends the coverage
+                total += months
+            else:
+                if anchor is not None:
+                    intervals.append((anchor, end))
+                anchor = start
+                total = months
+            # always count from the anchor, to avoid day of month drift
+            end = Row._month_add(anchor, total)
+
+        if anchor is not None:
+            intervals.append((anchor, end))
+        return intervals
+
+    def _build_index(self):
+        """Sweep all the interval edges into elementary segments, each with
+           the set of members covered during that segment
+        """
+        events = {}
+        for member, intervals in self.intervals.items():
+            for start, end in intervals:
+                events.setdefault(start, []).append((1, member))
+                events.setdefault(end, []).append((-1, member))
+
+        self._bounds = sorted(events)
+        self._segments = []
+        covered = set()
+        for date in self._bounds:
+            for change, member in events[date]:
+                if change > 0:
+                    covered.add(member)
+                else:
+                    covered.discard(member)
+            self._segments.append(frozenset(covered))
+
+    def members(self):
+        return sorted(self.intervals)
+
+    def covered_on(self, date):
+        """return the set of members covered on the given date
+        """
+        i = bisect.bisect_right(self._bounds, date) - 1
+        if i < 0:
+            return frozenset()
+        return self._segments[i]
+
+    def is_covered(self, member, date):
+        starts = self._starts.get(member, [])
+        i = bisect.bisect_right(starts, date) - 1
+        if i < 0:
+            return False
+        return date < self.intervals[member][i][1]
+
+    def end_date(self, member):
+        """return the date that the coverage for this member runs out
+        """
+        intervals = self.intervals.get(member)
+        if not intervals:
+            return None
+        return intervals[-1][1]
+
+    def gaps(self, member, start=None, end=None):
+        """return the list of [start, end) intervals where the member was not
+           covered.  Without start or end, the gaps are only those between
+           the first and last covered dates
+        """
+        intervals = self.intervals.get(member, [])
+        if not intervals:
+            if start is not None and end is not None and start < end:
+                return [(start, end)]
+            return []
+
+        starts = self._starts[member]
+        lo = 0
+        hi = len(intervals)
+        if start is not None:
+            lo = max(0, bisect.bisect_right(starts, start) - 1)
+        if end is not None:
+            hi = bisect.bisect_left(starts, end)
+
+        gaps = []
+        if start is not None and start < intervals[lo][0]:
+            gaps.append((start, intervals[lo][0]))
+        for i in range(lo, hi - 1):
+            gaps.append((intervals[i][1], intervals[i+1][0]))
+        if end is not None and hi > 0 and intervals[hi-1][1] < end:
+            gaps.append((intervals[hi-1][1], end))
+
+        # clip to the requested range
+        result = []
+        for gap_start, gap_end in gaps:
+            if start is not None:
+                gap_start = max(gap_start, start)
+            if end is not None:
+                gap_end = min(gap_end, end)
+            if gap_start < gap_end:
+                result.append((gap_start, gap_end))
+        return result
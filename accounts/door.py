@@ -0,0 +1,155 @@
+# Licensed under GPLv3
+"""Comparing the door activity export with the dues paid
+"""
+import csv
+import re
+try:
+    from html.parser import HTMLParser
+    from urllib.request import urlopen
+except ImportError:  # pragma: no cover
+    from HTMLParser import HTMLParser
+    from urllib2 import urlopen
+from .core import MemberCoverage, split_children
+
+
+def door_table_rows(text):
+    """return the text of each cell in each table row of an HTML page
+    """
+    class TableParser(HTMLParser):
+        def __init__(self):
+            HTMLParser.__init__(self)
+            self.rows = []
+            self._cell = None
+
+        def handle_starttag(self, tag, attrs):
+            if tag == 'tr':
+                self.rows.append([])
+            elif tag in ('td', 'th') and self.rows:
+                self._cell = []
+
+        def handle_endtag(self, tag):
+            if tag in ('td', 'th') and self._cell is not None:
+                self.rows[-1].append(''.join(self._cell).strip())
+                self._cell = None
+
+        def handle_data(self, data):
+            if self._cell is not None:
+                self._cell.append(data)
+
+    parser = TableParser()
+    parser.feed(text)
+    parser.close()
+    return parser.rows
+
+
+def door_read(text):
+    """Read a door activity export, either the HTML table from the door
+       server or a CSV file, yielding (name, month) for the last ping of each
+       user.  The name is in the first column and the last ping, starting
+       with a date, in the fourth
+    """
+    if re.search(r'<tr\b', text, re.I):
+        records = door_table_rows(text)
+    else:
+        records = csv.reader(text.splitlines())
+
+    for record in records:
+        if len(record) < 4:
+            continue
+        match = re.match(r'\s*(\d{4}-\d{2})', record[3])
+        if not match or not record[0].strip():
+            continue
+        yield (record[0].strip(), match.group(1))
+
+
+def member_normalise(name):
+    """return the name in the form used to match door users to dues tags
+    """
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+
+def payment_matrix(rows, activity, month):
+    """Join the door activity against the months paid for by dues
+
+       Both sides are hashed by the normalised member name in one pass each.
+       Members are active if their last ping is in the month or later, and
+       paid if their dues cover the month.
+
+       Returns (active_unpaid, paid_inactive), each a sorted list of
+       (name, last ping month, last paid month) with None for unknown
+    """
+    pings = {}
+    names = {}
+    for (name, ping) in activity:
+        key = member_normalise(name)
+        if key not in pings or ping > pings[key]:
+            pings[key] = ping
+            names[key] = name
+
+    paid = {}
+    for row in rows:
+        member = MemberCoverage.member(row)
+        if member is None:
+            continue
+        key = member_normalise(member)
+        names.setdefault(key, member)
+        paid.setdefault(key, set()).update(
+            child.month for child in split_children(row))
+
+    active_unpaid = []
+    paid_inactive = []
+    for key in set(pings) | set(paid):
+        ping = pings.get(key)
+        months = paid.get(key, set())
+        entry = (names[key], ping, max(months) if months else None)
+        active = ping is not None and ping >= month
+        if active and month not in months:
+            active_unpaid.append(entry)
+        elif not active and month in months:
+            paid_inactive.append(entry)
+
+    def _key(entry):
+        return member_normalise(entry[0])
+
+    return (sorted(active_unpaid, key=_key),
+            sorted(paid_inactive, key=_key))
+
+
+def door_fetch(source):   # pragma: no cover
+    """return the text of the door activity export from a file or URL
+    """
+    if re.match(r'^https?://', source):
+        response = urlopen(source)
+        try:
+            return response.read().decode('utf-8')
+        finally:
+            response.close()
+    with open(source, 'r') as f:
+        return f.read()
+
+
+def subp_payment_matrix(args):
+    activity = list(door_read(door_fetch(args.source)))
+
+    month = args.month
+    if month is None:
+        if not activity:
+            return 'No door activity found'
+        month = max(ping for (name, ping) in activity)
+
+    (active_unpaid, paid_inactive) = payment_matrix(args.rows, activity,
+                                                    month)
+
+    def _entry(entry):
+        return "  {:<20}{:>10}{:>10}".format(
+            entry[0], entry[1] or '-', entry[2] or '-')
+
+    s = []
+    s.append("Month: {}".format(month))
+    s.append("  {:<20}{:>10}{:>10}".format('', 'Last ping', 'Last paid'))
+    s.append("Active but unpaid:")
+    s.extend(_entry(entry) for entry in active_unpaid)
+    s.append("")
+    s.append("Paid but inactive:")
+    s.extend(_entry(entry) for entry in paid_inactive)
+    return "\n".join(s)
@@ -0,0 +1,78 @@
+# Licensed under GPLv3
+"""Finding the rows that were recorded twice
+"""
+from .core import MemberCoverage, row_key, split_children
+
+
+def dupes_find(rows, days):
+    """Find the rows that look like they record the same transaction twice
+
+       Exact duplicates have the same row_key() and direction, and are found
+       by hashing.  Likely duplicates pay the same member's dues with the
+       same value within the given number of days, either as recorded or
+       once split into months.  These are bucketed by (member, value) and
+       by date into buckets "days" wide, so only the rows in the same or the
+       neighbouring bucket need to be compared.  The children of one split
+       row are never reported as duplicates of each other.
+
+       Returns a list of the exact duplicate groups and a list of the
+       likely duplicate pairs, all in date order
+    """
+    exact = {}
+    buckets = {}
+    pairs = set()
+    rows = list(rows)
+    origins = [row if row.parent is None else row.parent for row in rows]
+
+    for i, row in enumerate(rows):
+        key = (row.direction,) + row_key(row)
+        exact.setdefault(key, []).append(i)
+
+        member = MemberCoverage.member(row)
+        if member is None:
+            continue
+
+        for child in split_children(row):
+            ordinal = child.date.toordinal()
+            bucket = ordinal // (days + 1)
+            for near in (bucket - 1, bucket, bucket + 1):
+                for (j, other) in buckets.get((member, child.value, near), []):
+                    if (origins[j] is not origins[i] and
+                            abs(other - ordinal) <= days):
+                        pairs.add((j, i))
+            buckets.setdefault((member, child.value, bucket), []).append(
+                (i, ordinal))
+
+    groups = [g for g in exact.values() if len(g) > 1]
+    # there is no need to report the exact duplicates twice
+    for group in groups:
+        for j in group:
+            for i in group:
+                pairs.discard((j, i))
+
+    def _rows(indexes):
+        return sorted((rows[i] for i in indexes),
+                      key=lambda x: (x.date, x.source or ''))
+
+    groups = sorted((_rows(g) for g in groups), key=lambda x: x[0].date)
+    likely = sorted((_rows(p) for p in pairs), key=lambda x: x[0].date)
+    return groups, likely
+
+
+def subp_dupes(args):
+    (groups, likely) = dupes_find(args.rows, args.days)
+
+    def _row(row):
+        return "  {:<24}{:>8}  {}  {}".format(
+            row.source or '-', row.value, row.date, row.comment)
+
+    s = []
+    s.append("Exact duplicates:")
+    for group in groups:
+        s.extend(_row(row) for row in group)
+        s.append("")
+    s.append("Likely duplicates (within {} days):".format(args.days))
+    for pair in likely:
+        s.extend(_row(row) for row in pair)
+        s.append("")
+    return "\n".join(s)
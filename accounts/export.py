@@ -0,0 +1,37 @@
+# Licensed under GPLv3
+"""Exporting the rows as CSV or JSON
+"""
+import csv
+import json
+from .core import Row, apply_filter_strings, grid_accumulate, writes_output
+
+
+@writes_output
+def subp_csv(args, out):
+    rows = sorted(args.rows, key=lambda x: x.date)
+
+    writer = csv.writer(out)
+    # Write header
+    writer.writerow([row.capitalize() for row in Row._fields])
+
+    for row in rows:
+        writer.writerow(row)
+
+    writer.writerow('')
+    writer.writerow(('Sum',))
+    writer.writerow((sum(rows),))
+
+
+def subp_json_payments(args):
+    rows = apply_filter_strings([
+        'direction==incoming',
+    ], args.rows)
+
+    (months, tags, grid, totals) = grid_accumulate(rows)
+    # We are only interested in last payment date
+    return json.dumps(({
+        k.lower(): sorted(
+            v.keys(),
+            key=lambda x: tuple(map(int, x.split('-')))
+        )[-1] for k, v in grid.items()
+    }))
@@ -0,0 +1,136 @@
+# Licensed under GPLv3
+"""Simulating the future balance from the bills and dues
+"""
+import math
+import random
+from .core import (
+    MemberCoverage, month_index, month_name, percentile, split_children)
+
+
+class ForecastModel(object):
+    """A simple model of the future cashflow, learnt from the ledger
+
+       Each "#bills:" tag is a monthly obligation with a mean and standard
+       deviation, and each member paying dues recently is a monthly income
+       that stops when the member churns.  simulate() runs many scenarios
+       at once: the state of every scenario is kept in flat lists that are
+       updated a whole month at a time, rather than by replaying rows.
+    """
+
+    def __init__(self, balance, month, bills, members, churn):
+        self.balance = balance      # the starting balance
+        self.month = month          # month_index() of the first month
+        self.bills = bills          # {tag: (mean, stdev)}
+        self.members = members      # {member: (monthly dues, paid until)}
+        self.churn = churn          # chance of a member leaving each month
+
+    @classmethod
+    def learn(cls, rows, recent=2, churn=None):
+        balance = 0
+        bills = {}
+        dues = {}
+        last = None
+        for row in rows:
+            balance = row + balance
+            month = month_index(row.date)
+            if last is None or month > last:
+                last = month
+            for child in split_children(row):
+                month = month_index(child.date)
+                member = MemberCoverage.member(child)
+                if member is not None:
+                    paid = dues.setdefault(member, {})
+                    paid[month] = paid.get(month, 0) + child.value
+                elif (child.direction == 'outgoing' and child.hashtag and
+                        child.hashtag.startswith('bills:')):
+                    paid = bills.setdefault(child.hashtag, {})
+                    paid[month] = paid.get(month, 0) - child.value
+
+        if last is None:
+            raise ValueError('No rows to learn a forecast from')
+
+        bill_stats = {}
+        for tag, paid in bills.items():
+            # months with no payment count as zero, from the first payment on
+            amounts = [float(paid.get(m, 0)) for m in range(min(paid),
+                                                            last + 1)]
+            mean = sum(amounts) / len(amounts)
+            var = sum((a - mean) ** 2 for a in amounts) / len(amounts)
+            bill_stats[tag] = (mean, math.sqrt(var))
+
+        members = {}
+        member_months = 0
+        lapsed = 0
+        for member, paid in dues.items():
+            member_months += len(paid)
+            if max(paid) <= last - recent:
+                lapsed += 1
+                continue
+            months = sorted(paid)[-6:]
+            fee = float(sum(paid[m] for m in months)) / len(months)
+            members[member] = (fee, max(paid))
+
+        if churn is None:
+            churn = float(lapsed) / member_months if member_months else 0.0
+
+        return cls(float(balance), last + 1, bill_stats, members, churn)
+
+    def simulate(self, months, scenarios, rng):
+        """return, for each month, the sorted list of scenario balances and
+           the fraction of scenarios that have gone negative by then
+        """
+        balances = [self.balance] * scenarios
+        negative = [False] * scenarios
+        active = dict((m, [True] * scenarios) for m in self.members)
+
+        results = []
+        for i in range(months):
+            flows = [0.0] * scenarios
+            for member, (fee, paid_until) in self.members.items():
+                alive = active[member] = [
+                    a and rng.random() >= self.churn for a in active[member]
+                ]
+                if self.month + i <= paid_until:
+                    # these months were paid for in advance
+                    continue
+                flows = [f + fee if a else f for f, a in zip(flows, alive)]
+            for tag, (mean, stdev) in self.bills.items():
+                flows = [f - max(0.0, rng.gauss(mean, stdev)) for f in flows]
+
+            balances = [b + f for b, f in zip(balances, flows)]
+            negative = [n or b < 0 for n, b in zip(negative, balances)]
+            results.append((sorted(balances),
+                            float(sum(negative)) / scenarios))
+        return results
+
+
+def subp_forecast(args):
+    model = ForecastModel.learn(args.rows, churn=args.churn)
+    rng = random.Random(args.seed)
+    results = model.simulate(args.months, args.scenarios, rng)
+
+    s = []
+    s.append("Starting balance: {:.0f}".format(model.balance))
+    s.append("Monthly bills: {:.0f}  Monthly dues: {:.0f} ({} members)".format(
+        sum(mean for mean, _ in model.bills.values()),
+        sum(fee for fee, _ in model.members.values()), len(model.members)))
+    s.append("Member churn per month: {:.1%}".format(model.churn))
+    s.append("")
+    s.append("Month      P(negative)      p10   median      p90")
+
+    runway = None
+    for i, (balances, negative) in enumerate(results):
+        month = month_name(model.month + i)
+        median = percentile(balances, 0.5)
+        if runway is None and median < 0:
+            runway = i
+        s.append("{}  {:>11.1%} {:>8.0f} {:>8.0f} {:>8.0f}".format(
+            month, negative,
+            percentile(balances, 0.1), median, percentile(balances, 0.9)))
+
+    s.append("")
+    if runway is None:
+        s.append("Runway: more than {} months".format(args.months))
+    else:
+        s.append("Runway: {} months".format(runway))
+    return "\n".join(s)
@@ -0,0 +1,201 @@
+# Licensed under GPLv3
+"""Replaying the ledger through its git history
+"""
+import decimal
+import os
+import subprocess
+from .core import (
+    apply_filter_strings, grid_accumulate, grid_render, ledger_ignored,
+    parse_lines)
+
+
+def git(dirname, *args):  # pragma: no cover
+    """Run a git command in the repository holding dirname
+    """
+    output = subprocess.check_output(('git', '-C', dirname) + args)
+    return output.decode('utf-8')
+
+
+def git_cat_blobs(dirname, blobs):  # pragma: no cover
+    """Fetch the contents of many blobs with a single git process
+    """
+    blobs = sorted(set(blobs))
+    if not blobs:
+        return {}
+
+    proc = subprocess.Popen(('git', '-C', dirname, 'cat-file', '--batch'),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output, _ = proc.communicate(''.join(b+'\n' for b in blobs).encode())
+    if proc.returncode:
+        raise RuntimeError('git cat-file failed')
+
+    contents = {}
+    pos = 0
+    for blob in blobs:
+        end = output.index(b'\n', pos)
+        header = output[pos:end].decode().split()
+        size = int(header[2])
+        contents[blob] = output[end+1:end+1+size].decode('utf-8')
+        pos = end + 1 + size + 1
+    return contents
+
+
+def parse_git_log(text):
+    """Parse the output of "git log --raw --no-abbrev --format='commit %H %ad'"
+       into a list of (commit, date, changes).  The changes are a list of
+       (filename, blob), where the blob is None for a deleted file
+    """
+    log = []
+    for line in text.splitlines():
+        if line.startswith('commit '):
+            _, commit, date = line.split(' ', 2)
+            log.append((commit, date, []))
+        elif line.startswith(':'):
+            meta, path = line.split('\t', 1)
+            fields = meta.split()
+            blob = fields[3]
+            if fields[4].startswith('D') or not blob.strip('0'):
+                blob = None
+            log[-1][2].append((os.path.basename(path), blob))
+    return log
+
+
+class ParsedBlobs(object):
+    """Parse the contents of ledger files, remembering the result for each
+       blob so that an unchanged file is only ever parsed once.  Only the
+       rows matching the filters are kept
+    """
+
+    def __init__(self, read_blob, split=False, filter_strings=None):
+        self.read_blob = read_blob
+        self.split = split
+        self.filter_strings = filter_strings
+        self.parsed = {}
+
+    def rows(self, filename, blob):
+        """return the rows in the blob, or None if it could not be parsed
+        """
+        if blob not in self.parsed:
+            self.parsed[blob] = self._parse(filename, blob)
+        return self.parsed[blob]
+
+    def _parse(self, filename, blob):
+        direction, _ = filename.split('-', 1)
+        try:
+            rows = list(parse_lines(self.read_blob(blob).splitlines(),
+                                    direction))
+        except (ValueError, TypeError, decimal.InvalidOperation):
+            # older revisions are not always clean, note it and carry on
+            return None
+
+        if self.split:
+            tmp = []
+            for row in rows:
+                tmp.extend(row.autosplit())
+            rows = tmp
+        return list(apply_filter_strings(self.filter_strings, rows))
+
+
+def history_replay(log, blobs):
+    """Replay the ledger changes in the log, yielding (commit, date, balance,
+       broken) for each commit, where broken is the list of files that could
+       not be parsed at that commit.  Only the changed files are looked at.
+    """
+    sums = {}
+    broken = set()
+    balance = 0
+    for commit, date, changes in log:
+        for filename, blob in changes:
+            if ledger_ignored(filename):
+                continue
+            balance -= sums.pop(filename, 0)
+            broken.discard(filename)
+            if blob is None:
+                continue
+
+            rows = blobs.rows(filename, blob)
+            if rows is None:
+                broken.add(filename)
+                continue
+            sums[filename] = sum(rows)
+            balance += sums[filename]
+
+        yield commit, date, balance, sorted(broken)
+
+
+def grid_diff(old, new):
+    """Compare two grid_accumulate() results, returning a result in the same
+       shape holding only the cells that changed and their difference
+    """
+    (_, _, grid_old, totals_old) = old
+    (_, _, grid_new, totals_new) = new
+
+    months = set()
+    tags = set()
+    grid = {}
+    totals = {'total': totals_new['total'] - totals_old['total']}
+    for tag in set(grid_old) | set(grid_new):
+        cells_old = grid_old.get(tag, {})
+        cells_new = grid_new.get(tag, {})
+        for month in set(cells_old) | set(cells_new):
+            value_old = cells_old.get(month, {'sum': 0})['sum']
+            value_new = cells_new.get(month, {'sum': 0})['sum']
+            if value_old == value_new:
+                continue
+            grid.setdefault(tag, {})[month] = {'sum': value_new - value_old}
+            months.add(month)
+            tags.add(tag)
+
+    for month in months:
+        totals[month] = totals_new.get(month, 0) - totals_old.get(month, 0)
+
+    return months, tags, grid, totals
+
+
+def subp_history(args):  # pragma: no cover
+    blobs = {}
+
+    def read_blob(blob):
+        if blob not in blobs:
+            blobs.update(git_cat_blobs(args.dir, [blob]))
+        return blobs[blob]
+
+    parsed = ParsedBlobs(read_blob, split=args.split,
+                         filter_strings=args.filter)
+
+    if args.diff:
+        result = []
+        for rev in args.diff:
+            listing = git(args.dir, 'ls-tree', rev, '--', '.')
+            files = []
+            for line in listing.splitlines():
+                meta, path = line.split('\t', 1)
+                filename = os.path.basename(path)
+                if not ledger_ignored(filename):
+                    files.append((filename, meta.split()[2]))
+            blobs.update(git_cat_blobs(args.dir, [b for _, b in files]))
+
+            rows = []
+            for filename, blob in files:
+                rows.extend(parsed.rows(filename, blob) or [])
+            result.append(grid_accumulate(rows))
+
+        (months, tags, grid, totals) = grid_diff(*result)
+        if not tags:
+            return 'No differences'
+        return grid_render(months, tags, grid, totals)
+
+    log = parse_git_log(git(args.dir, 'log', '--reverse', '--no-renames',
+                            '--raw', '--no-abbrev', '--date=short',
+                            '--format=commit %H %ad', '--', '.'))
+    blobs.update(git_cat_blobs(args.dir, [
+        blob for _, _, changes in log for _, blob in changes if blob
+    ]))
+
+    s = []
+    for commit, date, balance, broken in history_replay(log, parsed):
+        line = "{} {} {:>9}".format(commit[:8], date, balance)
+        if broken:
+            line += "  (unparsable: {})".format(' '.join(broken))
+        s.append(line)
+    return "\n".join(s)
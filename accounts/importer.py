@@ -0,0 +1,155 @@
+# Licensed under GPLv3
+"""Importing the transactions from CSV or TSV files into the cash files
+"""
+import csv
+import datetime
+import decimal
+import os
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # not available on all platforms, the file locking is advisory anyway
+    fcntl = None
+from .core import (
+    FILE_MONTH_SLACK, Row, month_index, month_name, parse_lines, row_filename,
+    row_format, row_key)
+
+
+def import_read(fileobj, delimiter=',', columns=None, date_format=None):
+    """Read a CSV export, yielding a Row for each record.  The columns are
+       found by the (case insensitive) header names.  Without a direction
+       column, negative values are outgoing
+    """
+    columns = dict({
+        'value': 'value',
+        'date': 'date',
+        'comment': 'comment',
+        'direction': 'direction',
+    }, **(columns or {}))
+
+    reader = csv.reader(fileobj, delimiter=delimiter)
+    header = [h.strip().lower() for h in next(reader)]
+    index = {}
+    for key, name in columns.items():
+        if name.lower() in header:
+            index[key] = header.index(name.lower())
+    for key in ('value', 'date', 'comment'):
+        if key not in index:
+            raise ValueError('No "{}" column found'.format(columns[key]))
+
+    for lineno, record in enumerate(reader, 2):
+        if not any(field.strip() for field in record):
+            continue
+        try:
+            value = record[index['value']].strip().replace(',', '')
+            date = record[index['date']].strip()
+            comment = ' '.join(record[index['comment']].split())
+
+            if 'direction' in index:
+                direction = record[index['direction']].strip().lower()
+            elif value.startswith('-'):
+                direction = 'outgoing'
+                value = value[1:]
+            else:
+                direction = 'incoming'
+
+            if date_format:
+                date = datetime.datetime.strptime(date, date_format)
+                date = date.date().isoformat()
+
+            yield Row(value, date, comment, direction)
+        except (ValueError, IndexError, decimal.InvalidOperation) as e:
+            raise ValueError('line {}: {}'.format(lineno, e))
+
+
+def import_route(rows):
+    """Group the new rows by the file they belong in, dropping any that are
+       repeated in the import
+    """
+    files = {}
+    seen = set()
+    for row in rows:
+        key = row_key(row)
+        if key in seen:
+            continue
+        seen.add(key)
+        files.setdefault(row_filename(row), []).append(row)
+    return files
+
+
+def import_neighbours(filename):
+    """return the names of the other cash files that rows belonging in this
+       one might have been recorded in (see FILE_MONTH_SLACK)
+    """
+    direction, _, month = filename.partition('-')
+    index = month_index(datetime.datetime.strptime(month, '%Y-%m'))
+    return ['{}-{}'.format(direction, month_name(index + offset))
+            for offset in range(-FILE_MONTH_SLACK, FILE_MONTH_SLACK + 1)
+            if offset]
+
+
+def import_append(dirname, filename, rows):   # pragma: no cover
+    """Append the rows to one cash file in a single locked write, skipping
+       any that are already recorded there, or in the neighbouring files.
+       Returns the rows added
+    """
+    direction, _ = filename.split('-', 1)
+    existing = set()
+    for neighbour in import_neighbours(filename):
+        path = os.path.join(dirname, neighbour)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            for row in parse_lines(f, direction):
+                existing.add(row_key(row))
+
+    with open(os.path.join(dirname, filename), 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            text = f.read()
+            for row in parse_lines(text.splitlines(), direction):
+                existing.add(row_key(row))
+
+            added = [row for row in rows if row_key(row) not in existing]
+            if added:
+                lines = ''.join(row_format(row) for row in added)
+                if text and not text.endswith('\n'):
+                    lines = '\n' + lines
+                f.write(lines)
+                f.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    return added
+
+
+def subp_import(args):  # pragma: no cover
+    rows = []
+    for filename in args.files:
+        delimiter = args.delimiter
+        if delimiter is None:
+            delimiter = '\t' if filename.endswith('.tsv') else ','
+        columns = {
+            'value': args.value_col,
+            'date': args.date_col,
+            'comment': args.comment_col,
+        }
+        with open(filename) as f:
+            try:
+                rows.extend(import_read(f, delimiter, columns,
+                                        args.date_format))
+            except ValueError as e:
+                raise ValueError('{}: {}'.format(filename, e))
+
+    s = []
+    for filename, new in sorted(import_route(rows).items()):
+        if args.dry_run:
+            for row in new:
+                s.append("{}: {}".format(filename, row_format(row).rstrip()))
+            continue
+        added = import_append(args.dir, filename, new)
+        s.append("{}: {} added, {} already present".format(
+            filename, len(added), len(new) - len(added)))
+    return "\n".join(s)
@@ -0,0 +1,112 @@
+# Licensed under GPLv3
+"""An index of the words and tags in the comments, for searching them
+"""
+import re
+import json
+from .cache import OutputCache, cache_key, ledger_hash
+from .core import apply_filter_strings, tag_ancestors
+
+
+class CommentIndex(object):
+    """An inverted index from the words and tags in the comments to the rows,
+       so a search takes time in proportion to the rows found and not to the
+       size of the ledger.  The words are case folded, and each tag (with
+       every tag above it) is also kept as a "#tag" token.
+    """
+
+    def __init__(self, rows, postings=None):
+        # a fixed order, so that the saved postings still refer to the same
+        # rows when the ledger is read again
+        self.rows = sorted(rows, key=lambda row: (
+            row.date, row.direction, row.comment, row.value, row.source or ''))
+        if postings is None:
+            postings = {}
+            for i, row in enumerate(self.rows):
+                for token in self.tokens(row.comment):
+                    postings.setdefault(token, []).append(i)
+        self.postings = postings
+        self.comments = set(row.comment for row in self.rows)
+
+    @staticmethod
+    def tokens(comment):
+        """return the set of tokens for a comment
+        """
+        comment = comment.lower()
+        tokens = set(re.findall(r'\w+', comment))
+        for tag in re.findall(r'#([a-z]\S*)', comment):
+            tokens.update('#' + t for t in tag_ancestors(tag))
+        return tokens
+
+    def search(self, terms, any_term=False):
+        """return the rows with all of the terms, or with any of them
+        """
+        found = sorted((self.postings.get(t.lower(), []) for t in terms),
+                       key=len)
+        if not found:
+            return []
+        ids = set(found[0])
+        for postings in found[1:]:
+            if any_term:
+                ids.update(postings)
+            else:
+                ids.intersection_update(postings)
+        return [self.rows[i] for i in sorted(ids)]
+
+    def comments_matching(self, word):
+        """return the set of comments that "comment=~word" would match, for
+           a plain word.  Only the vocabulary is searched, not every comment
+        """
+        word = word.lower()
+        comments = set()
+        for token, ids in self.postings.items():
+            # the words already include the parts of every tag
+            if word in token and not token.startswith('#'):
+                comments.update(self.rows[i].comment for i in ids)
+        return comments
+
+    def dumps(self):
+        return json.dumps({'count': len(self.rows), 'postings': self.postings},
+                          sort_keys=True)
+
+    @classmethod
+    def loads(cls, rows, text):
+        """return the index of the rows using the postings saved by dumps(),
+           or a new index if they do not fit the rows
+        """
+        data = json.loads(text)
+        rows = list(rows)
+        if data['count'] != len(rows):
+            return cls(rows)
+        return cls(rows, data['postings'])
+
+
+def comment_index(args, summaries, rows):   # pragma: no cover
+    """return the CommentIndex of the rows.  With --cache, it is saved with
+       the cached results, so it is only built once for each ledger
+    """
+    if not args.cache:
+        return CommentIndex(rows)
+
+    cache = OutputCache(args.cache_dir)
+    key = cache_key(ledger_hash(args.dir), 'index', {
+        'filter': args.filter,
+        'split': args.split or args.spans,
+        'closed': [summary['year'] for summary in summaries],
+    }, None)
+    text = cache.get(key)
+    if text is not None:
+        return CommentIndex.loads(rows, text)
+    index = CommentIndex(rows)
+    cache.put(key, index.dumps())
+    return index
+
+
+def subp_search(args):
+    rows = args.index.search(args.terms, args.any)
+    rows = apply_filter_strings(args.filter, rows, args.index)
+
+    s = []
+    for row in rows:
+        s.append("{:<24}{:>8}  {}  {}".format(
+            row.source or '-', row.value, row.date, row.comment))
+    return "\n".join(s)
@@ -0,0 +1,116 @@
+# Licensed under GPLv3
+"""A directory of cash files, for use by other python code
+"""
+import os
+import threading
+from .core import (
+    MemberCoverage, autosplit_rows, grid_accumulate_directions, ledger_ignored,
+    parse_dir)
+from .topay import obligation_record, topay_accumulate, topay_table
+
+
+class Ledger(object):
+    """A directory of cash files, for use by other python code
+
+       Each of the views is only worked out the first time it is used, and
+       then kept until the files in the directory change.  The size and
+       modification time of the files is checked each time a view is used,
+       so a change is noticed without needing to re-read the files.
+
+       One Ledger can be shared between threads.  The views are shared as
+       well, so they must not be modified.
+
+       The schedule of recurring bills is as from obligations_read(), or
+       None to learn them from the payments, as for "topay".
+    """
+
+    def __init__(self, dirname, schedule=None):
+        self.dirname = dirname
+        self.schedule = schedule
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._views = {}
+
+    def stamp(self):
+        """return a fingerprint that changes when any file is changed
+        """
+        stamp = []
+        for filename in sorted(os.listdir(self.dirname)):
+            if ledger_ignored(filename):
+                continue
+            st = os.stat(os.path.join(self.dirname, filename))
+            stamp.append((filename, st.st_size, st.st_mtime))
+        return tuple(stamp)
+
+    def _view(self, name, func):
+        with self._lock:
+            stamp = self.stamp()
+            if stamp != self._stamp:
+                self._views = {}
+                self._stamp = stamp
+            if name not in self._views:
+                self._views[name] = func()
+            return self._views[name]
+
+    @property
+    def rows(self):
+        """All the rows, as recorded"""
+        return self._view('rows', lambda: tuple(parse_dir(self.dirname)))
+
+    @property
+    def split_rows(self):
+        """All the rows, with the "!months" rows split into their children"""
+        return self._view('split_rows',
+                          lambda: tuple(autosplit_rows(self.rows)))
+
+    @property
+    def total(self):
+        """The balance of all the rows"""
+        return self._view('total', lambda: sum(self.rows))
+
+    @property
+    def grid(self):
+        """The (months, tags, grid, totals) of the split rows, as used by the
+           "grid" subcommand
+        """
+        return self._view('grid',
+                          lambda: grid_accumulate_directions(self.split_rows))
+
+    @property
+    def topay(self):
+        """The (months, tags, grid, totals) of the outgoing split rows, as
+           used by the "topay" subcommand
+        """
+        return self._view('topay', lambda: topay_accumulate(self.split_rows))
+
+    @property
+    def payments(self):
+        """The (date, amount) of each outgoing bills payment, by hashtag"""
+        def _payments():
+            payments = {}
+            for row in self.split_rows:
+                obligation_record(row, payments)
+            return payments
+        return self._view('payments', _payments)
+
+    def topay_table(self, today=None):
+        """return the (month, bills) of the topay view, with the overdue and
+           under-paid bills flagged, as shown by the "topay" subcommand
+        """
+        with self._lock:
+            return list(topay_table(self.topay, self.payments,
+                                    schedule=self.schedule, today=today))
+
+    @property
+    def last_payments(self):
+        """The most recent dues row for each member"""
+        def _last_payments():
+            last = {}
+            for row in self.rows:
+                member = MemberCoverage.member(row)
+                if member is None:
+                    continue
+                if member not in last or row.date > last[member].date:
+                    last[member] = row
+            return last
+        return self._view('last_payments', _last_payments)
@@ -0,0 +1,208 @@
+# Licensed under GPLv3
+"""An sqlite copy of the rows, for ad hoc queries
+"""
+import datetime
+import sys
+import os
+import re
+import hashlib
+import sqlite3
+from .core import (
+    filter_parse, ledger_ignored, parse_lines, rel_months, split_children)
+
+
+# The SQL for each field that filters can use in the sqlite mirror
+SQL_FIELDS = {
+    'value': 'value',
+    'date': 'date',
+    'month': 'month',
+    'direction': 'direction',
+    'hashtag': 'hashtag',
+    'comment': 'comment',
+    'rel_months': 'rel_months(date)',
+}
+
+SQL_OPS = {
+    '==': '=',
+    '!=': '!=',
+    '>': '>',
+    '<': '<',
+    '>=': '>=',
+    '<=': '<=',
+}
+
+
+def filter_to_sql(string):
+    """Translate a human readable filter into an SQL expression and its
+       parameters, for use against the sqlite mirror
+    """
+    (field, op, value) = filter_parse(string)
+    if field not in SQL_FIELDS:
+        raise ValueError('Field "{}" is not in the sqlite mirror'.format(
+            field))
+    column = SQL_FIELDS[field]
+
+    if field == 'hashtag' and value == 'None' and op in ('==', '!='):
+        # rows without a hashtag compare as the string "None"
+        return 'hashtag IS {}NULL'.format('NOT ' if op == '!=' else ''), []
+    if field == 'hashtag':
+        column = "COALESCE(hashtag, 'None')"
+
+    if op == '=~':
+        return 'regexp(?, {})'.format(column), [value]
+    if op not in SQL_OPS:
+        raise ValueError('Unknown filter operation "{}"'.format(op))
+    return '{} {} ?'.format(column, SQL_OPS[op]), [value]
+
+
+class LedgerMirror(object):
+    """An sqlite copy of the parsed rows, for ad hoc queries
+
+       Each source file is stored with a fingerprint of its contents, so
+       that a sync only re-parses the files that have changed.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS files (
+            name TEXT PRIMARY KEY,
+            fingerprint TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS rows (
+            file TEXT,
+            value NUMERIC,
+            value_text TEXT,
+            date TEXT,
+            month TEXT,
+            direction TEXT,
+            hashtag TEXT,
+            comment TEXT
+        )""",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+        "CREATE INDEX IF NOT EXISTS rows_file ON rows (file)",
+        "CREATE INDEX IF NOT EXISTS rows_date ON rows (date)",
+        "CREATE INDEX IF NOT EXISTS rows_month ON rows (month)",
+        "CREATE INDEX IF NOT EXISTS rows_direction ON rows (direction)",
+        "CREATE INDEX IF NOT EXISTS rows_hashtag ON rows (hashtag)",
+    )
+
+    def __init__(self, filename, split=False):
+        self.db = sqlite3.connect(filename)
+        if sys.version_info[0] == 2:  # pragma: no cover
+            # the rows hold utf-8 encoded str, keep them that way
+            self.db.text_factory = str
+        self.db.create_function('regexp', 2, self._regexp)
+        self.db.create_function('rel_months', 1, self._rel_months)
+        for sql in self.schema:
+            self.db.execute(sql)
+
+        # a change of split mode means every file needs reloading
+        mode = 'split' if split else 'rows'
+        self.split = split
+        cur = self.db.execute("SELECT value FROM meta WHERE key='mode'")
+        old = cur.fetchone()
+        if old is None or old[0] != mode:
+            with self.db:
+                self.db.execute("DELETE FROM files")
+                self.db.execute("DELETE FROM rows")
+                self.db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('mode', ?)", (mode,))
+
+    @staticmethod
+    def _regexp(pattern, value):
+        return value is not None and bool(re.search(pattern, value, re.I))
+
+    @staticmethod
+    def _rel_months(date):
+        date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+        return rel_months(date)
+
+    @staticmethod
+    def fingerprint(data):
+        return hashlib.sha1(data).hexdigest()
+
+    def files(self):
+        """return a dict of the file names and fingerprints in the mirror
+        """
+        return dict(self.db.execute("SELECT name, fingerprint FROM files"))
+
+    def update_file(self, name, data):
+        """Replace the rows from one source file.  The caller is expected
+           to check the fingerprint first and to commit
+        """
+        text = data
+        if not isinstance(text, str):
+            # python 3 rows need the text, on python 2 the bytes are a str
+            text = text.decode('utf-8')
+
+        direction, _ = name.split('-', 1)
+        rows = parse_lines(text.splitlines(), direction)
+        if self.split:
+            rows = (child for row in rows for child in split_children(row))
+
+        self.db.execute("DELETE FROM rows WHERE file = ?", (name,))
+        self.db.executemany(
+            "INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((name, str(row.value), str(row.value), row.date.isoformat(),
+              row.month, row.direction, row.hashtag, row.comment)
+             for row in rows))
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?)",
+                        (name, self.fingerprint(data)))
+
+    def remove_file(self, name):
+        self.db.execute("DELETE FROM rows WHERE file = ?", (name,))
+        self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def sync(self, sources):
+        """Bring the mirror up to date with a dict of source file names and
+           their contents as bytes, returning the names that were (re)loaded
+           or removed
+        """
+        known = self.files()
+        changed = []
+        with self.db:
+            for name in sorted(set(known) - set(sources)):
+                self.remove_file(name)
+                changed.append(name)
+            for name, data in sorted(sources.items()):
+                if known.get(name) == self.fingerprint(data):
+                    continue
+                self.update_file(name, data)
+                changed.append(name)
+        return changed
+
+    def query(self, filter_strings=None):
+        """return the (value, date, comment) of the rows matching the
+           filters, in date order
+        """
+        where = []
+        params = []
+        for string in filter_strings or []:
+            (sql, values) = filter_to_sql(string)
+            where.append(sql)
+            params.extend(values)
+
+        sql = "SELECT value_text, date, comment FROM rows"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY date, file, rowid"
+        return self.db.execute(sql, params).fetchall()
+
+
+def subp_sqlite(args):  # pragma: no cover
+    mirror = LedgerMirror(args.db, split=args.split)
+
+    sources = {}
+    for filename in os.listdir(args.dir):
+        if ledger_ignored(filename):
+            continue
+        with open(os.path.join(args.dir, filename), 'rb') as f:
+            sources[filename] = f.read()
+    changed = mirror.sync(sources)
+    sys.stderr.write("Synced {} of {} files\n".format(len(changed),
+                                                      len(sources)))
+
+    if args.sql:
+        rows = mirror.db.execute(args.sql).fetchall()
+    else:
+        rows = mirror.query(args.filter)
+    return "\n".join("\t".join(str(f) for f in row) for row in rows)
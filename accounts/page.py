@@ -0,0 +1,190 @@
+# Licensed under GPLv3
+"""The HTML balance page
+"""
+import calendar
+import datetime
+import os
+import re
+from .core import (
+    ROOT_DIR, TEMPLATE_FILE, GridAccumulator, RowSpan, filter_compare,
+    filter_parse, grid_render_colheader, grid_render_datagroom,
+    grid_render_rows, writes_output)
+from .seal import seal_check
+
+
+class QueryPlan(object):
+    """Evaluate several aggregate queries over the rows in one scan
+
+       Each query is registered with its list of filter strings.  The
+       filters are only parsed once and, for each row, every field value and
+       every filter result is computed once and shared by all the queries
+       that ask for it.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.parsed = {}
+
+    def _register(self, query, filter_strings):
+        query.filters = list(filter_strings or [])
+        for string in query.filters:
+            if string not in self.parsed:
+                self.parsed[string] = filter_parse(string)
+        self.queries.append(query)
+        return query
+
+    def grid(self, filter_strings=None, tag=None):
+        """A grid_accumulate() of the matching rows.  The optional tag
+           function returns the hashtag to file each row under
+        """
+        return self._register(GridQuery(tag), filter_strings)
+
+    def max(self, field, filter_strings=None):
+        """The largest value of the field in the matching rows
+        """
+        return self._register(MaxQuery(field), filter_strings)
+
+    def total(self, filter_strings=None):
+        """The sum of the matching rows
+        """
+        return self._register(TotalQuery(), filter_strings)
+
+    def _match(self, row, query, values, matched):
+        for string in query.filters:
+            if string not in matched:
+                (field, op, value_match) = self.parsed[string]
+                if field not in values:
+                    values[field] = row._getvalue(field)
+                matched[string] = filter_compare(op, values[field],
+                                                 value_match)
+            if not matched[string]:
+                return False
+        return True
+
+    def run(self, rows):
+        for row in rows:
+            if isinstance(row, RowSpan):
+                # spans can narrow while filtering, so cannot share results
+                for query in self.queries:
+                    match = row
+                    for string in query.filters:
+                        match = match.filter(string)
+                        if match is None:
+                            break
+                    if match is not None:
+                        query.add(match)
+                continue
+
+            values = {}
+            matched = {}
+            for query in self.queries:
+                if self._match(row, query, values, matched):
+                    query.add(row)
+
+
+class GridQuery(object):
+    def __init__(self, tag=None):
+        self.tag = tag
+        self.accumulator = GridAccumulator()
+
+    def add(self, row):
+        tag = None
+        if self.tag is not None:
+            tag = self.tag(row)
+        self.accumulator.add(row, tag)
+
+    @property
+    def result(self):
+        return self.accumulator.result()
+
+
+class MaxQuery(object):
+    def __init__(self, field):
+        self.field = field
+        self.result = None
+
+    def add(self, row):
+        value = getattr(row, self.field)
+        if self.result is None or value > self.result:
+            self.result = value
+
+
+class TotalQuery(object):
+    def __init__(self):
+        self.result = 0
+
+    def add(self, row):
+        self.result = row + self.result
+
+
+def template_write(f, tpl, values):
+    """Poor mans template engine, writing the template with each "{key}"
+       replaced by its value
+    """
+    pattern = r'\{(' + '|'.join(re.escape(k) for k in values) + r')\}'
+    for i, part in enumerate(re.split(pattern, tpl)):
+        f.write(values[part] if i % 2 else part)
+
+
+@writes_output
+def subp_make_balance(args, out):
+    with open(os.path.join(ROOT_DIR, TEMPLATE_FILE)) as f:
+        tpl = f.read()
+
+    def _dues_tag(row):
+        # Make the category look pretty
+        return ''.join(row.hashtag.split(':')[1:]).title()
+
+    # Everything needed for the page is collected in one pass over the rows
+    plan = QueryPlan()
+    # Filter out only the membership dues
+    dues = plan.grid([
+        'direction==incoming',
+        'hashtag=~^dues:',
+        'rel_months>-5',
+        'rel_months<5',
+    ], tag=_dues_tag)
+    rent = plan.max('date', [
+        'direction==outgoing',
+        'hashtag=~^bills:rent',
+    ])
+    balance = plan.total()
+    plan.run(args.rows)
+
+    (months, tags, grid, totals) = dues.result
+    (months, tags, months_len, tags_len) = grid_render_datagroom(months, tags)
+
+    header = ''.join(grid_render_colheader(months, months_len, tags_len))
+    grid = ''.join(grid_render_rows(months, tags, grid, months_len, tags_len))
+
+    def _get_next_rent_month():
+        last_rent_payment = rent.result
+        if last_rent_payment is None:
+            raise ValueError('No rent payments found')
+
+        day = calendar.monthrange(last_rent_payment.year,
+                                  last_rent_payment.month)[1]
+        next_month = datetime.datetime(
+            last_rent_payment.year,
+            last_rent_payment.month,
+            day) + datetime.timedelta(days=1)
+        s = ' '.join((next_month.strftime('%B'), str(next_month.year))).upper()
+        return s
+
+    def _seal_root():
+        check = seal_check(args.dir)
+        if check is None:
+            return 'not sealed'
+        (seal, changed, added, removed, root) = check
+        if root != seal['root']:
+            return '{} (changed since sealed)'.format(root)
+        return root
+
+    template_write(out, tpl, {
+        'balance_sum': str(balance.result),
+        'grid_header': header,
+        'grid': grid,
+        'rent_due': _get_next_rent_month(),
+        'seal_root': _seal_root(),
+    })
+    out.write("\n")
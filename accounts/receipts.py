@@ -0,0 +1,146 @@
+# Licensed under GPLv3
+"""Matching the bill payments to the receipts in the bills dir
+"""
+from collections import namedtuple
+import datetime
+import os
+import re
+from .core import apply_filter_strings, tag_parts
+
+
+# Words in receipt filenames that say nothing about what was paid for
+RECEIPT_STOPWORDS = ('paid', 'payment', 'for', 'dsl', 'receipt')
+# Receipt filename words that are spelt differently in the hashtags
+RECEIPT_ALIASES = {
+    'rental': 'rent',
+    'pccw': 'internet',
+    'electric': 'electricity',
+    'business': 'br',
+    'reg': 'br',
+}
+
+
+class Receipt(namedtuple('Receipt', ('date', 'keywords', 'filename',
+                                     'slack'))):
+    """A scanned bill or receipt, from a filename like
+       "2016-08-26_electricity.jpg".  When the day is not known
+       ("2017-05-xx_dsl-rent.jpg") the date is the middle of the month and
+       the slack gives the number of days it could be out by
+    """
+
+    @classmethod
+    def from_filename(cls, filename):
+        m = re.match(r'(\d{4})-(\d{2})-(\d{2}|xx)_(.*?)(\.\w+)?$', filename)
+        if not m:
+            return None
+
+        slack = 0
+        day = m.group(3)
+        if day == 'xx':
+            day = 15
+            slack = 16
+        date = datetime.date(int(m.group(1)), int(m.group(2)), int(day))
+
+        keywords = []
+        for word in re.split(r'[\W_]+', m.group(4).lower()):
+            if not word or word in RECEIPT_STOPWORDS:
+                continue
+            word = RECEIPT_ALIASES.get(word, word)
+            if word not in keywords:
+                keywords.append(word)
+
+        return cls(date, tuple(keywords), filename, slack)
+
+
+def receipt_keyword(row):
+    """return the word that receipts for this row would be named with
+    """
+    if row.hashtag is None:
+        return None
+    return tag_parts(row.hashtag)[-1].lower()
+
+
+def receipts_match(rows, receipts, window):
+    """Link each receipt to the nearest row with the same keyword that is
+       within the window of days.
+
+       Everything is sorted by (keyword, date) once, then a forward sweep
+       finds the row before each receipt and a backward sweep the row after.
+       Returns a dict of row index to list of receipts, the list of rows
+       with no receipts and the list of receipts with no row.
+    """
+    events = []
+    for i, row in enumerate(rows):
+        keyword = receipt_keyword(row)
+        if keyword is not None:
+            events.append((keyword, row.date, 0, i))
+    for j, receipt in enumerate(receipts):
+        for keyword in receipt.keywords:
+            events.append((keyword, receipt.date, 1, j))
+    events.sort()
+
+    # best[j] = (distance, row index) of the nearest row for receipt j
+    best = {}
+
+    def sweep(events):
+        keyword = None
+        near = None
+        for event_keyword, date, kind, index in events:
+            if event_keyword != keyword:
+                keyword = event_keyword
+                near = None
+            if kind == 0:
+                near = (date, index)
+                continue
+            if near is None:
+                continue
+            distance = abs((date - near[0]).days)
+            if distance > window + receipts[index].slack:
+                continue
+            if index not in best or distance < best[index][0]:
+                best[index] = (distance, near[1])
+
+    sweep(events)
+    sweep(reversed(events))
+
+    matches = {}
+    for j, (_, i) in sorted(best.items()):
+        matches.setdefault(i, []).append(receipts[j])
+
+    unreceipted = [row for i, row in enumerate(rows) if i not in matches]
+    orphans = [r for j, r in enumerate(receipts) if j not in best]
+
+    return matches, unreceipted, orphans
+
+
+def subp_receipts(args):
+    rows = sorted(apply_filter_strings([
+        'direction==outgoing',
+        'hashtag=~^bills:',
+    ], args.rows), key=lambda x: x.date)
+
+    receipts = []
+    for filename in os.listdir(args.bills):
+        receipt = Receipt.from_filename(filename)
+        if receipt is not None:
+            receipts.append(receipt)
+    receipts.sort()
+
+    (matches, unreceipted, orphans) = receipts_match(rows, receipts,
+                                                     args.window)
+
+    s = []
+    for i, row in enumerate(rows):
+        if i in matches:
+            s.append("{}\t{}\t{:<23}\t{}".format(
+                row.date, row.value, row.hashtag,
+                ' '.join(r.filename for r in matches[i])))
+    s.append("")
+    s.append("Unreceipted payments:")
+    for row in unreceipted:
+        s.append("{}\t{}\t{}".format(row.date, row.value, row.hashtag))
+    s.append("")
+    s.append("Orphan receipts:")
+    for receipt in orphans:
+        s.append(receipt.filename)
+    return "\n".join(s)
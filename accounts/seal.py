@@ -0,0 +1,198 @@
+# Licensed under GPLv3
+"""A hash tree over the cash files, to find the files changed since
+"""
+import os
+import re
+import json
+import hashlib
+from .core import SEAL_FILE, parse_lines
+
+
+def merkle_leaf(name, data):
+    """return the hash of one cash file, for the leaves of the seal
+    """
+    h = hashlib.sha256(b'\0')
+    h.update(name.encode('utf-8') + b'\0')
+    h.update(data)
+    return h.hexdigest()
+
+
+def merkle_node(left, right):
+    """return the hash of an inner node of the seal
+    """
+    return hashlib.sha256(b'\1' + (left + right).encode('utf-8')).hexdigest()
+
+
+def merkle_tree(leaves):
+    """return the list of levels of the tree over the leaf hashes, from the
+       leaves up to the root.  An odd node at the end of a level is carried
+       up to the next level as it is
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([
+            merkle_node(level[i], level[i + 1]) if i + 1 < len(level)
+            else level[i]
+            for i in range(0, len(level), 2)
+        ])
+    return levels
+
+
+def merkle_update(levels, index, leaf):
+    """Replace one leaf of the tree, rehashing just the path to the root
+    """
+    levels[0][index] = leaf
+    for depth in range(1, len(levels)):
+        below = levels[depth - 1]
+        left = index & ~1
+        if left + 1 < len(below):
+            node = merkle_node(below[left], below[left + 1])
+        else:
+            node = below[left]
+        index //= 2
+        levels[depth][index] = node
+
+
+def seal_files(dirname):
+    """return the names of the cash files to seal, in direction and month
+       order
+    """
+    pattern = re.compile(r'^(incoming|outgoing)-\d{4}-\d\d$')
+    return sorted(f for f in os.listdir(dirname) if pattern.match(f))
+
+
+def seal_stats(dirname, files):   # pragma: no cover
+    """return {filename: [size, mtime]} for the files
+    """
+    stats = {}
+    for filename in files:
+        st = os.stat(os.path.join(dirname, filename))
+        stats[filename] = [st.st_size, st.st_mtime]
+    return stats
+
+
+def seal_hash(dirname, filename):   # pragma: no cover
+    """return the leaf hash and the subtotal of one cash file
+    """
+    with open(os.path.join(dirname, filename), 'rb') as f:
+        data = f.read()
+    direction = filename.split('-', 1)[0]
+    rows = parse_lines(data.decode('utf-8').splitlines(), direction)
+    return (merkle_leaf(filename, data), str(sum(rows)))
+
+
+def seal_build(files, stats, rehash):
+    """return the seal of the files, with the hash and subtotal of each from
+       rehash(filename)
+    """
+    entries = []
+    for filename in files:
+        (leaf, subtotal) = rehash(filename)
+        entries.append([filename] + stats[filename] + [leaf, subtotal])
+    levels = merkle_tree(entry[3] for entry in entries)
+    return {
+        'root': levels[-1][0] if entries else None,
+        'files': entries,
+        'tree': levels,
+    }
+
+
+def seal_verify(seal, files, stats, rehash):
+    """Check the files against the seal, only rehashing the files whose size
+       or mtime has changed.  Return (changed, added, removed, root) where
+       changed is a list of (filename, sealed subtotal, new subtotal) for the
+       files with different contents, and root is the root of the tree over
+       the files as they are now
+    """
+    sealed = dict((entry[0], i) for (i, entry) in enumerate(seal['files']))
+    levels = [list(level) for level in seal['tree']]
+    changed = []
+    added = [f for f in files if f not in sealed]
+    removed = sorted(f for f in sealed if f not in stats)
+
+    leaves = {}
+    for filename in files:
+        if filename not in sealed:
+            continue
+        entry = seal['files'][sealed[filename]]
+        if stats[filename] == entry[1:3]:
+            continue
+        (leaf, subtotal) = rehash(filename)
+        if leaf == entry[3]:
+            continue
+        changed.append((filename, entry[4], subtotal))
+        leaves[filename] = leaf
+        if not added and not removed:
+            merkle_update(levels, sealed[filename], leaf)
+
+    if added or removed:
+        # the shape of the tree has changed, so it is built again, but only
+        # the new files need to be read
+        for filename in added:
+            leaves[filename] = rehash(filename)[0]
+        levels = merkle_tree(
+            leaves.get(f) or seal['files'][sealed[f]][3] for f in files)
+
+    root = levels[-1][0] if levels[0] else None
+    return (changed, added, removed, root)
+
+
+def seal_write(dirname, seal):   # pragma: no cover
+    with open(os.path.join(dirname, SEAL_FILE), 'w') as f:
+        json.dump(seal, f, sort_keys=True)
+        f.write('\n')
+
+
+def seal_load(dirname):   # pragma: no cover
+    """return the seal saved in the cash dir, or None
+    """
+    filename = os.path.join(dirname, SEAL_FILE)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def seal_check(dirname):   # pragma: no cover
+    """return the results of seal_verify() for the cash dir, or None if it
+       has not been sealed
+    """
+    seal = seal_load(dirname)
+    if seal is None:
+        return None
+    files = seal_files(dirname)
+    return (seal,) + seal_verify(seal, files, seal_stats(dirname, files),
+                                 lambda f: seal_hash(dirname, f))
+
+
+def subp_seal(args):  # pragma: no cover
+    files = seal_files(args.dir)
+    if not files:
+        raise ValueError('No cash files found to seal')
+    seal = seal_build(files, seal_stats(args.dir, files),
+                      lambda f: seal_hash(args.dir, f))
+    seal_write(args.dir, seal)
+    return "Sealed {} files, root {}".format(len(files), seal['root'])
+
+
+def subp_verify(args):  # pragma: no cover
+    check = seal_check(args.dir)
+    if check is None:
+        raise ValueError('The cash files have not been sealed')
+    (seal, changed, added, removed, root) = check
+
+    s = []
+    for (filename, before, after) in changed:
+        s.append("{}: changed, subtotal {} -> {}".format(
+            filename, before, after))
+    for filename in added:
+        s.append("{}: added".format(filename))
+    for filename in removed:
+        s.append("{}: removed".format(filename))
+    if root == seal['root']:
+        s.append("Verified {}".format(root))
+    else:
+        s.append("Sealed {}".format(seal['root']))
+        s.append("Now    {}".format(root))
+    return "\n".join(s)
@@ -0,0 +1,142 @@
+# Licensed under GPLv3
+"""The sum, party, grid and coverage reports
+"""
+import datetime
+import re
+from .core import (
+    MemberCoverage, cube_accumulate, direction_tag, grid_accumulate_directions,
+    grid_write, tag_ancestors, tag_parts, writes_output)
+
+
+def grid_tree(tags, grid):
+    """Roll the grid up the tag tree, returning the tags and grid for every
+       node in the tree.  Each node sums all the tags below it, the cells of
+       each tag are added into all of its ancestors in one pass
+    """
+    tree = {}
+    for tag in tags:
+        for node in tag_ancestors(tag):
+            cells = tree.setdefault(node, {})
+            for month, cell in grid[tag].items():
+                if month not in cells:
+                    cells[month] = {
+                        'sum': 0,
+                        'last': datetime.date(1970, 1, 1),
+                    }
+                cells[month]['sum'] += cell['sum']
+                cells[month]['last'] = max(cell['last'],
+                                           cells[month]['last'])
+    return set(tree), tree
+
+
+def tag_undirected(tag):
+    """return the tag without any direction prefix from direction_tag()
+    """
+    return re.sub(r'^(in|out) ', '', tag, flags=re.I)
+
+
+def grid_tree_select(tags, nodes, depth, drill=()):
+    """return the nodes of the tag tree to show when collapsed to the given
+       depth.  The tags shallower than the depth are shown as they are, and
+       all the tags below any drilled node are shown as well.  The drilled
+       nodes can be named with or without their direction prefix
+    """
+    drill = set(d.lower() for d in drill)
+    found = set()
+    selected = set()
+    for node in nodes:
+        names = set([node.lower(), tag_undirected(node.lower())])
+        found.update(drill & names)
+
+        level = len(tag_parts(node))
+        if level == depth or (level < depth and node in tags):
+            selected.add(node)
+        elif node in tags and level > depth:
+            ancestors = tag_ancestors(node.lower())[:-1]
+            ancestors += [tag_undirected(a) for a in ancestors]
+            if drill.intersection(ancestors):
+                selected.add(node)
+
+    if drill - found:
+        raise ValueError('No tag to drill into: {}'.format(
+            ', '.join(sorted(drill - found))))
+    return selected
+
+
+def grid_tree_cells(grid, tree, selected, depth):
+    """return the cells for the selected nodes.  A node at the depth is the
+       subtotal of all the tags below it.  Any other node is a tag that is
+       shown along with the tags below it, so only its own cells are used
+    """
+    return dict(
+        (node, tree[node] if len(tag_parts(node)) == depth else grid[node])
+        for node in selected)
+
+
+#
+# This section contains the implementation of the commandline
+# sub-commands.  Ideally, they are all small and simple, implemented with
+# calls to the above functions.  This should allow clearer understanding
+# of the intent of each sub-command
+#
+
+
+def subp_sum(args):
+    if args.period is not None:
+        (periods, tags, grid, totals) = cube_accumulate(args.rows, args.period)
+        result = totals['total']
+    else:
+        result = sum(args.rows)
+    if result < 0:
+        raise ValueError(
+            "Impossible negative value cash balance: {}".format(result))
+
+    if args.period is not None:
+        s = ["{}\t{}".format(p, totals[p]) for p in sorted(periods)]
+        s.append("Total\t{}".format(result))
+        return "\n".join(s)
+    return "{}".format(result)
+
+
+def subp_party(args):
+    balance = sum(args.rows)
+    return "Success" if balance > 0 else "Fail"
+
+
+@writes_output
+def subp_grid(args, out):
+    if args.period is not None:
+        (months, tags, grid, totals) = cube_accumulate(args.rows, args.period,
+                                                       direction_tag)
+    else:
+        (months, tags, grid, totals) = grid_accumulate_directions(args.rows)
+    if args.depth is not None:
+        (nodes, tree) = grid_tree(tags, grid)
+        selected = grid_tree_select(tags, nodes, args.depth, args.drill)
+        grid = grid_tree_cells(grid, tree, selected, args.depth)
+        tags = selected
+    grid_write(out, months, tags, grid, totals)
+    out.write("\n")
+
+
+def subp_coverage(args):
+    coverage = MemberCoverage(args.rows)
+
+    if args.member:
+        member = args.member.lower()
+        s = []
+        for start, end in coverage.intervals.get(member, []):
+            s.append((start, 'covered', end))
+        for start, end in coverage.gaps(member):
+            s.append((start, 'gap', end))
+        return "\n".join(
+            "{}\t{}\t{}".format(kind, start, end)
+            for start, kind, end in sorted(s)
+        )
+
+    if args.date:
+        date = datetime.datetime.strptime(args.date, "%Y-%m-%d").date()
+    else:
+        date = datetime.datetime.utcnow().date()
+
+    return "\n".join(sorted(coverage.covered_on(date)))
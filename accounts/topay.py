@@ -0,0 +1,259 @@
+# Licensed under GPLv3
+"""The pending payments, and the recurring bills that are overdue
+"""
+from collections import namedtuple
+import calendar
+import datetime
+import decimal
+from .core import (
+    GridAccumulator, RowSpan, StringSink, apply_filter_strings,
+    cube_accumulate, grid_accumulate, month_index, month_name, percentile,
+    writes_output)
+
+
+# Recurring bills are tagged under this prefix, eg "#bills:rent"
+OBLIGATION_PREFIX = 'bills:'
+
+# A learnt amount is only checked if most months paid were within this
+# fraction of it, otherwise the bill is taken to vary (eg electricity)
+OBLIGATION_TOLERANCE = decimal.Decimal('0.1')
+
+# How a flagged bill is shown in the "Pay Date" column of topay
+TOPAY_FLAG = '{date} ({status})'
+
+# How often a recurring bill is due, how much (or None if it varies) and on
+# which day of the month
+Obligation = namedtuple('Obligation', ('tag', 'months', 'amount', 'day'))
+
+
+def topay_accumulate(rows, period=None):
+    """Accumulate the outgoing rows into month+tag buckets, or the buckets
+       for another period
+    """
+    rows = apply_filter_strings(['direction==outgoing'], rows)
+    if period is not None:
+        return cube_accumulate(rows, period)
+    return grid_accumulate(rows)
+
+
+def obligations_read(lines):
+    """Read a schedule of recurring bills, one per line as:
+           tag months amount day
+       where the amount can be "-" if it varies
+    """
+    schedule = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) != 4:
+            raise ValueError('bad schedule line: {}'.format(line))
+        (tag, months, amount, day) = fields
+        amount = None if amount == '-' else abs(decimal.Decimal(amount))
+        tag = tag.capitalize()
+        schedule[tag] = Obligation(tag, int(months), amount, int(day))
+    return schedule
+
+
+def obligations_schedule(args):
+    """return the schedule of bills given on the command line, if any
+    """
+    if args.schedule is None:
+        return None
+    with open(args.schedule) as f:  # pragma: no cover
+        return obligations_read(f)
+
+
+def obligation_record(row, payments):
+    """If the row is an outgoing bills payment, add its (date, amount) to
+       payments, by hashtag
+    """
+    if (row.direction == 'outgoing' and row.hashtag is not None and
+            row.hashtag.lower().startswith(OBLIGATION_PREFIX)):
+        children = row.expand() if isinstance(row, RowSpan) else [row]
+        payments.setdefault(GridAccumulator.tag(row), []).extend(
+            (child.date, abs(child.value)) for child in children)
+
+
+def obligation_payments(rows, payments):
+    """Pass the rows through unchanged, while collecting the (date, amount)
+       of every outgoing bills payment into payments, by hashtag
+    """
+    for row in rows:
+        obligation_record(row, payments)
+        yield row
+
+
+def obligation_learn(tag, payments):
+    """return the Obligation inferred from the sorted (date, amount) payments
+       for one tag, or None if there are too few to show a pattern
+    """
+    paid = {}
+    days = []
+    for (date, amount) in payments:
+        index = month_index(date)
+        if index not in paid:
+            paid[index] = 0
+            days.append(date.day)
+        paid[index] += amount
+    if len(paid) < 2:
+        return None
+
+    indexes = sorted(paid)
+    gaps = sorted(b - a for (a, b) in zip(indexes, indexes[1:]))
+    amounts = sorted(paid.values())
+    amount = percentile(amounts, 0.5)
+    usual = [x for x in amounts
+             if abs(x - amount) <= amount * OBLIGATION_TOLERANCE]
+    if len(usual) * 2 <= len(amounts):
+        amount = None
+    return Obligation(tag, percentile(gaps, 0.5), amount,
+                      percentile(sorted(days), 0.5))
+
+
+def obligation_status(obligation, payments, first, last, today):
+    """Sweep once through the sorted payments for one obligation, from its
+       first payment (or the first month_index if never paid) up to the last
+       month_index, returning {month: (status, paid)} for every due month
+       that is "overdue" or "underpaid"
+    """
+    status = {}
+    slot = month_index(payments[0][0]) if payments else first
+    i = 0
+    while slot <= last:
+        end = slot + obligation.months
+        paid = 0
+        while i < len(payments) and month_index(payments[i][0]) < end:
+            paid += payments[i][1]
+            i += 1
+
+        (year, month) = (slot // 12, slot % 12 + 1)
+        day = min(obligation.day, calendar.monthrange(year, month)[1])
+        if not paid:
+            if datetime.date(year, month, day) < today:
+                status[month_name(slot)] = ('overdue', paid)
+        elif obligation.amount is not None and paid < obligation.amount:
+            status[month_name(slot)] = ('underpaid', paid)
+        slot = end
+    return status
+
+
+def obligations_check(payments, schedule, first, last, today):
+    """return {tag: {month: (status, paid, obligation)}} for all the bills
+       that were not paid in full, using the schedule or else learning the
+       obligation from the payments
+    """
+    flags = {}
+    for tag in set(payments) | set(schedule):
+        history = sorted(payments.get(tag, []))
+        obligation = schedule.get(tag)
+        if obligation is None:
+            obligation = obligation_learn(tag, history)
+        if obligation is None:
+            continue
+        status = obligation_status(obligation, history, first, last, today)
+        if status:
+            flags[tag] = dict(
+                (month, (state, paid, obligation))
+                for (month, (state, paid)) in status.items())
+    return flags
+
+
+def topay_table(result, payments, period=None, schedule=None, today=None):
+    """Yield (month, bills) for each month of the topay_accumulate() result,
+       where bills is a list of (hashtag, price, date, status).  The status
+       says why the bill is flagged, or is None
+    """
+    (months, tags, grid, totals) = result
+
+    # The bills are checked against what was due in each month
+    flags = {}
+    if period is None and months:
+        if today is None:
+            today = datetime.datetime.utcnow().date()
+        (first, last) = [
+            month_index(datetime.datetime.strptime(month, '%Y-%m'))
+            for month in (min(months), max(months))
+        ]
+        flags = obligations_check(payments, schedule or {}, first, last,
+                                  today)
+
+    for month in sorted(months):
+        bills = []
+        for hashtag in sorted(set(tags) | set(flags)):
+            if month in grid.get(hashtag, {}):
+                price = grid[hashtag][month]['sum']
+                date = grid[hashtag][month]['last']
+            else:
+                price = "$0"
+                date = "Not Yet"
+
+            status = None
+            if month in flags.get(hashtag, {}):
+                (status, paid, obligation) = flags[hashtag][month]
+                if obligation.amount is not None:
+                    status = '{}, {} due'.format(status, obligation.amount)
+
+            bills.append((hashtag.capitalize(), price, date, status))
+        yield month, bills
+
+
+def topay_write(f, rows, strings, period=None, schedule=None, today=None):
+    payments = {}
+    result = topay_accumulate(obligation_payments(rows, payments), period)
+
+    for month, bills in topay_table(result, payments, period, schedule,
+                                    today):
+        f.write(strings['header'].format(date=month))
+        f.write("\n")
+        f.write(strings['table_start'])
+        f.write("\n")
+        for (hashtag, price, date, status) in bills:
+            if status is not None:
+                date = strings.get('flag', TOPAY_FLAG).format(
+                    date=date, status=status)
+            f.write(strings['table_row'].format(hashtag=hashtag,
+                                                price=price, date=date))
+            f.write("\n")
+        f.write(strings['table_end'])
+        f.write("\n")
+
+
+def topay_render(rows, strings, period=None, schedule=None, today=None):
+    sink = StringSink()
+    topay_write(sink, rows, strings, period, schedule, today)
+    return sink.getvalue()
+
+
+@writes_output
+def subp_topay(args, out):
+    strings = {
+        'header': 'Date: {date}',
+        'table_start': "Bill\t\t\tPrice\tPay Date",
+        'table_end': '',
+        'table_row': "{hashtag:<23}\t{price}\t{date}",
+        'flag': TOPAY_FLAG,
+    }
+    topay_write(out, args.rows, strings, args.period,
+                obligations_schedule(args))
+    out.write("\n")
+
+
+@writes_output
+def subp_topay_html(args, out):
+    strings = {
+        'header': '<h2>Date: <i>{date}</i></h2>',
+        'table_start':
+            "<table>\n" +
+            "<tr><th>Bills</th><th>Price</th><th>Pay Date</th></tr>",
+        'table_end': '</table>',
+        'table_row': '''
+    <tr>
+        <td>{hashtag}</td><td>{price}</td><td>{date}</td>
+    </tr>''',
+        'flag': '{date} <strong>{status}</strong>',
+    }
+    topay_write(out, args.rows, strings, args.period,
+                obligations_schedule(args))
+    out.write("\n")
@@ -0,0 +1,115 @@
+# Licensed under GPLv3
+"""Rolling sums, year on year changes and tag shares
+"""
+import datetime
+import json
+from .core import grid_accumulate_directions, month_index, month_name
+
+
+def trends_compute(months, tags, grid, windows=(3, 6, 12)):
+    """Work out the rolling window sums and averages, the year on year
+       change and the share of the total for each tag in a grid.
+
+       All the series run over every month from the first to the last, with
+       gaps as zero.  Each rolling sum is updated by adding the month coming
+       into the window and subtracting the one leaving it, so the work does
+       not depend on the window size.  Tags starting with "in " or "out "
+       have their share taken from the total of the same direction.
+    """
+    result = {}
+    if not months:
+        return [], result
+
+    indexes = [month_index(datetime.date(int(m[:4]), int(m[5:7]), 1))
+               for m in months]
+    first = min(indexes)
+    count = max(indexes) - first + 1
+    labels = [month_name(first + i) for i in range(count)]
+
+    totals = {}
+    for tag in tags:
+        total = sum(cell['sum'] for cell in grid[tag].values())
+        group = tag.split(' ', 1)[0].lower()
+        totals[group] = totals.get(group, 0) + total
+
+    for tag in tags:
+        series = [grid[tag][m]['sum'] if m in grid[tag] else 0
+                  for m in labels]
+
+        rolling = {}
+        average = {}
+        for window in windows:
+            sums = []
+            running = 0
+            for i, value in enumerate(series):
+                running += value
+                if i >= window:
+                    running -= series[i - window]
+                sums.append(running)
+            rolling[window] = sums
+            average[window] = [
+                float(v) / min(window, i + 1) for i, v in enumerate(sums)
+            ]
+
+        yoy = [None if i < 12 else value - series[i - 12]
+               for i, value in enumerate(series)]
+
+        total = sum(series)
+        group = tag.split(' ', 1)[0].lower()
+        share = float(total) / float(totals[group]) if totals[group] else 0.0
+
+        result[tag] = {
+            'sum': series,
+            'rolling': rolling,
+            'average': average,
+            'yoy': yoy,
+            'total': total,
+            'share': share,
+        }
+
+    return labels, result
+
+
+def subp_trends(args):
+    (months, tags, grid, totals) = grid_accumulate_directions(args.rows)
+    (labels, trends) = trends_compute(months, tags, grid)
+
+    if args.json:
+        def _number(value):
+            if value is None:
+                return None
+            return float(value)
+
+        return json.dumps({
+            'months': labels,
+            'tags': dict((tag.lower(), {
+                'sum': [_number(v) for v in t['sum']],
+                'rolling': dict((str(w), [_number(v) for v in values])
+                                for w, values in t['rolling'].items()),
+                'average': dict((str(w), values)
+                                for w, values in t['average'].items()),
+                'yoy': [_number(v) for v in t['yoy']],
+                'total': _number(t['total']),
+                'share': t['share'],
+            }) for tag, t in trends.items()),
+        }, sort_keys=True)
+
+    if not labels:
+        return ''
+
+    tags_len = max(len(tag) for tag in trends) + 1
+    s = []
+    s.append("Trends for {}".format(labels[-1]))
+    s.append("{:<{}}{:>9}{:>9}{:>9}{:>9}{:>9}{:>9}{:>7}".format(
+        '', tags_len, 'Month', '3 Month', '6 Month', '12 Month',
+        'Avg 12', 'YoY', 'Share'))
+    for tag in sorted(trends):
+        t = trends[tag]
+        yoy = t['yoy'][-1]
+        s.append(
+            "{:<{}}{:>9}{:>9}{:>9}{:>9}{:>9.0f}{:>9}{:>7.1%}".format(
+                tag, tags_len, t['sum'][-1], t['rolling'][3][-1],
+                t['rolling'][6][-1], t['rolling'][12][-1],
+                t['average'][12][-1], '' if yoy is None else yoy,
+                t['share']))
+    return "\n".join(s)
@@ -0,0 +1,241 @@
+# Licensed under GPLv3
+"""A static site with a page per month and member
+"""
+import os
+import re
+import json
+import hashlib
+import multiprocessing
+try:
+    from html import escape
+except ImportError:  # pragma: no cover
+    from cgi import escape
+from .core import GridAccumulator, MemberCoverage, direction_tag
+from .topay import (
+    TOPAY_FLAG, obligation_record, obligations_schedule, topay_table)
+
+
+# The list of what was used to render each page of the site is kept here
+SITE_MANIFEST = '.manifest.json'
+
+# The layout of every page of the site
+SITE_PAGE = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8" />
+<title>dsl balance - {title}</title>
+<style>
+body {{ background-color:#000; color:#00E100; font-family:monospace; }}
+a {{ color:#eee; }}
+td {{ padding:0 1em; text-align:right; }}
+td:first-child {{ text-align:left; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+{body}
+<p><a href="index.html">index</a></p>
+</body>
+</html>
+'''
+
+
+class SiteModel(object):
+    """Everything needed to render the static site, gathered in one pass
+       over the rows.  Each page only gets the part of the model that it
+       shows, so that pages can be rendered separately and only re-rendered
+       when their part has changed.
+    """
+
+    def __init__(self, rows, schedule=None, today=None):
+        grid = GridAccumulator()
+        topay = GridAccumulator()
+        payments = {}
+        self.members = {}
+        for row in rows:
+            grid.add(row, direction_tag(row))
+            if row.direction == 'outgoing':
+                topay.add(row)
+            obligation_record(row, payments)
+            member = MemberCoverage.member(row)
+            if member is not None:
+                self.members.setdefault(member, []).append(
+                    (row.date.isoformat(), str(row.value), row.comment))
+
+        (self.months, self.tags, self.grid, self.totals) = grid.result()
+        self.months = sorted(self.months)
+
+        # every month has a list of bills, even with nothing paid out
+        (_, tags, topay, _) = topay.result()
+        self.topay = dict(topay_table((self.months, tags, topay, None),
+                                      payments, schedule=schedule,
+                                      today=today))
+
+    def month_page(self, month, balance):
+        topay = []
+        for (tag, price, date, status) in self.topay.get(month, []):
+            if status is not None:
+                date = TOPAY_FLAG.format(date=date, status=status)
+            topay.append((tag, str(price), str(date)))
+
+        grid = [(tag, str(self.grid[tag][month]['sum']))
+                for tag in sorted(self.tags) if month in self.grid[tag]]
+
+        return {
+            'month': month,
+            'topay': topay,
+            'grid': grid,
+            'total': str(self.totals[month]),
+            'balance': str(balance),
+        }
+
+    def pages(self):
+        """return a list of (filename, kind, data) for every page
+        """
+        pages = []
+        balance = 0
+        for month in self.months:
+            balance += self.totals[month]
+            pages.append(('month-{}.html'.format(month), 'month',
+                          self.month_page(month, balance)))
+
+        for member, rows in sorted(self.members.items()):
+            pages.append((site_member_filename(member), 'member', {
+                'member': member,
+                'rows': sorted(rows),
+            }))
+
+        pages.append(('index.html', 'index', {
+            'balance': str(self.totals['total']),
+            'months': self.months,
+            'members': sorted(self.members),
+        }))
+        return pages
+
+
+def html_escape(text):
+    return escape(text)
+
+
+def site_member_filename(member):
+    return 'member-{}.html'.format(re.sub(r'[^a-z0-9_-]', '_', member))
+
+
+def site_table(rows, header=None):
+    """return an HTML table of the rows of strings
+    """
+    s = ['<table>']
+    if header is not None:
+        s.append('<tr>{}</tr>'.format(
+            ''.join('<th>{}</th>'.format(html_escape(h)) for h in header)))
+    for row in rows:
+        s.append('<tr>{}</tr>'.format(
+            ''.join('<td>{}</td>'.format(html_escape(c)) for c in row)))
+    s.append('</table>')
+    return "\n".join(s)
+
+
+def site_render(page):
+    """Render one page of the site, returning the filename and the HTML
+    """
+    (filename, kind, data) = page
+
+    if kind == 'month':
+        title = data['month']
+        body = "\n".join([
+            '<h2>Bills</h2>',
+            site_table(data['topay'], ('Bill', 'Price', 'Pay Date')),
+            '<h2>Tags</h2>',
+            site_table(data['grid'] + [
+                ('Month Sub Total', data['total']),
+                ('Running Balance', data['balance']),
+            ]),
+        ])
+    elif kind == 'member':
+        title = data['member']
+        body = site_table(data['rows'], ('Date', 'Value', 'Comment'))
+    elif kind == 'index':
+        title = 'Balance: {}'.format(data['balance'])
+        links = []
+        for (heading, names, link) in (
+                ('Months', data['months'], 'month-{}.html'.format),
+                ('Members', data['members'], site_member_filename)):
+            links.append('<h2>{}</h2>'.format(heading))
+            links.append('<ul>')
+            links.extend('<li><a href="{}">{}</a></li>'.format(
+                link(name), html_escape(name)) for name in names)
+            links.append('</ul>')
+        body = "\n".join(links)
+    else:
+        raise ValueError('Unknown page kind "{}"'.format(kind))
+
+    return filename, SITE_PAGE.format(title=html_escape(title), body=body)
+
+
+def site_fingerprint(page):
+    """return a hash of everything that goes into rendering the page
+    """
+    text = json.dumps(page, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def site_changed(pages, manifest):
+    """return the pages that are not listed in the manifest with the same
+       fingerprint, and the new manifest
+    """
+    changed = []
+    new = {}
+    for page in pages:
+        fingerprint = site_fingerprint(page)
+        new[page[0]] = fingerprint
+        if manifest.get(page[0]) != fingerprint:
+            changed.append(page)
+    return changed, new
+
+
+def site_build(dirname, pages, jobs=None):   # pragma: no cover
+    """Render the changed pages into dirname, using a pool of processes, and
+       return the filenames written
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    manifest_file = os.path.join(dirname, SITE_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    # a page that has been removed must be rendered again
+    manifest = dict((name, fingerprint)
+                    for name, fingerprint in manifest.items()
+                    if os.path.exists(os.path.join(dirname, name)))
+
+    (changed, new) = site_changed(pages, manifest)
+    # and a page that is no longer in the site is removed
+    for name in set(manifest) - set(new):
+        os.unlink(os.path.join(dirname, name))
+
+    if jobs == 1 or len(changed) < 2:
+        rendered = [site_render(page) for page in changed]
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            rendered = pool.map(site_render, changed)
+        finally:
+            pool.close()
+            pool.join()
+
+    for filename, html in rendered:
+        with open(os.path.join(dirname, filename), 'w') as f:
+            f.write(html)
+
+    with open(manifest_file, 'w') as f:
+        json.dump(new, f, sort_keys=True)
+    return [filename for filename, _ in rendered]
+
+
+def subp_site(args):  # pragma: no cover
+    pages = SiteModel(args.rows, obligations_schedule(args)).pages()
+    written = site_build(args.out_dir, pages, args.jobs)
+    return "Wrote {} of {} pages to {}".format(len(written), len(pages),
+                                               args.out_dir)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+""" This is a startup time benchmark - it runs balance.py a number of times
+    for some common commands against a generated ledger and reports how long
+    it takes from starting the interpreter to the first byte of output.
+
+    The tool is run from shell loops and hooks, so this fixed cost matters
+    more than the time taken for any one large ledger.  The budget is on
+    top of the time that the interpreter takes to start, measured in the same
+    run, so that a slow or busy machine does not fail it.  If the median time
+    for any command is over the budget, the exit status is non zero.
+"""
+
+import argparse
+import datetime
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The commands to time, each is run with "--dir" pointing at the ledger
+COMMANDS = (
+    ('sum',),
+    ('party',),
+    ('topay',),
+    ('--split', 'grid'),
+)
+
+
+def make_ledger(dirname, months):
+    """Write a ledger with a few typical rows for each month
+    """
+    date = datetime.date(2000, 1, 1)
+    for _ in range(months):
+        month = date.strftime('%Y-%m')
+        with open(os.path.join(dirname, 'incoming-' + month), 'w') as f:
+            for i in range(10):
+                f.write('500\t{}-{:02d}\t#dues:member{}\n'.format(
+                    month, i + 1, i))
+            f.write('1000\t{}-15\tdonation !months:3\n'.format(month))
+        with open(os.path.join(dirname, 'outgoing-' + month), 'w') as f:
+            f.write('4000\t{}-05\t#bills:rent\n'.format(month))
+            f.write('488\t{}-09\t#bills:internet\n'.format(month))
+        date = (date + datetime.timedelta(days=31)).replace(day=1)
+
+
+def time_to_output(argv):
+    """return the seconds from starting the command to its first output
+    """
+    start = time.time()
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+    proc.stdout.read(1)
+    elapsed = time.time() - start
+    proc.stdout.read()
+    proc.wait()
+    if proc.returncode:
+        raise RuntimeError('{} failed'.format(' '.join(argv)))
+    return elapsed
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--runs', type=int, default=20,
+                           help='How many times to run each command')
+    argparser.add_argument('--months', type=int, default=24,
+                           help='How many months of cash files to generate')
+    argparser.add_argument('--budget', type=float, default=60,
+                           help='Maximum median milliseconds for a command, '
+                                'more than the interpreter takes to start')
+    args = argparser.parse_args()
+
+    dirname = tempfile.mkdtemp()
+    try:
+        make_ledger(dirname, args.months)
+
+        baseline = [sys.executable, '-c', 'print(1)']
+        times = [time_to_output(baseline) for _ in range(args.runs)]
+        interpreter = median(times) * 1000
+        print('{:<20}{:>8.1f} ms'.format('(interpreter)', interpreter))
+        limit = interpreter + args.budget
+
+        over = []
+        for command in COMMANDS:
+            argv = [sys.executable, os.path.join(HERE, 'balance.py'),
+                    '--dir', dirname] + list(command)
+            # the first run might compile and save the modules, which only
+            # happens once after they are changed, so it is not counted
+            time_to_output(argv)
+            times = [time_to_output(argv) for _ in range(args.runs)]
+            ms = median(times) * 1000
+            name = ' '.join(command)
+            print('{:<20}{:>8.1f} ms'.format(name, ms))
+            if ms > limit:
+                over.append(name)
+    finally:
+        shutil.rmtree(dirname)
+
+    if over:
+        sys.stderr.write('Over the {:.0f} ms budget: {}\n'.format(
+            limit, ', '.join(over)))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
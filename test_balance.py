@@ -3,8 +3,14 @@
 """
 
 import unittest
+import tempfile
+import shutil
 import datetime
+import decimal
+import io
+import random
 import sys
+import os
 if sys.version_info[0] == 2:  # pragma: no cover
     import mock
 else:
@@ -174,6 +180,38 @@ class TestRowClass(unittest.TestCase):
 
         # TODO - at at least a trivial example showing method==proportional
 
+    def test_autosplit_span(self):
+        self.assertEqual(self.rows[0].autosplit_span(), self.rows[0])
+
+        for row in self.rows[4:7]:
+            span = row.autosplit_span()
+            self.assertEqual(span.expand(), row.autosplit())
+            self.assertEqual(span.value, sum(row.autosplit()))
+
+        span = self.rows[6].autosplit_span()
+        self.assertEqual(span.date, datetime.date(1970, 1, 5))
+        self.assertEqual(span.hashtag, None)
+        self.assertEqual(span.filter('comment=~nothing'), None)
+        self.assertEqual(span.filter('comment=~child'), span)
+
+        # narrowing on the months
+        got = span.filter('month>1970-01')
+        self.assertEqual(got.runs, [(1, 3)])
+        self.assertEqual(got.value, 66)
+        self.assertEqual(got.date, datetime.date(1970, 2, 5))
+        self.assertEqual(span.filter('month!=1970-02').runs, [(0, 1), (2, 3)])
+        self.assertEqual(span.filter('month==1970-02').runs, [(1, 2)])
+        self.assertEqual(span.filter('date=~-0[13]-').runs, [(0, 1), (2, 3)])
+        self.assertEqual(span.filter('month<1970-01'), None)
+
+        # only the first child gets the rounding remainder
+        self.assertEqual(span.filter('value>33').runs, [(0, 1)])
+        self.assertEqual(span.filter('value==33').runs, [(1, 3)])
+
+        with self.assertRaises(ValueError):
+            balance.Row("100", "1970-01-01", "!months:0", "incoming") \
+                .autosplit_span()
+
     def test_match(self):
         obj = self.rows[2]
         with self.assertRaises(AttributeError):
@@ -202,6 +240,11 @@ class TestRowClass(unittest.TestCase):
         self.assertEqual(obj.filter('month>1969-12'), obj)
         self.assertEqual(obj.filter('month>1970-01'), None)
 
+        self.assertEqual(obj.filter('date>=1970-01-03'), obj)
+        self.assertEqual(obj.filter('date>=1970-01-04'), None)
+        self.assertEqual(obj.filter('date<=1970-01-03'), obj)
+        self.assertEqual(obj.filter('date<=1970-01-02'), None)
+
         self.assertEqual(obj.filter('comment=~gtag'), obj)
         self.assertEqual(obj.filter('comment=~^a'), obj)
         self.assertEqual(obj.filter('comment=~^foo'), None)
@@ -213,6 +256,80 @@ class TestRowClass(unittest.TestCase):
         self.assertEqual(obj.filter('rel_months<-265'), None)
 
 
+class TestMemberCoverage(unittest.TestCase):
+    def setUp(self):
+        r = [None for x in range(6)]
+        r[0] = balance.Row("500", "1970-01-31", "#dues:alice", "incoming")
+        r[1] = balance.Row("500", "1970-02-15", "#dues:alice", "incoming")
+        r[2] = balance.Row("500", "1970-06-01", "#dues:Alice !months:2", "incoming") # noqa
+        r[3] = balance.Row("500", "1970-03-10", "#dues:bob !months:-1:2", "incoming") # noqa
+        r[4] = balance.Row("500", "1970-03-10", "#bills:rent", "outgoing")
+        r[5] = balance.Row("500", "1970-03-10", "#clubmate", "incoming")
+        self.coverage = balance.MemberCoverage(r)
+
+    def tearDown(self):
+        self.coverage = None
+
+    def test_intervals(self):
+        self.assertEqual(self.coverage.members(), ['alice', 'bob'])
+        # the early payment extends the coverage, counted from the anchor
+        self.assertEqual(self.coverage.intervals['alice'], [
+            (datetime.date(1970, 1, 31), datetime.date(1970, 3, 31)),
+            (datetime.date(1970, 6, 1), datetime.date(1970, 8, 1)),
+        ])
+        self.assertEqual(self.coverage.intervals['bob'], [
+            (datetime.date(1970, 2, 10), datetime.date(1970, 4, 10)),
+        ])
+        self.assertEqual(self.coverage.end_date('alice'),
+                         datetime.date(1970, 8, 1))
+        self.assertEqual(self.coverage.end_date('carol'), None)
+
+    def test_covered_on(self):
+        def covered(*date):
+            return sorted(self.coverage.covered_on(datetime.date(*date)))
+
+        self.assertEqual(covered(1970, 1, 1), [])
+        self.assertEqual(covered(1970, 2, 10), ['alice', 'bob'])
+        self.assertEqual(covered(1970, 3, 31), ['bob'])
+        self.assertEqual(covered(1970, 4, 10), [])
+        self.assertEqual(covered(1970, 7, 31), ['alice'])
+        self.assertEqual(covered(1970, 8, 1), [])
+
+        self.assertTrue(
+            self.coverage.is_covered('alice', datetime.date(1970, 3, 30)))
+        self.assertFalse(
+            self.coverage.is_covered('alice', datetime.date(1970, 3, 31)))
+        self.assertFalse(
+            self.coverage.is_covered('carol', datetime.date(1970, 3, 31)))
+
+    def test_gaps(self):
+        self.assertEqual(self.coverage.gaps('alice'), [
+            (datetime.date(1970, 3, 31), datetime.date(1970, 6, 1)),
+        ])
+        self.assertEqual(self.coverage.gaps('alice',
+                                            datetime.date(1970, 1, 1),
+                                            datetime.date(1970, 12, 1)), [
+            (datetime.date(1970, 1, 1), datetime.date(1970, 1, 31)),
+            (datetime.date(1970, 3, 31), datetime.date(1970, 6, 1)),
+            (datetime.date(1970, 8, 1), datetime.date(1970, 12, 1)),
+        ])
+        self.assertEqual(self.coverage.gaps('alice',
+                                            datetime.date(1970, 4, 1),
+                                            datetime.date(1970, 5, 1)), [
+            (datetime.date(1970, 4, 1), datetime.date(1970, 5, 1)),
+        ])
+        self.assertEqual(self.coverage.gaps('carol'), [])
+
+    def test_split_children(self):
+        rows = balance.Row(
+            "1000", "1970-01-05", "#dues:alice !months:2", "incoming"
+        ).autosplit()
+        coverage = balance.MemberCoverage(rows)
+        self.assertEqual(coverage.intervals['alice'], [
+            (datetime.date(1970, 1, 5), datetime.date(1970, 3, 5)),
+        ])
+
+
 class TestMisc(unittest.TestCase):
     def setUp(self):
         r = [None for x in range(6)]
@@ -280,6 +397,43 @@ class TestMisc(unittest.TestCase):
                     'total': -45
                 }))
 
+    def test_grid_accumulate_spans(self):
+        rows = [
+            balance.Row("10", "1970-01-31", "#rent !months:-1:4", "outgoing"),
+            balance.Row("100", "1970-02-15", "#rent !months:3", "outgoing"),
+            balance.Row("10", "1970-02-06", "#rent", "outgoing"),
+            balance.Row("50", "1970-01-05", "!months:2", "incoming"),
+        ]
+        split = []
+        for row in rows:
+            split.extend(row.autosplit())
+
+        spans = [row.autosplit_span() for row in rows]
+        self.assertEqual(balance.grid_accumulate(spans),
+                         balance.grid_accumulate(split))
+
+        spans = balance.apply_filter_strings(['month>1970-01'], spans)
+        split = balance.apply_filter_strings(['month>1970-01'], split)
+        self.assertEqual(balance.grid_accumulate(spans),
+                         balance.grid_accumulate(split))
+
+    def test_query_plan(self):
+        plan = balance.QueryPlan()
+        rent = plan.grid(['comment=~rent'])
+        outgoing = plan.total(['direction==outgoing'])
+        last = plan.max('date', ['direction==outgoing', 'hashtag==water'])
+        upper = plan.grid(tag=lambda row: 'all')
+
+        # a single pass over an iterator is enough for all the queries
+        plan.run(iter(self.rows))
+
+        self.assertEqual(rent.result, balance.grid_accumulate(
+            [self.rows[2], self.rows[4]]))
+        self.assertEqual(outgoing.result, -55)
+        self.assertEqual(last.result, datetime.date(1970, 1, 11))
+        self.assertEqual(sorted(upper.result[1]), ['All'])
+        self.assertEqual(upper.result[3]['total'], -45)
+
     def test_topay_render(self):
         strings = {
             'header': 'header: {date}',
@@ -348,9 +502,15 @@ class TestSubp(unittest.TestCase):
         r[8] = balance.Row("13152", "1990-05-25", "balance books", "incoming") # noqa
 
         self.rows = r
+        self.depth = None
+        self.period = None
+        self.schedule = None
+        self.drill = []
+        self.dir = tempfile.mkdtemp()
 
     def tearDown(self):
         self.rows = None
+        shutil.rmtree(self.dir)
 
     def test_sum(self):
         self.assertEqual(balance.subp_sum(self), "10")
@@ -429,7 +589,31 @@ class TestSubp(unittest.TestCase):
         self.assertEqual(balance.subp_party(self), "Success")
         # FIXME - add a "Fail" case too
 
-    # FIXME - subp_csv
+    def test_csv(self):
+        sink = balance.StringSink()
+        balance.subp_csv(self, sink)
+        expect = [
+            "Value,Date,Comment",
+            "500,1990-04-03,#dues:test1",
+            "20,1990-04-03,Unknown",
+            "-12500,1990-04-15,#bills:rent",
+            "-1500,1990-04-26,#clubmate",
+            "1500,1990-04-27,#clubmate",
+            "-1174,1990-04-27,#bills:electric",
+            "500,1990-05-02,#dues:test1",
+            "-488,1990-05-25,#bills:internet",
+            "13152,1990-05-25,balance books",
+            "",
+            "Sum",
+            "10",
+            "",
+        ]
+        self.assertEqual(sink.getvalue().split("\r\n"), expect)
+
+    def test_writes_output(self):
+        sink = balance.StringSink()
+        self.assertIsNone(balance.subp_grid(self, sink))
+        self.assertEqual(sink.getvalue(), balance.subp_grid(self) + "\n")
 
     def test_grid(self):
         expect = [
@@ -450,6 +634,52 @@ class TestSubp(unittest.TestCase):
         got = balance.subp_grid(self).split("\n")
         self.assertEqual(got, expect)
 
+        # the rows are not changed, and only one pass over them is needed
+        self.assertEqual(self.rows[0].hashtag, 'dues:test1')
+        rows = self.rows
+        self.rows = iter(rows)
+        self.assertEqual(balance.subp_grid(self).split("\n"), expect)
+        self.rows = iter(rows)
+        self.assertEqual(balance.subp_sum(self), "10")
+
+    def test_grid_depth(self):
+        expect = [
+            "               1990-04  1990-05",
+            "In clubmate       1500         ",
+            "In dues            500      500",
+            "In unknown          20    13152",
+            "Out bills       -13674     -488",
+            "Out clubmate     -1500         ",
+            "",
+            "MONTH Sub Total   -13154    13164",
+            "RUNNING Balance   -13154       10",
+            "TOTAL:        10",
+        ]
+
+        self.depth = 1
+        got = balance.subp_grid(self).split("\n")
+        self.assertEqual(got, expect)
+
+        # drilling down shows every tag below the subtotal
+        self.drill = ['out bills']
+        got = balance.subp_grid(self).split("\n")
+        self.assertEqual(got[4:8], [
+            "Out bills             -13674     -488",
+            "Out bills:electric     -1174         ",
+            "Out bills:internet               -488",
+            "Out bills:rent        -12500         ",
+        ])
+
+        # the direction can be left out
+        self.drill = ['bills']
+        got = balance.subp_grid(self).split("\n")
+        self.assertEqual(got[4:8], [
+            "Out bills             -13674     -488",
+            "Out bills:electric     -1174         ",
+            "Out bills:internet               -488",
+            "Out bills:rent        -12500         ",
+        ])
+
 # TODO - re-import the json from a string and do a deep compare
 #     def test_json_dues(self):
 #         r = ""
@@ -471,3 +701,1255 @@ class TestSubp(unittest.TestCase):
         # TODO - have a testable "rowset.forcastNext(category)" function
         want = 'Rent (next due: <span style="color:red">MAY 1990</span>)'
         self.assertTrue(want in got)
+
+    @mock.patch('balance.datetime.datetime', fakedatetime)
+    def test_make_balance_subtag(self):
+        self.rows[6] = balance.Row(
+            "500", "1990-05-02", "#dues:test1:extra", "incoming")
+        got = balance.subp_make_balance(self)
+
+        # the dues name keeps every level below "dues", joined together
+        want = "Test1            500         \nTest1extra                500\n"
+        self.assertTrue(want in got)
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.log = "\n".join([
+            "commit aaaa 1970-01-01",
+            "",
+            ":000000 100644 0000 b1 A\tcash/incoming-1970-01",
+            ":000000 100644 0000 b2 A\tcash/outgoing-1970-01",
+            "commit bbbb 1970-01-02",
+            "",
+            ":100644 100644 b1 b3 M\tcash/incoming-1970-01",
+            ":000000 100644 0000 b4 A\tcash/notes-1970-01",
+            "commit cccc 1970-01-03",
+            "",
+            ":100644 000000 b2 0000 D\tcash/outgoing-1970-01",
+            ":100644 000000 b4 0000 D\tcash/notes-1970-01",
+        ])
+        self.blobs = {
+            'b1': "100 1970-01-01 #dues:test1\n",
+            'b2': "30 1970-01-02 #bills:rent\n",
+            'b3': "100 1970-01-01 #dues:test1\n50 1970-01-20 #clubmate\n",
+            'b4': "\tnot a row\n",
+        }
+
+    def test_parse_git_log(self):
+        log = balance.parse_git_log(self.log)
+        self.assertEqual([c[0] for c in log], ['aaaa', 'bbbb', 'cccc'])
+        self.assertEqual(log[1], ('bbbb', '1970-01-02', [
+            ('incoming-1970-01', 'b3'),
+            ('notes-1970-01', 'b4'),
+        ]))
+        self.assertEqual(log[2][2], [
+            ('outgoing-1970-01', None),
+            ('notes-1970-01', None),
+        ])
+
+    def test_history_replay(self):
+        reads = []
+
+        def read_blob(blob):
+            reads.append(blob)
+            return self.blobs[blob]
+
+        parsed = balance.ParsedBlobs(read_blob)
+        log = balance.parse_git_log(self.log)
+        got = list(balance.history_replay(log, parsed))
+        self.assertEqual(got, [
+            ('aaaa', '1970-01-01', 70, []),
+            ('bbbb', '1970-01-02', 120, ['notes-1970-01']),
+            ('cccc', '1970-01-03', 150, []),
+        ])
+        # each changed blob is only read once
+        self.assertEqual(sorted(reads), ['b1', 'b2', 'b3', 'b4'])
+
+        # only the rows matching the filters are counted
+        parsed = balance.ParsedBlobs(read_blob,
+                                     filter_strings=['hashtag=~^dues'])
+        got = list(balance.history_replay(log, parsed))
+        self.assertEqual([total for _, _, total, _ in got],
+                         [100, 100, 100])
+
+    def test_grid_diff(self):
+        old = [
+            balance.Row("100", "1970-01-01", "#dues:test1", "incoming"),
+            balance.Row("30", "1970-01-02", "#bills:rent", "outgoing"),
+        ]
+        new = old + [
+            balance.Row("50", "1970-02-20", "#clubmate", "incoming"),
+        ]
+        new[1] = balance.Row("35", "1970-01-02", "#bills:rent", "outgoing")
+
+        got = balance.grid_diff(balance.grid_accumulate(old),
+                                balance.grid_accumulate(new))
+        self.assertEqual(got, (
+            set(['1970-01', '1970-02']),
+            set(['Bills:rent', 'Clubmate']),
+            {
+                'Bills:rent': {'1970-01': {'sum': -5}},
+                'Clubmate': {'1970-02': {'sum': 50}},
+            },
+            {'1970-01': -5, '1970-02': 50, 'total': 45},
+        ))
+
+
+class TestReceipts(unittest.TestCase):
+    def test_from_filename(self):
+        got = balance.Receipt.from_filename('2017-05-30_rent-paid-for-april.jpg') # noqa
+        self.assertEqual(got.date, datetime.date(2017, 5, 30))
+        self.assertEqual(got.keywords, ('rent', 'april'))
+        self.assertEqual(got.slack, 0)
+
+        got = balance.Receipt.from_filename('2016-10-19_business_reg_PAID.jpg') # noqa
+        self.assertEqual(got.keywords, ('br',))
+
+        got = balance.Receipt.from_filename('2017-05-xx_dsl-electricity.jpg')
+        self.assertEqual(got.date, datetime.date(2017, 5, 15))
+        self.assertEqual(got.keywords, ('electricity',))
+        self.assertEqual(got.slack, 16)
+
+        self.assertEqual(balance.Receipt.from_filename('README'), None)
+
+    def test_receipts_match(self):
+        rows = [
+            balance.Row("100", "1970-01-10", "#bills:rent", "outgoing"),
+            balance.Row("100", "1970-02-10", "#bills:rent", "outgoing"),
+            balance.Row("20", "1970-01-20", "#bills:internet", "outgoing"),
+            balance.Row("30", "1970-01-25", "#bills:electricity", "outgoing"),
+        ]
+        receipts = sorted([
+            balance.Receipt.from_filename('1970-01-08_rental.jpg'),
+            balance.Receipt.from_filename('1970-02-01_rent_paid.jpg'),
+            balance.Receipt.from_filename('1970-02-28_rent_paid.jpg'),
+            balance.Receipt.from_filename('1970-01-21_pccw.pdf'),
+            balance.Receipt.from_filename('1970-06-01_electricity.pdf'),
+        ])
+
+        (matches, unreceipted, orphans) = balance.receipts_match(
+            rows, receipts, 10)
+
+        def names(i):
+            return [r.filename for r in matches[i]]
+
+        self.assertEqual(names(0), ['1970-01-08_rental.jpg'])
+        self.assertEqual(names(1), ['1970-02-01_rent_paid.jpg'])
+        self.assertEqual(names(2), ['1970-01-21_pccw.pdf'])
+        self.assertEqual(unreceipted, rows[3:4])
+        self.assertEqual([r.filename for r in orphans], [
+            '1970-02-28_rent_paid.jpg',
+            '1970-06-01_electricity.pdf',
+        ])
+
+
+class TestFilePushdown(unittest.TestCase):
+    def modes(self, filters, split=False):
+        pushdown = balance.FilePushdown(filters, split)
+        return [pushdown.mode(f) for f in (
+            'incoming-1990-01',
+            'outgoing-1990-03',
+            'incoming-1990-05',
+            'incoming-1990-07',
+            'membershipfees',
+        )]
+
+    def test_no_filters(self):
+        self.assertEqual(self.modes(None), ['all'] * 5)
+        self.assertEqual(self.modes(['comment=~rent']), ['all'] * 5)
+
+    def test_direction(self):
+        self.assertEqual(self.modes(['direction==outgoing']),
+                         [None, 'all', None, None, None])
+        self.assertEqual(self.modes(['direction!=outgoing']),
+                         ['all', None, 'all', 'all', 'all'])
+
+    def test_month(self):
+        self.assertEqual(self.modes(['month==1990-05']),
+                         [None, None, 'all', None, 'all'])
+        # the slack allows for rows in the neighbouring files
+        self.assertEqual(self.modes(['month>1990-03']),
+                         [None, 'all', 'all', 'all', 'all'])
+        self.assertEqual(self.modes(['month>=1990-05', 'month<=1990-05']),
+                         [None, None, 'all', None, 'all'])
+        self.assertEqual(self.modes(['date<1990-02-05']),
+                         ['all', 'all', None, None, 'all'])
+
+    def test_month_bounds(self):
+        march = balance.month_index(datetime.date(1990, 3, 1))
+        for (filters, lo, hi) in (
+                (['month>1990-03'], march + 1, None),
+                (['month<1990-03'], None, march - 1),
+                # "1990-03-05" > "1990-03", so march is still needed
+                (['date>1990-03'], march, None),
+                (['date<1990-03'], None, march - 1),
+                (['date>1990-03-05'], march, None),
+                (['date<=1990-03'], None, march),
+        ):
+            pushdown = balance.FilePushdown(filters)
+            self.assertEqual((pushdown.lo, pushdown.hi), (lo, hi), filters)
+
+        # the rows themselves agree
+        row = balance.Row("1", "1990-03-05", "", "incoming")
+        self.assertIsNotNone(row.filter('date>1990-03'))
+        self.assertIsNone(row.filter('date<1990-03'))
+
+    def test_split(self):
+        self.assertEqual(self.modes(['month==1990-05'], split=True),
+                         ['split', 'split', 'all', 'split', 'all'])
+
+    @mock.patch('balance.datetime.datetime', fakedatetime)
+    def test_rel_months(self):
+        self.assertEqual(self.modes(['rel_months>-1']),
+                         [None, 'all', 'all', 'all', 'all'])
+        self.assertEqual(self.modes(['rel_months<-3']),
+                         ['all', 'all', None, None, 'all'])
+
+    def test_spans_untagged(self):
+        # a row with no hashtag filters the same as a span as when split
+        rows = [balance.Row("30", "1990-01-10", "donation !months:3",
+                            "incoming")]
+        for s in ('hashtag=~^dues', 'hashtag==None', 'hashtag!=None'):
+            split = list(balance.apply_filter_strings(
+                [s], balance.autosplit_rows(rows)))
+            spans = list(balance.apply_filter_strings(
+                [s], balance.autosplit_spans(rows)))
+            self.assertEqual(list(balance.expand_spans(spans)), split, s)
+
+
+class TestForecast(unittest.TestCase):
+    def setUp(self):
+        self.rows = [
+            balance.Row("1000", "1990-01-01", "opening", "incoming"),
+            balance.Row("100", "1990-01-05", "#bills:rent", "outgoing"),
+            balance.Row("100", "1990-02-05", "#bills:rent", "outgoing"),
+            balance.Row("100", "1990-03-05", "#bills:rent", "outgoing"),
+            balance.Row("30", "1990-01-05", "#bills:internet !months:3", "outgoing"), # noqa
+            balance.Row("50", "1990-02-01", "#dues:alice", "incoming"),
+            balance.Row("50", "1990-03-01", "#dues:alice", "incoming"),
+            balance.Row("120", "1990-03-01", "#dues:bob !months:3", "incoming"), # noqa
+            balance.Row("50", "1990-01-01", "#dues:carol", "incoming"),
+        ]
+
+    def test_learn(self):
+        model = balance.ForecastModel.learn(self.rows)
+        self.assertEqual(model.balance, 1000 - 300 - 30 + 100 + 120 + 50)
+        self.assertEqual(balance.month_name(model.month), '1990-04')
+        self.assertEqual(model.bills, {
+            'bills:rent': (100.0, 0.0),
+            'bills:internet': (10.0, 0.0),
+        })
+        # carol has lapsed, bob has paid until 1990-05
+        self.assertEqual(model.members, {
+            'alice': (50.0, balance.month_index(datetime.date(1990, 3, 1))),
+            'bob': (40.0, balance.month_index(datetime.date(1990, 5, 1))),
+        })
+        self.assertEqual(model.churn, 1.0 / 6)
+
+        with self.assertRaises(ValueError):
+            balance.ForecastModel.learn([])
+
+    def test_simulate(self):
+        model = balance.ForecastModel.learn(self.rows, churn=0)
+        got = model.simulate(3, 4, random.Random(1))
+        self.assertEqual(got, [
+            ([880.0] * 4, 0.0),
+            ([820.0] * 4, 0.0),
+            ([800.0] * 4, 0.0),
+        ])
+
+        model.churn = 1
+        model.balance = 150
+        got = model.simulate(3, 4, random.Random(1))
+        self.assertEqual(got, [
+            ([40.0] * 4, 0.0),
+            ([-70.0] * 4, 1.0),
+            ([-180.0] * 4, 1.0),
+        ])
+
+
+class TestImport(unittest.TestCase):
+    def read(self, text, **kwargs):
+        return list(balance.import_read(io.StringIO(text), **kwargs))
+
+    def test_import_read(self):
+        got = self.read(
+            'Value,Date,Comment\n'
+            '500,1990-04-03,"#dues:test1  paid"\n'
+            '\n'
+            '"-1,174",1990-04-27,#bills:electric\n'
+        )
+        self.assertEqual(got, [
+            balance.Row("500", "1990-04-03", "#dues:test1 paid", "incoming"),
+            balance.Row("1174", "1990-04-27", "#bills:electric", "outgoing"),
+        ])
+
+        got = self.read(
+            'gross\twhen\tname\tdirection\n'
+            '500\t03/04/1990\tTest1\tOutgoing\n',
+            delimiter='\t', date_format='%d/%m/%Y',
+            columns={'value': 'Gross', 'date': 'When', 'comment': 'Name'},
+        )
+        self.assertEqual(got, [
+            balance.Row("500", "1990-04-03", "Test1", "outgoing"),
+        ])
+
+    def test_import_read_errors(self):
+        with self.assertRaises(ValueError):
+            self.read('value,date\n500,1990-04-03\n')
+        with self.assertRaises(ValueError):
+            self.read('value,date,comment\n500,1990-04-33,oops\n')
+        with self.assertRaises(ValueError):
+            self.read('value,date,comment\nabc,1990-04-03,oops\n')
+
+    def test_import_route(self):
+        rows = [
+            balance.Row("500", "1990-04-03", "#dues:test1", "incoming"),
+            balance.Row("500", "1990-04-03", "#DUES:test1 ", "incoming"),
+            balance.Row("500", "1990-04-03", "#dues:test1", "outgoing"),
+            balance.Row("500", "1990-05-03", "#dues:test1", "incoming"),
+        ]
+        self.assertEqual(balance.import_route(rows), {
+            'incoming-1990-04': rows[0:1],
+            'outgoing-1990-04': rows[2:3],
+            'incoming-1990-05': rows[3:4],
+        })
+        self.assertEqual(balance.row_format(rows[2]),
+                         "500\t1990-04-03\t#dues:test1\n")
+
+    def test_import_append(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            # a row recorded in the file for the month before its date
+            with open(os.path.join(dirname, 'incoming-1990-03'), 'w') as f:
+                f.write("500\t1990-04-01\t#dues:test1\n")
+            with open(os.path.join(dirname, 'outgoing-1990-04'), 'w') as f:
+                f.write("500\t1990-04-03\t#dues:test2\n")
+
+            rows = [
+                balance.Row("500", "1990-04-01", "#dues:test1", "incoming"),
+                balance.Row("500", "1990-04-03", "#dues:test2", "incoming"),
+            ]
+            added = balance.import_append(dirname, 'incoming-1990-04', rows)
+            self.assertEqual(added, rows[1:])
+            with open(os.path.join(dirname, 'incoming-1990-04')) as f:
+                self.assertEqual(f.read(), "500\t1990-04-03\t#dues:test2\n")
+        finally:
+            shutil.rmtree(dirname)
+
+        self.assertEqual(balance.import_neighbours('incoming-1990-01'),
+                         ['incoming-1989-12', 'incoming-1990-02'])
+
+
+class TestLedgerMirror(unittest.TestCase):
+    def setUp(self):
+        self.mirror = balance.LedgerMirror(':memory:')
+        self.sources = {
+            'incoming-1990-04': b"500 1990-04-03 #dues:test1\n"
+                                b"20 1990-04-03 Unknown\n",
+            'outgoing-1990-04': b"12500 1990-04-15 #bills:rent\n",
+        }
+
+    def tearDown(self):
+        self.mirror = None
+
+    def test_filter_to_sql(self):
+        self.assertEqual(balance.filter_to_sql('month>=1990-04'),
+                         ('month >= ?', ['1990-04']))
+        self.assertEqual(balance.filter_to_sql('value<10'),
+                         ('value < ?', [10.0]))
+        self.assertEqual(balance.filter_to_sql('hashtag==None'),
+                         ('hashtag IS NULL', []))
+        self.assertEqual(balance.filter_to_sql('comment=~rent'),
+                         ('regexp(?, comment)', ['rent']))
+        with self.assertRaises(ValueError):
+            balance.filter_to_sql('bangtag==months')
+        with self.assertRaises(ValueError):
+            balance.filter_to_sql('value<>10')
+
+    def test_sync(self):
+        changed = self.mirror.sync(self.sources)
+        self.assertEqual(changed, ['incoming-1990-04', 'outgoing-1990-04'])
+        self.assertEqual(self.mirror.sync(self.sources), [])
+
+        self.sources['incoming-1990-04'] += b"1500 1990-04-27 #clubmate\n"
+        del self.sources['outgoing-1990-04']
+        changed = self.mirror.sync(self.sources)
+        self.assertEqual(changed, ['outgoing-1990-04', 'incoming-1990-04'])
+
+        self.assertEqual(len(self.mirror.query()), 3)
+
+    def test_query(self):
+        self.mirror.sync(self.sources)
+        self.assertEqual(self.mirror.query(['direction==outgoing']), [
+            ('-12500', '1990-04-15', '#bills:rent'),
+        ])
+        self.assertEqual(self.mirror.query(['hashtag==None']), [
+            ('20', '1990-04-03', 'Unknown'),
+        ])
+        self.assertEqual(self.mirror.query(['value>100', 'comment=~DUES']), [
+            ('500', '1990-04-03', '#dues:test1'),
+        ])
+
+    def test_non_ascii(self):
+        comment = u'Caf\xe9 #clubmate'
+        self.sources['outgoing-1990-04'] = (
+            u'15 1990-04-20 ' + comment + u'\n').encode('utf-8')
+        self.assertEqual(self.mirror.sync(self.sources),
+                         ['incoming-1990-04', 'outgoing-1990-04'])
+        self.assertEqual(self.mirror.sync(self.sources), [])
+
+        if sys.version_info[0] == 2:  # pragma: no cover
+            comment = comment.encode('utf-8')
+        self.assertEqual(self.mirror.query(['hashtag==clubmate']), [
+            ('-15', '1990-04-20', comment),
+        ])
+
+    @mock.patch('balance.datetime.datetime', fakedatetime)
+    def test_query_rel_months(self):
+        self.mirror.sync(self.sources)
+        self.assertEqual(len(self.mirror.query(['rel_months==-1'])), 3)
+        self.assertEqual(len(self.mirror.query(['rel_months<-1'])), 0)
+
+
+class TestOutputCache(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.cache = balance.OutputCache(os.path.join(self.dirname, 'c'),
+                                         max_bytes=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_cache_key(self):
+        key = balance.cache_key('abc', 'grid', {'split': True}, '1990-05')
+        self.assertEqual(
+            key,
+            balance.cache_key('abc', 'grid', {'split': True}, '1990-05'))
+        self.assertNotEqual(
+            key,
+            balance.cache_key('abd', 'grid', {'split': True}, '1990-05'))
+        self.assertNotEqual(
+            key,
+            balance.cache_key('abc', 'sum', {'split': True}, '1990-05'))
+        self.assertNotEqual(
+            key,
+            balance.cache_key('abc', 'grid', {'split': False}, '1990-05'))
+        self.assertNotEqual(
+            key,
+            balance.cache_key('abc', 'grid', {'split': True}, '1990-06'))
+
+    def test_cache_as_of(self):
+        now = datetime.datetime(1990, 5, 2, 12, 0)
+        self.assertEqual(balance.cache_as_of(True, now), '1990-05')
+        self.assertEqual(balance.cache_as_of('day', now), '1990-05-02')
+
+        # the overdue bills in topay change from day to day
+        for cmd in ('topay', 'topay_html'):
+            self.assertEqual(balance.subp_cmds[cmd]['cache'], 'day')
+
+    def test_get_put(self):
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.put('a', '1234')
+        self.assertEqual(self.cache.get('a'), '1234')
+
+    def test_evict(self):
+        self.cache.put('a', '1234')
+        self.cache.put('b', '1234')
+        os.utime(self.cache._path('a'), (1, 1))
+        os.utime(self.cache._path('b'), (2, 2))
+        # reading "a" makes "b" the least recently used
+        self.cache.get('a')
+        self.cache.put('c', '1234')
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), '1234')
+        self.assertEqual(self.cache.get('c'), '1234')
+
+        self.assertEqual(self.cache.clear(), 2)
+        self.assertEqual(self.cache.get('a'), None)
+
+
+class TestTrends(unittest.TestCase):
+    def test_compute(self):
+        months = ['2017-01', '2017-03', '2018-03']
+        tags = ['in a', 'in b', 'out c']
+        grid = {
+            'in a': {
+                '2017-01': {'sum': 10},
+                '2017-03': {'sum': 20},
+                '2018-03': {'sum': 5},
+            },
+            'in b': {
+                '2017-03': {'sum': 15},
+            },
+            'out c': {
+                '2017-01': {'sum': -4},
+            },
+        }
+
+        (labels, trends) = balance.trends_compute(months, tags, grid)
+
+        self.assertEqual(len(labels), 15)
+        self.assertEqual(labels[0], '2017-01')
+        self.assertEqual(labels[-1], '2018-03')
+
+        a = trends['in a']
+        self.assertEqual(a['sum'][:3], [10, 0, 20])
+        self.assertEqual(a['rolling'][3][:4], [10, 10, 30, 20])
+        self.assertEqual(a['average'][3][:4], [10.0, 5.0, 10.0, 20.0 / 3])
+        self.assertEqual(a['rolling'][12][-1], 5)
+        self.assertEqual(a['yoy'][:12], [None] * 12)
+        self.assertEqual(a['yoy'][14], -15)
+        self.assertEqual(a['share'], 35.0 / 50)
+
+        self.assertEqual(trends['in b']['share'], 15.0 / 50)
+        self.assertEqual(trends['out c']['share'], 1.0)
+
+    def test_empty(self):
+        self.assertEqual(balance.trends_compute([], [], {}), ([], {}))
+
+
+class TestDupes(unittest.TestCase):
+    def test_parse_lines_source(self):
+        lines = [
+            '# comment\n',
+            '10  1990-01-01  one\n',
+            '\n',
+            '20  1990-01-02  two\n',
+        ]
+        rows = list(balance.parse_lines(lines, 'incoming', 'incoming-1990-01'))
+        self.assertEqual([r.source for r in rows],
+                         ['incoming-1990-01:2', 'incoming-1990-01:4'])
+
+        rows = list(balance.parse_lines(lines, 'incoming'))
+        self.assertEqual(rows[0].source, None)
+
+    def test_find(self):
+        rows = [
+            balance.Row('10', '1990-01-01', 'Beer  #Drinks', 'outgoing'),
+            balance.Row('10', '1990-01-01', 'beer #drinks', 'outgoing'),
+            balance.Row('10', '1990-01-01', 'beer #drinks', 'incoming'),
+            balance.Row('50', '1990-02-03', '#dues:alice', 'incoming'),
+            balance.Row('50', '1990-02-08', 'Alice #dues:alice', 'incoming'),
+            balance.Row('50', '1990-03-08', 'Alice #dues:alice', 'incoming'),
+            balance.Row('50', '1990-02-04', '#dues:bob', 'incoming'),
+            balance.Row('100', '1990-04-01', '#dues:bob !months:2',
+                        'incoming'),
+            balance.Row('50', '1990-05-03', '#dues:bob', 'incoming'),
+        ]
+
+        (groups, likely) = balance.dupes_find(rows, 5)
+
+        self.assertEqual(groups, [rows[0:2]])
+        self.assertEqual(likely, [
+            [rows[3], rows[4]],
+            [rows[7], rows[8]],
+        ])
+
+        (groups, likely) = balance.dupes_find(rows, 1)
+        self.assertEqual(likely, [])
+
+    def test_split_children(self):
+        # the months of one split row are not duplicates of each other
+        rows = [
+            balance.Row('150', '1990-01-05', '#dues:alice !months:3',
+                        'incoming'),
+            balance.Row('50', '1990-04-10', '#dues:alice', 'incoming'),
+        ]
+        for split in (balance.autosplit_rows(rows),
+                      balance.expand_spans(balance.autosplit_spans(rows))):
+            split = list(split)
+            (groups, likely) = balance.dupes_find(split, 40)
+            self.assertEqual(groups, [])
+            self.assertEqual(likely, [[split[2], split[3]]])
+
+
+class TestPaymentMatrix(unittest.TestCase):
+    def test_door_read(self):
+        html = (
+            '<table><tr><th>Name</th><th>Id</th><th>Door</th><th>Ping</th>'
+            '</tr>\n'
+            '<tr><td>Alice <b>A</b></td><td>1</td><td>front</td>'
+            '<td>1990-02-03 10:00</td></tr>\n'
+            '<tr><td>Bob</td><td>2</td><td>front</td><td></td></tr>\n'
+            '</table>'
+        )
+        self.assertEqual(list(balance.door_read(html)),
+                         [('Alice A', '1990-02')])
+
+        text = 'name,id,door,ping\nBob,2,front,1990-01-30\n'
+        self.assertEqual(list(balance.door_read(text)),
+                         [('Bob', '1990-01')])
+
+    def test_join(self):
+        rows = [
+            balance.Row('100', '1990-01-01', '#dues:alicea !months:2',
+                        'incoming'),
+            balance.Row('50', '1990-02-01', '#dues:carol', 'incoming'),
+            balance.Row('50', '1990-01-01', '#dues:dave', 'incoming'),
+            balance.Row('50', '1990-02-01', '#bills:rent', 'outgoing'),
+        ]
+        activity = [
+            ('Alice A', '1990-02'),
+            ('Bob', '1990-01'),
+            ('Bob', '1990-02'),
+            ('Carol', '1990-01'),
+            ('Dave', '1990-03'),
+        ]
+
+        (active_unpaid, paid_inactive) = balance.payment_matrix(
+            rows, activity, '1990-02')
+        self.assertEqual(active_unpaid, [
+            ('Bob', '1990-02', None),
+            ('Dave', '1990-03', '1990-01'),
+        ])
+        self.assertEqual(paid_inactive, [
+            ('Carol', '1990-01', '1990-02'),
+        ])
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.write('incoming-1990-01',
+                   '100\t1990-01-01\t#dues:alice !months:2\n'
+                   '50\t1990-01-10\t#dues:bob\n')
+        self.write('outgoing-1990-01', '30\t1990-01-05\t#bills:rent\n')
+        self.ledger = balance.Ledger(self.dirname)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def write(self, filename, text):
+        with open(os.path.join(self.dirname, filename), 'w') as f:
+            f.write(text)
+
+    def test_views(self):
+        self.assertEqual(len(self.ledger.rows), 3)
+        self.assertEqual(len(self.ledger.split_rows), 4)
+        self.assertEqual(self.ledger.total, 120)
+
+        (months, tags, grid, totals) = self.ledger.grid
+        self.assertEqual(sorted(tags), ['In dues:alice', 'In dues:bob',
+                                        'Out bills:rent'])
+        self.assertEqual(grid['In dues:alice']['1990-02']['sum'], 50)
+
+        (months, tags, grid, totals) = self.ledger.topay
+        self.assertEqual(sorted(tags), ['Bills:rent'])
+        self.assertEqual(sorted(self.ledger.payments), ['Bills:rent'])
+
+        last = self.ledger.last_payments
+        self.assertEqual(sorted(last), ['alice', 'bob'])
+        self.assertEqual(last['bob'].date, datetime.date(1990, 1, 10))
+
+    def test_topay_table(self):
+        # the same rows and flags as the topay subcommand
+        today = datetime.date(1990, 3, 1)
+        self.ledger.schedule = balance.obligations_read(['bills:rent 1 40 1'])
+        self.assertEqual(self.ledger.topay_table(today), [
+            ('1990-01', [('Bills:rent', -30, datetime.date(1990, 1, 5),
+                          'underpaid, 40 due')]),
+        ])
+
+        got = balance.topay_render(
+            self.ledger.split_rows,
+            {'header': '{date}', 'table_start': '', 'table_end': '',
+             'table_row': '{hashtag} {price} {date}'},
+            schedule=self.ledger.schedule, today=today)
+        self.assertEqual(got.split("\n")[2],
+                         'Bills:rent -30 1990-01-05 (underpaid, 40 due)')
+
+    def test_invalidate(self):
+        rows = self.ledger.rows
+        self.assertIs(self.ledger.rows, rows)
+        self.assertEqual(self.ledger.total, 120)
+
+        self.write('incoming-1990-02', '5\t1990-02-01\tdonation\n')
+        self.assertIsNot(self.ledger.rows, rows)
+        self.assertEqual(len(self.ledger.rows), 4)
+        self.assertEqual(self.ledger.total, 125)
+
+
+class TestCloseYear(unittest.TestCase):
+    def setUp(self):
+        self.rows = [
+            balance.Row('100', '1990-11-01', '#dues:alice !months:3',
+                        'incoming'),
+            balance.Row('50', '1990-11-10', '#dues:bob', 'incoming'),
+            balance.Row('20', '1990-11-20', '#dues:bob', 'incoming'),
+            balance.Row('30', '1990-12-05', '#bills:rent', 'outgoing'),
+            balance.Row('5', '1990-12-06', 'snacks', 'outgoing'),
+        ]
+        self.summary = balance.closed_summary(
+            1990, ['incoming-1990-11', 'outgoing-1990-12'], 'abc', self.rows)
+
+    def test_summary(self):
+        self.assertEqual(self.summary['balance'], '135')
+        self.assertEqual(self.summary['last_payments'], {
+            'alice': '1990-11-01',
+            'bob': '1990-11-20',
+        })
+        self.assertEqual(self.summary['cells'], [
+            ['incoming', 'dues:alice', '1990-11', '100', '1990-11-01'],
+            ['incoming', 'dues:bob', '1990-11', '70', '1990-11-20'],
+            ['outgoing', '', '1990-12', '5', '1990-12-06'],
+            ['outgoing', 'bills:rent', '1990-12', '30', '1990-12-05'],
+        ])
+        self.assertEqual(len(self.summary['split_cells']), 6)
+
+    def test_rows(self):
+        for split in (False, True):
+            rows = self.rows
+            if split:
+                rows = list(balance.autosplit_rows(rows))
+            closed = list(balance.closed_rows(self.summary, split))
+
+            self.assertEqual(sum(closed), sum(rows))
+            self.assertEqual(balance.grid_accumulate_directions(closed),
+                             balance.grid_accumulate_directions(rows))
+
+    def test_safe(self):
+        self.assertTrue(balance.closed_safe(None))
+        self.assertTrue(balance.closed_safe([
+            'month>=1990-01', 'direction==incoming', 'hashtag=~^dues:',
+        ]))
+        self.assertFalse(balance.closed_safe(['month>=1990-01', 'value>10']))
+        self.assertFalse(balance.closed_safe(['comment=~beer']))
+
+    def test_ignored(self):
+        self.assertTrue(balance.ledger_ignored('closed-1990.json'))
+        self.assertTrue(balance.ledger_ignored('membershipfees'))
+        self.assertFalse(balance.ledger_ignored('incoming-1990-11'))
+
+
+class TestTagTree(unittest.TestCase):
+    def setUp(self):
+        rows = [
+            balance.Row('10', '1990-01-01', '#dues:alice', 'incoming'),
+            balance.Row('20', '1990-01-05', '#dues:bob', 'incoming'),
+            balance.Row('30', '1990-02-01', '#dues:bob', 'incoming'),
+            balance.Row('5', '1990-01-03', '#bills:rent', 'outgoing'),
+            balance.Row('7', '1990-01-04', '#bills:net:dsl', 'outgoing'),
+            balance.Row('1', '1990-01-02', '#tshirt', 'incoming'),
+        ]
+        (months, self.tags, self.grid, totals) = \
+            balance.grid_accumulate(rows)
+
+    def test_ancestors(self):
+        self.assertEqual(balance.tag_parts('bills:rent'), ['bills', 'rent'])
+        self.assertEqual(balance.tag_ancestors('bills:net:dsl'),
+                         ['bills', 'bills:net', 'bills:net:dsl'])
+        self.assertEqual(balance.tag_ancestors('tshirt'), ['tshirt'])
+
+    def test_tree(self):
+        (nodes, tree) = balance.grid_tree(self.tags, self.grid)
+        self.assertEqual(sorted(nodes), [
+            'Bills', 'Bills:net', 'Bills:net:dsl', 'Bills:rent',
+            'Dues', 'Dues:alice', 'Dues:bob', 'Tshirt',
+        ])
+        self.assertEqual(tree['Dues']['1990-01']['sum'], 30)
+        self.assertEqual(tree['Dues']['1990-01']['last'],
+                         datetime.date(1990, 1, 5))
+        self.assertEqual(tree['Dues']['1990-02']['sum'], 30)
+        self.assertEqual(tree['Bills']['1990-01']['sum'], -12)
+        self.assertEqual(tree['Dues:bob'], self.grid['Dues:bob'])
+
+    def test_select(self):
+        (nodes, tree) = balance.grid_tree(self.tags, self.grid)
+        self.assertEqual(
+            sorted(balance.grid_tree_select(self.tags, nodes, 1)),
+            ['Bills', 'Dues', 'Tshirt'])
+        self.assertEqual(
+            sorted(balance.grid_tree_select(self.tags, nodes, 2)),
+            ['Bills:net', 'Bills:rent', 'Dues:alice', 'Dues:bob', 'Tshirt'])
+        self.assertEqual(
+            sorted(balance.grid_tree_select(self.tags, nodes, 1, ['bills'])),
+            ['Bills', 'Bills:net:dsl', 'Bills:rent', 'Dues', 'Tshirt'])
+
+        with self.assertRaises(ValueError):
+            balance.grid_tree_select(self.tags, nodes, 1, ['nothing'])
+
+    def test_select_directions(self):
+        tags = ['Out bills:rent', 'Out bills:net', 'In bills:refund']
+        nodes = set(['Out bills', 'In bills']) | set(tags)
+        self.assertEqual(
+            sorted(balance.grid_tree_select(tags, nodes, 1, ['bills'])),
+            sorted(nodes))
+        self.assertEqual(
+            sorted(balance.grid_tree_select(tags, nodes, 1, ['Out bills'])),
+            ['In bills', 'Out bills', 'Out bills:net', 'Out bills:rent'])
+
+    def test_leaf_and_parent(self):
+        # "bills" is used on its own as well as above "bills:rent"
+        rows = [
+            balance.Row('5', '1990-01-03', '#bills:rent', 'outgoing'),
+            balance.Row('2', '1990-01-04', '#bills', 'outgoing'),
+        ]
+        (months, tags, grid, totals) = balance.grid_accumulate(rows)
+        (nodes, tree) = balance.grid_tree(tags, grid)
+        selected = balance.grid_tree_select(tags, nodes, 2)
+        self.assertEqual(sorted(selected), ['Bills', 'Bills:rent'])
+
+        # each amount is only shown once
+        cells = balance.grid_tree_cells(grid, tree, selected, 2)
+        self.assertEqual(cells['Bills']['1990-01']['sum'], -2)
+        self.assertEqual(cells['Bills:rent']['1990-01']['sum'], -5)
+
+        cells = balance.grid_tree_cells(grid, tree, set(['Bills']), 1)
+        self.assertEqual(cells['Bills']['1990-01']['sum'], -7)
+
+
+class TestTimeCube(unittest.TestCase):
+    def setUp(self):
+        self.rows = [
+            balance.Row('10', '1990-01-01', '#dues:alice', 'incoming'),
+            balance.Row('20', '1990-01-07', '#dues:alice', 'incoming'),
+            balance.Row('30', '1990-01-08', '#dues:alice', 'incoming'),
+            balance.Row('5', '1990-03-31', '#bills:rent', 'outgoing'),
+            balance.Row('40', '1990-04-01', '#dues:alice', 'incoming'),
+            balance.Row('60', '1991-01-01', '#dues:alice !months:3',
+                        'incoming'),
+        ]
+
+    def test_period_name(self):
+        self.assertEqual(balance.period_name('month', 1990 * 12), '1990-01')
+        self.assertEqual(balance.period_name('quarter', 1990 * 4 + 1),
+                         '1990-Q2')
+        self.assertEqual(balance.period_name('year', 1990), '1990')
+
+        # 1990-01-01 was a Monday
+        week = balance.period_key(
+            'week', datetime.date(1990, 1, 7).toordinal())
+        self.assertEqual(balance.period_name('week', week), '1990-W01')
+        self.assertEqual(balance.period_key(
+            'week', datetime.date(1990, 1, 8).toordinal()), week + 1)
+
+        with self.assertRaises(ValueError):
+            balance.period_key('fortnight', 1)
+
+    def test_month_matches_grid(self):
+        rows = list(balance.autosplit_rows(self.rows))
+        self.assertEqual(balance.cube_accumulate(rows, 'month'),
+                         balance.grid_accumulate(rows))
+
+        spans = list(balance.autosplit_spans(self.rows))
+        self.assertEqual(balance.cube_accumulate(spans, 'month'),
+                         balance.grid_accumulate(rows))
+
+    def test_rollup(self):
+        cube = balance.TimeCube()
+        for row in self.rows:
+            cube.add(row)
+
+        (periods, tags, grid, totals) = cube.result('week')
+        self.assertEqual(grid['Dues:alice']['1990-W01'], {
+            'sum': 30, 'last': datetime.date(1990, 1, 7),
+        })
+        self.assertEqual(grid['Dues:alice']['1990-W02']['sum'], 30)
+
+        (periods, tags, grid, totals) = cube.result('quarter')
+        self.assertEqual(sorted(periods), ['1990-Q1', '1990-Q2', '1991-Q1'])
+        self.assertEqual(grid['Dues:alice']['1990-Q1']['sum'], 60)
+        self.assertEqual(totals['1990-Q1'], 55)
+        self.assertEqual(grid['Bills:rent']['1990-Q1']['last'],
+                         datetime.date(1990, 3, 31))
+
+        (periods, tags, grid, totals) = cube.result('year')
+        self.assertEqual(totals, {'1990': 95, '1991': 60, 'total': 155})
+
+        # adding more rows makes the rollups catch up
+        cube.add(balance.Row('1', '1990-12-31', 'late', 'incoming'))
+        (periods, tags, grid, totals) = cube.result('year')
+        self.assertEqual(totals['1990'], 96)
+
+
+class TestObligations(unittest.TestCase):
+    def setUp(self):
+        self.rows = [
+            balance.Row("12500", "1990-01-03", "#bills:rent", "outgoing"),
+            balance.Row("12500", "1990-02-02", "#bills:rent", "outgoing"),
+            balance.Row("10000", "1990-03-04", "#bills:rent", "outgoing"),
+            balance.Row("900", "1990-01-20", "#bills:power", "outgoing"),
+            balance.Row("1500", "1990-03-21", "#bills:power", "outgoing"),
+            balance.Row("300", "1990-04-02", "#clubmate", "outgoing"),
+            balance.Row("500", "1990-04-02", "#dues:test1", "incoming"),
+        ]
+        self.today = datetime.date(1990, 4, 10)
+
+    def payments(self):
+        payments = {}
+        for row in balance.obligation_payments(self.rows, payments):
+            pass
+        return payments
+
+    def test_learn(self):
+        payments = self.payments()
+        self.assertEqual(sorted(payments), ['Bills:power', 'Bills:rent'])
+
+        rent = balance.obligation_learn('Bills:rent', payments['Bills:rent'])
+        self.assertEqual(rent, balance.Obligation('Bills:rent', 1, 12500, 3))
+
+        # varying amounts are not checked, and the period is learnt
+        power = balance.obligation_learn('Bills:power',
+                                         payments['Bills:power'])
+        self.assertEqual(power, balance.Obligation('Bills:power', 2, None, 21))
+
+        self.assertIsNone(balance.obligation_learn(
+            'Bills:rent', payments['Bills:rent'][:1]))
+
+    def test_status(self):
+        payments = self.payments()
+        rent = balance.Obligation('Bills:rent', 1, 12500, 3)
+        jan = balance.month_index(datetime.date(1990, 1, 1))
+        got = balance.obligation_status(
+            rent, payments['Bills:rent'], jan, jan + 4, self.today)
+        self.assertEqual(got, {
+            '1990-03': ('underpaid', 10000),
+            '1990-04': ('overdue', 0),
+        })
+
+        # not due yet
+        got = balance.obligation_status(
+            rent, payments['Bills:rent'], jan, jan + 4,
+            datetime.date(1990, 4, 3))
+        self.assertEqual(got, {'1990-03': ('underpaid', 10000)})
+
+        # a scheduled bill that was never paid is due from the first month
+        water = balance.Obligation('Bills:water', 3, None, 31)
+        got = balance.obligation_status(water, [], jan, jan + 4, self.today)
+        self.assertEqual(got, {'1990-01': ('overdue', 0)})
+
+    def test_read(self):
+        lines = [
+            "# tag months amount day",
+            "",
+            "bills:rent 1 -12500 1",
+            "bills:water 3 - 15",
+        ]
+        self.assertEqual(balance.obligations_read(lines), {
+            'Bills:rent': balance.Obligation('Bills:rent', 1, 12500, 1),
+            'Bills:water': balance.Obligation('Bills:water', 3, None, 15),
+        })
+        with self.assertRaises(ValueError):
+            balance.obligations_read(["bills:rent 1"])
+
+    def test_topay_render(self):
+        strings = {
+            'header': 'header: {date}',
+            'table_start': 'table_start:',
+            'table_end': 'table_end:',
+            'table_row': 'table_row: {hashtag}, {price}, {date}',
+        }
+        schedule = balance.obligations_read(["bills:water 12 - 15"])
+        got = balance.topay_render(self.rows, strings, schedule=schedule,
+                                   today=self.today).split("\n")
+        self.assertEqual(got[1:6], [
+            "table_start:",
+            "table_row: Bills:power, -900, 1990-01-20",
+            "table_row: Bills:rent, -12500, 1990-01-03",
+            "table_row: Bills:water, $0, Not Yet (overdue)",
+            "table_row: Clubmate, $0, Not Yet",
+        ])
+        self.assertEqual(got[-7:-2], [
+            "table_start:",
+            "table_row: Bills:power, $0, Not Yet",
+            "table_row: Bills:rent, $0, Not Yet (overdue, 12500 due)",
+            "table_row: Bills:water, $0, Not Yet",
+            "table_row: Clubmate, -300, 1990-04-02",
+        ])
+        self.assertIn(
+            "table_row: Bills:rent, -10000, 1990-03-04 "
+            "(underpaid, 12500 due)", got)
+
+
+class TestSite(unittest.TestCase):
+    def setUp(self):
+        rows = [
+            balance.Row('100', '1990-01-01', '#dues:alice <b>', 'incoming'),
+            balance.Row('30', '1990-01-05', '#bills:rent', 'outgoing'),
+            balance.Row('50', '1990-02-01', '#dues:alice', 'incoming'),
+        ]
+        self.model = balance.SiteModel(iter(rows))
+
+    def test_pages(self):
+        pages = self.model.pages()
+        self.assertEqual([p[0] for p in pages], [
+            'month-1990-01.html',
+            'month-1990-02.html',
+            'member-alice.html',
+            'index.html',
+        ])
+        self.assertEqual(pages[1][2], {
+            'month': '1990-02',
+            'topay': [('Bills:rent', '$0', 'Not Yet')],
+            'grid': [('In dues:alice', '50')],
+            'total': '50',
+            'balance': '120',
+        })
+        self.assertEqual(pages[3][2], {
+            'balance': '120',
+            'months': ['1990-01', '1990-02'],
+            'members': ['alice'],
+        })
+
+    def test_topay(self):
+        # the bills are shown and flagged just as they are by topay_html
+        rows = [
+            balance.Row('30', '1990-01-05', '#bills:rent', 'outgoing'),
+            balance.Row('30', '1990-02-05', '#bills:rent', 'outgoing'),
+            balance.Row('50', '1990-03-01', '#dues:alice', 'incoming'),
+        ]
+        today = datetime.date(1990, 4, 1)
+        model = balance.SiteModel(rows, today=today)
+        self.assertEqual(model.month_page('1990-03', 0)['topay'], [
+            ('Bills:rent', '$0', 'Not Yet (overdue, 30 due)'),
+        ])
+        self.assertEqual(model.month_page('1990-02', 0)['topay'], [
+            ('Bills:rent', '-30', '1990-02-05'),
+        ])
+
+        # the flags are the same as for topay, over the same months
+        got = balance.topay_render(rows + [
+            balance.Row('1', '1990-03-01', '#other', 'outgoing'),
+        ], {
+            'header': '', 'table_start': '', 'table_end': '',
+            'table_row': '{hashtag} {price} {date}',
+        }, today=today)
+        self.assertIn('Bills:rent $0 Not Yet (overdue, 30 due)', got)
+
+    def test_render(self):
+        pages = self.model.pages()
+        (filename, html) = balance.site_render(pages[2])
+        self.assertEqual(filename, 'member-alice.html')
+        self.assertIn('<td>#dues:alice &lt;b&gt;</td>', html)
+
+        (filename, html) = balance.site_render(pages[3])
+        self.assertIn('<a href="month-1990-02.html">1990-02</a>', html)
+        self.assertIn('<a href="member-alice.html">alice</a>', html)
+
+        with self.assertRaises(ValueError):
+            balance.site_render(('x', 'unknown', {}))
+
+    def test_changed(self):
+        pages = self.model.pages()
+        (changed, manifest) = balance.site_changed(pages, {})
+        self.assertEqual(changed, pages)
+
+        (changed, again) = balance.site_changed(pages, manifest)
+        self.assertEqual(changed, [])
+        self.assertEqual(again, manifest)
+
+        pages[1][2]['balance'] = '121'
+        (changed, again) = balance.site_changed(pages, manifest)
+        self.assertEqual(changed, [pages[1]])
+
+
+class TestSeal(unittest.TestCase):
+    def setUp(self):
+        self.files = ['incoming-1990-01', 'incoming-1990-02',
+                      'outgoing-1990-01', 'outgoing-1990-02',
+                      'outgoing-1990-03']
+        self.contents = dict((f, f.encode('utf-8')) for f in self.files)
+        self.stats = dict((f, [10, 1.5]) for f in self.files)
+        self.rehashed = []
+
+    def rehash(self, filename):
+        self.rehashed.append(filename)
+        data = self.contents[filename]
+        return (balance.merkle_leaf(filename, data), str(len(data)))
+
+    def test_tree(self):
+        leaves = ['a', 'b', 'c']
+        levels = balance.merkle_tree(leaves)
+        ab = balance.merkle_node('a', 'b')
+        self.assertEqual(levels, [
+            ['a', 'b', 'c'],
+            [ab, 'c'],
+            [balance.merkle_node(ab, 'c')],
+        ])
+
+        balance.merkle_update(levels, 2, 'd')
+        self.assertEqual(levels, balance.merkle_tree(['a', 'b', 'd']))
+        balance.merkle_update(levels, 0, 'e')
+        self.assertEqual(levels, balance.merkle_tree(['e', 'b', 'd']))
+
+    def test_verify(self):
+        seal = balance.seal_build(self.files, self.stats, self.rehash)
+        self.assertEqual(seal['root'], seal['tree'][-1][0])
+        self.assertEqual(seal['files'][0][-1], '16')
+
+        # nothing is read if nothing has changed
+        self.rehashed = []
+        got = balance.seal_verify(seal, self.files, self.stats, self.rehash)
+        self.assertEqual(got, ([], [], [], seal['root']))
+        self.assertEqual(self.rehashed, [])
+
+        # a touched file is read, but has not changed
+        self.stats['incoming-1990-02'] = [10, 2.5]
+        got = balance.seal_verify(seal, self.files, self.stats, self.rehash)
+        self.assertEqual(got, ([], [], [], seal['root']))
+        self.assertEqual(self.rehashed, ['incoming-1990-02'])
+
+        self.contents['outgoing-1990-02'] = b'changed'
+        self.stats['outgoing-1990-02'] = [7, 1.5]
+        (changed, added, removed, root) = balance.seal_verify(
+            seal, self.files, self.stats, self.rehash)
+        self.assertEqual(changed, [('outgoing-1990-02', '16', '7')])
+        self.assertEqual(root, balance.seal_build(
+            self.files, self.stats, self.rehash)['root'])
+
+    def test_verify_added(self):
+        seal = balance.seal_build(self.files, self.stats, self.rehash)
+        files = self.files[1:] + ['outgoing-1990-04']
+        self.contents['outgoing-1990-04'] = b'new'
+        self.stats['outgoing-1990-04'] = [3, 1.5]
+        del self.stats['incoming-1990-01']
+
+        self.rehashed = []
+        (changed, added, removed, root) = balance.seal_verify(
+            seal, files, self.stats, self.rehash)
+        self.assertEqual(changed, [])
+        self.assertEqual(added, ['outgoing-1990-04'])
+        self.assertEqual(removed, ['incoming-1990-01'])
+        self.assertEqual(self.rehashed, ['outgoing-1990-04'])
+        self.assertEqual(root, balance.seal_build(
+            files, self.stats, self.rehash)['root'])
+
+
+class TestCommentIndex(unittest.TestCase):
+    def setUp(self):
+        self.rows = [
+            balance.Row("12500", "1990-04-15", "Rent #bills:rent", "outgoing"),
+            balance.Row("1174", "1990-04-27", "#bills:electric", "outgoing"),
+            balance.Row("500", "1990-04-03", "Alice #dues:alice", "incoming"),
+            balance.Row("600", "1990-04-03", "Bookshelf rental", "incoming"),
+            balance.Row("20", "1990-05-01", "from ALICE", "incoming"),
+        ]
+        self.index = balance.CommentIndex(self.rows)
+
+    def test_tokens(self):
+        self.assertEqual(balance.CommentIndex.tokens("Rent #Bills:rent"),
+                         set(['rent', 'bills', '#bills', '#bills:rent']))
+
+    def test_search(self):
+        def comments(rows):
+            return [row.comment for row in rows]
+
+        self.assertEqual(comments(self.index.search(['alice'])), [
+            "Alice #dues:alice", "from ALICE",
+        ])
+        self.assertEqual(comments(self.index.search(['#bills'])), [
+            "Rent #bills:rent", "#bills:electric",
+        ])
+        self.assertEqual(comments(self.index.search(['#bills', 'rent'])), [
+            "Rent #bills:rent",
+        ])
+        self.assertEqual(comments(self.index.search(['#dues', 'rent'],
+                                                    any_term=True)), [
+            "Alice #dues:alice", "Rent #bills:rent",
+        ])
+        self.assertEqual(self.index.search(['nothing']), [])
+
+    def test_filter(self):
+        self.assertEqual(balance.comment_filter_word('comment=~Rent'), 'rent')
+        self.assertIsNone(balance.comment_filter_word('comment=~^rent'))
+        self.assertIsNone(balance.comment_filter_word('hashtag=~rent'))
+
+        # the index gives the same rows as the regex, including rows it has
+        # not seen
+        extra = balance.Row("1", "1990-05-02", "rent !child", "outgoing")
+        for s in ('comment=~rent', 'comment=~LICE', 'comment=~bill'):
+            rows = self.rows + [extra]
+            want = list(balance.apply_filter_strings([s], rows))
+            got = list(balance.apply_filter_strings([s], rows, self.index))
+            self.assertEqual(got, want)
+
+    def test_dumps(self):
+        index = balance.CommentIndex.loads(reversed(self.rows),
+                                           self.index.dumps())
+        self.assertEqual(index.postings, self.index.postings)
+        self.assertEqual(index.search(['alice']), self.index.search(['alice']))
+
+        # the saved postings are not used for different rows
+        index = balance.CommentIndex.loads(self.rows[:2], self.index.dumps())
+        self.assertEqual(index.search(['alice']), [])
+
+
+class TestFastSum(unittest.TestCase):
+    def check(self, files):
+        total = balance.FastSum()
+        rows = []
+        for direction, lines in files:
+            total.add_lines(lines, direction)
+            rows.extend(balance.parse_lines(lines, direction))
+        got = total.result()
+        self.assertEqual(str(got), str(sum(rows)))
+        return got
+
+    def test_matches_rows(self):
+        self.assertEqual(str(self.check([])), '0')
+        self.check([
+            ('incoming', ['10\t1990-01-01\tone\n', '\n', '# comment\n']),
+            ('outgoing', ['3\t1990-01-02\ttwo\n']),
+        ])
+        got = self.check([
+            ('incoming', ['10\t1990-01-01\tone\n', '2.5 1990-01-01 x\n']),
+            ('outgoing', ['0.25\t1990-01-02\ttwo\n', '1.\t1990-01-02\tz\n']),
+        ])
+        self.assertEqual(str(got), '11.25')
+        got = self.check([
+            ('outgoing', ['1E+1\t1990-01-02\tten\n']),
+            ('incoming', ['20.0\t1990-01-02\ttwenty\n']),
+        ])
+        self.assertEqual(str(got), '10.0')
+
+    def test_invalid(self):
+        total = balance.FastSum()
+        with self.assertRaises(ValueError):
+            total.add_lines(['-10\t1990-01-01\tnegative\n'], 'incoming')
+        with self.assertRaises(ValueError):
+            total.add_lines(['10\t1990-01-01\tx\n'], 'sideways')
+        with self.assertRaises(decimal.InvalidOperation):
+            total.add_lines(['ten\t1990-01-01\tx\n'], 'incoming')
+
+    def test_possible(self):
+        self.assertTrue(balance.fast_sum_possible(None))
+        self.assertTrue(balance.fast_sum_possible([
+            'direction==incoming', 'direction!=outgoing',
+        ]))
+        self.assertFalse(balance.fast_sum_possible(['month>=1990-01']))
+        self.assertFalse(balance.fast_sum_possible(['direction=~in']))
+
+
+class TestCommands(unittest.TestCase):
+    def test_args(self):
+        import argparse
+
+        # every command's options can be added to a parser of its own
+        for name, cmd in balance.subp_cmds.items():
+            parser = argparse.ArgumentParser()
+            for names, options in cmd.get('args', []):
+                parser.add_argument(*names, **options)
+
+        parser = argparse.ArgumentParser()
+        for names, options in balance.subp_cmds['grid']['args']:
+            parser.add_argument(*names, **options)
+        args = parser.parse_args(['--period', 'year', '--depth', '1'])
+        self.assertEqual(args.period, 'year')
+        self.assertEqual(args.depth, 1)
+        self.assertEqual(args.drill, [])
+
+    def test_command_find(self):
+        options = balance.main_options()
+        for argv, cmd in (
+                (['sum'], 'sum'),
+                (['--filter', 'sum', '--out', 'grid', 'topay', '--period',
+                  'year'], 'topay'),
+                (['--dir', 'topay', '--split', 'grid', '--drill', 'sum'],
+                 'grid'),
+                (['search', 'sum', 'party'], 'search'),
+                (['--split'], None),
+                (['--dir'], None),
+        ):
+            self.assertEqual(balance.command_find(options, argv), cmd, argv)